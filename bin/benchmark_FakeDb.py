@@ -0,0 +1,297 @@
+#!/usr/bin/python
+usage = "benchmark_FakeDb.py [--options] benchmark benchmark ..."
+description = "times common FakeDb operations so that we can compare implementations. Known benchmarks are : createEvent, pickle, logs, footprints, voevents, signoffs"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import sys
+
+import time
+import numpy as np
+
+import shutil
+import tempfile
+
+from ligoTest.gracedb.rest import FakeDb
+from ligoTest.gracedb import engines
+
+import pipelines
+import schedule
+
+from optparse import OptionParser
+
+#-------------------------------------------------
+
+parser = OptionParser(usage=usage, description=description)
+
+parser.add_option('-v', '--verbose', default=False, action='store_true')
+
+parser.add_option('-N', '--Nevents', default=20, type='int', help='the number of events we create for each pipeline')
+parser.add_option('-p', '--pipeline', default=[], type='string', action='append', help='benchmark createEvent for this pipeline. \
+Can be repeated. DEFAULT=gstlal, pycbc, CWB and LIB')
+
+parser.add_option('-n', '--Nrecords', default=[], type='int', action='append', help='benchmark pickle and logs for logs.pkl with this many entries. \
+Can be repeated. DEFAULT=1000, 10000')
+parser.add_option('-F', '--Nfootprints', default=[], type='int', action='append', help='benchmark footprints for events with this many footprints. \
+Can be repeated. DEFAULT=1000, 20000')
+parser.add_option('-V', '--Nvoevents', default=1000, type='int', help='the number of VOEvents we create for the voevents benchmark')
+parser.add_option('-S', '--Nsignoffs', default=1000, type='int', help='the number of signoffs we write for the signoffs benchmark')
+parser.add_option('-r', '--repeat', default=5, type='int', help='the number of times we repeat each pickle measurement')
+
+parser.add_option('-o', '--output-dir', default=None, type='string', help='where we write files and FakeDb directories. \
+DEFAULT is a temporary directory which is removed afterward')
+
+opts, args = parser.parse_args()
+
+if not args:
+    args = ['createEvent']
+
+if not opts.pipeline:
+    opts.pipeline = ['gstlal', 'pycbc', 'CWB', 'LIB']
+
+if not opts.Nrecords:
+    opts.Nrecords = [1000, 10000]
+
+if not opts.Nfootprints:
+    opts.Nfootprints = [1000, 20000]
+
+keep = opts.output_dir!=None
+if not keep:
+    opts.output_dir = tempfile.mkdtemp()
+elif not os.path.exists(opts.output_dir):
+    os.makedirs(opts.output_dir)
+
+#-------------------------------------------------
+
+__pipeline2group__ = {'gstlal'       : 'CBC',
+                      'gstlal-spiir' : 'CBC',
+                      'pycbc'        : 'CBC',
+                      'MBTAOnline'   : 'CBC',
+                      'CWB'          : 'Burst',
+                      'LIB'          : 'Burst',
+                     }
+
+def timeit(foo, *args, **kwargs):
+    '''
+    returns the time (in sec) it takes to call foo, hiding anything foo prints
+    '''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        t0 = time.time()
+        foo(*args, **kwargs)
+        return time.time()-t0
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def report(name, times):
+    times = np.array(times)*1e3
+    print "    %-24s : mean = %8.3f ms, median = %8.3f ms, min = %8.3f ms, max = %8.3f ms"%(name, np.mean(times), np.median(times), np.min(times), np.max(times))
+
+def genLogs(Nrecords):
+    '''
+    Nrecords log messages like those FakeDb writes
+    '''
+    return [{'comment': 'benchmark log message %d'%i,
+             'created': 1e9+i,
+             'self': os.path.join(opts.output_dir, 'T000001', 'logs.pkl'),
+             'file_version': 0,
+             'filename': '',
+             'tag_names': [],
+             'file': '',
+             'N': i+1,
+             'tags': '',
+             'issuer': {'username': 'albert.einstein@LIGO.ORG',
+                        'display_name': 'albert.einstein',
+                       },
+            } for i in xrange(Nrecords)]
+
+def benchmark_createEvent():
+    '''
+    createEvent latency for each pipeline
+        before : coinc documents are loaded with glue.ligolw and nothing is remembered between uploads
+        cold   : coinc documents are streamed (ligolwStream) and each file is new to FakeDb
+        replay : the same files are uploaded again, so extracted attributes come from FakeDb's cache
+    '''
+    for pipeline in opts.pipeline:
+        group = __pipeline2group__[pipeline]
+        print "createEvent : %s"%pipeline
+
+        ### generate files to upload
+        directory = os.path.join(opts.output_dir, pipeline)
+        os.makedirs(directory)
+        filenames = []
+        for i in xrange(opts.Nevents):
+            event = schedule.GraceDBEvent('benchmark-%s-%d'%(pipeline, i))
+            pipe = pipelines.initPipeline(1e9+10*i, 10**np.random.uniform(-10, -6), ['H1', 'L1'], group, pipeline, event)
+            filenames.append( pipe.genFiles(directory=directory)[0] )
+        if opts.verbose:
+            print "    generated %d files in %s"%(len(filenames), directory)
+
+        for name, fast, cacheSize, replay in [('before', False, 0, False), ('cold', True, FakeDb.__extraAttributesCacheSize__, False), ('replay', True, FakeDb.__extraAttributesCacheSize__, True)]:
+            gdb = FakeDb(os.path.join(opts.output_dir, '%s-%s'%(pipeline, name)))
+
+            defaultFast, defaultSize = FakeDb.fastExtraAttributes, FakeDb.__extraAttributesCacheSize__
+            FakeDb.fastExtraAttributes = fast
+            FakeDb.__extraAttributesCacheSize__ = cacheSize
+            FakeDb.__extraAttributesCache__.clear()
+            try:
+                if replay: ### warm up the cache with the same files
+                    for filename in filenames:
+                        timeit(gdb.createEvent, group, pipeline, filename)
+                report(name, [timeit(gdb.createEvent, group, pipeline, filename) for filename in filenames])
+            finally:
+                FakeDb.fastExtraAttributes, FakeDb.__extraAttributesCacheSize__ = defaultFast, defaultSize
+                gdb.close()
+
+def benchmark_pickle():
+    '''
+    latency of logs.pkl for each on-disk format version (see engines.DirectoryEngine.__version2protocol__)
+        write  : write every entry (what DirectoryEngine.upgrade does)
+        read   : load every entry
+        append : add a single entry to the end
+    '''
+    for Nrecords in opts.Nrecords:
+        logs = genLogs(Nrecords)
+
+        for version, protocol in sorted(engines.DirectoryEngine.__version2protocol__.items()):
+            print "pickle : %d entries, version=%d (protocol=%d)"%(Nrecords, version, protocol)
+
+            engine = engines.DirectoryEngine(os.path.join(opts.output_dir, 'pickle-%d-v%d'%(Nrecords, version)))
+            engine.__protocol__ = protocol
+            path = os.path.join(engine.service_url, 'logs.pkl')
+
+            report('write', [timeit(engine.__createRecords__, path, logs) for _ in xrange(opts.repeat)])
+            report('read', [timeit(engine.__extract__, path) for _ in xrange(opts.repeat)])
+            report('append', [timeit(engine.__append__, logs[-1], path) for _ in xrange(opts.repeat)])
+            if opts.verbose:
+                print "    %-24s : %d bytes"%('size', os.path.getsize(path))
+            engine.close()
+
+def benchmark_logs():
+    '''
+    latency of reading an event's logs through each engine
+        all    : every entry (what FakeDb.logs returns by default)
+        page   : 10 entries from the middle (FakeDb.logs with start and count)
+        since  : the last 10 entries (FakeDb.logs_since)
+    '''
+    for Nrecords in opts.Nrecords:
+        logs = genLogs(Nrecords)
+
+        for url in [os.path.join(opts.output_dir, 'logs-%d'%Nrecords), 'sqlite://'+os.path.join(opts.output_dir, 'logs-%d.db'%Nrecords), 'mem://logs-%d'%Nrecords]:
+            print "logs : %d entries, %s"%(Nrecords, url)
+
+            engine = engines.initEngine(url)
+            engine.create('T000001')
+            for log in logs:
+                engine.append('T000001', 'logs', log)
+
+            report('all', [timeit(engine.read, 'T000001', 'logs') for _ in xrange(opts.repeat)])
+            report('page', [timeit(engine.readRange, 'T000001', 'logs', start=Nrecords/2, stop=Nrecords/2+10) for _ in xrange(opts.repeat)])
+            report('since', [timeit(engine.readRange, 'T000001', 'logs', start=Nrecords-10) for _ in xrange(opts.repeat)])
+            engine.close()
+            if url.startswith('mem://'):
+                engines.MemoryEngine.drop(url[len('mem://'):])
+
+def benchmark_footprints():
+    '''
+    latency of EM observations through FakeDb with each engine. We create 10 events, each with a single observation
+        write   : writeEMObservation for one event
+        read    : emobservations for one event (every footprint)
+        query   : observationsOverlapping a 10x10 degree box across every event
+    '''
+    for Nfootprints in opts.Nfootprints:
+        for url in [os.path.join(opts.output_dir, 'footprints-%d'%Nfootprints), 'sqlite://'+os.path.join(opts.output_dir, 'footprints-%d.db'%Nfootprints), 'mem://footprints-%d'%Nfootprints]:
+            print "footprints : %d footprints per event, %s"%(Nfootprints, url)
+
+            gdb = FakeDb(url)
+            graceids = []
+            for i in xrange(10):
+                graceid = gdb.engine.genGraceID('T')
+                gdb.engine.create(graceid)
+                gdb.engine.write(graceid, 'toplevel', {'graceid':graceid, 'gpstime':1e9+i, 'group':'Test', 'pipeline':'gstlal', 'search':'LowMass'})
+                graceids.append(graceid)
+
+            times = []
+            for graceid in graceids:
+                ra = np.random.uniform(0, 360, Nfootprints)
+                dec = np.random.uniform(-90, 90, Nfootprints)
+                start = 1e9 + np.random.uniform(0, 86400, Nfootprints)
+                times.append( timeit(gdb.writeEMObservation, graceid, 'Test', ra, [1.], dec, [1.], start, [60.]) )
+            report('write', times)
+
+            report('read', [timeit(gdb.emobservations, graceid) for graceid in graceids[:opts.repeat]])
+            report('query', [timeit(gdb.observationsOverlapping, ra=(10*i, 10*i+10), dec=(-5, 5)) for i in xrange(opts.repeat)])
+            gdb.close()
+            if url.startswith('mem://'):
+                engines.MemoryEngine.drop(url[len('mem://'):])
+
+def benchmark_voevents():
+    '''
+    latency of FakeDb.createVOEvent with each engine, cycling through every voevent type for a single event with a sky map
+    '''
+    for url in [os.path.join(opts.output_dir, 'voevents'), 'sqlite://'+os.path.join(opts.output_dir, 'voevents.db'), 'mem://voevents']:
+        print "voevents : %d VOEvents, %s"%(opts.Nvoevents, url)
+
+        gdb = FakeDb(url)
+        graceid = gdb.engine.genGraceID('T')
+        gdb.engine.create(graceid)
+        gdb.engine.write(graceid, 'toplevel', {'graceid':graceid, 'gpstime':1e9, 'group':'Test', 'pipeline':'gstlal', 'search':'LowMass', 'far':1e-8, 'instruments':'H1,L1'})
+        gdb.engine.append(graceid, 'files', gdb.engine.attachData(graceid, 'bayestar.fits.gz', 'not really a sky map'))
+
+        types = ['PR', 'IN', 'UP', 'RE']
+        times = [timeit(gdb.createVOEvent, graceid, types[i%len(types)]) for i in xrange(opts.Nvoevents)]
+        report('createVOEvent', times)
+        print "    %-24s : %.1f per sec"%('throughput', len(times)/np.sum(times))
+        gdb.close()
+        if url.startswith('mem://'):
+            engines.MemoryEngine.drop(url[len('mem://'):])
+
+def benchmark_signoffs():
+    '''
+    latency of signoffs with each engine, for a single event that operators and advocates keep signing off on
+        write  : writeSignoff, cycling through instruments and statuses so that most calls update an existing signoff
+        lookup : signoffs for a single (signoff_type, instrument)
+    '''
+    signoffs = [('H1', 'OP'), ('L1', 'OP'), ('V1', 'OP'), (None, 'ADV')]
+    for url in [os.path.join(opts.output_dir, 'signoffs'), 'sqlite://'+os.path.join(opts.output_dir, 'signoffs.db'), 'mem://signoffs']:
+        print "signoffs : %d signoffs, %s"%(opts.Nsignoffs, url)
+
+        gdb = FakeDb(url)
+        graceid = gdb.engine.genGraceID('T')
+        gdb.engine.create(graceid)
+        gdb.engine.write(graceid, 'toplevel', {'graceid':graceid, 'gpstime':1e9, 'group':'Test', 'pipeline':'gstlal', 'search':'LowMass'})
+        gdb.engine.write(graceid, 'signoffs', dict())
+
+        times = []
+        for i in xrange(opts.Nsignoffs):
+            instrument, signoff_type = signoffs[i%len(signoffs)]
+            times.append( timeit(gdb.writeSignoff, graceid, instrument, signoff_type, ['OK', 'NO'][(i/len(signoffs))%2]) )
+        report('write', times)
+        report('lookup', [timeit(gdb.signoffs, graceid, 'OP', 'H1') for _ in xrange(opts.repeat)])
+        gdb.close()
+        if url.startswith('mem://'):
+            engines.MemoryEngine.drop(url[len('mem://'):])
+
+__benchmarks__ = {'createEvent' : benchmark_createEvent,
+                  'pickle'      : benchmark_pickle,
+                  'logs'        : benchmark_logs,
+                  'footprints'  : benchmark_footprints,
+                  'voevents'    : benchmark_voevents,
+                  'signoffs'    : benchmark_signoffs,
+                 }
+
+#-------------------------------------------------
+
+try:
+    for arg in args:
+        if not __benchmarks__.has_key(arg):
+            raise ValueError('benchmark=%s not understood. Must be one of : %s'%(arg, ', '.join(sorted(__benchmarks__.keys()))))
+        __benchmarks__[arg]()
+
+finally:
+    if not keep:
+        shutil.rmtree(opts.output_dir)
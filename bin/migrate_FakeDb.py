@@ -0,0 +1,57 @@
+#!/usr/bin/python
+usage = "migrate_FakeDb.py [--options] directory"
+description = "upgrades a directory-backed FakeDb to the current on-disk format and/or converts it between the flat and sharded layouts. Nothing else may write to the directory while this runs. If interrupted, run it again to finish the migration"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+
+from ligoTest.gracedb import engines
+
+from optparse import OptionParser
+
+#-------------------------------------------------
+
+parser = OptionParser(usage=usage, description=description)
+
+parser.add_option('-v', '--verbose', default=False, action='store_true')
+
+parser.add_option('-u', '--upgrade', default=False, action='store_true', help='rewrite every event in the current on-disk format \
+(version=%d)'%engines.DirectoryEngine.__formatVersion__)
+parser.add_option('-l', '--layout', default=None, type='string', help='the layout we convert to. Must be one of : %s. \
+DEFAULT is to keep the current layout'%(', '.join(engines.DirectoryEngine.__layouts__)))
+
+opts, args = parser.parse_args()
+
+if len(args)!=1:
+    raise ValueError('please supply exactly one directory as an argument')
+directory = args[0]
+
+if not os.path.isdir(directory):
+    raise ValueError('could not find directory=%s'%directory)
+
+if (not opts.upgrade) and (opts.layout==None):
+    raise ValueError('please supply --upgrade and/or --layout')
+
+if (opts.layout!=None) and (opts.layout not in engines.DirectoryEngine.__layouts__):
+    raise ValueError('--layout=%s not understood. Must be one of : %s'%(opts.layout, ', '.join(engines.DirectoryEngine.__layouts__)))
+
+#-------------------------------------------------
+
+engine = engines.DirectoryEngine(directory)
+
+if opts.upgrade:
+    if opts.verbose:
+        print "%s : version=%d -> %d"%(directory, engine.format['version'], engine.__formatVersion__)
+    engine.upgrade(verbose=opts.verbose)
+
+if opts.layout!=None:
+    if opts.verbose:
+        print "%s : layout=%s -> %s"%(directory, engine.layout, opts.layout)
+    engine.relayout(opts.layout, verbose=opts.verbose)
+
+engine.close()
+
+if opts.verbose:
+    print "done"
@@ -15,6 +15,8 @@ import random
 import simUtils as utils
 import schedule
 
+from ligoTest.gracedb import asyncdb
+
 from lal.gpstime import tconvert
 
 from ConfigParser import SafeConfigParser
@@ -40,6 +42,8 @@ parser.add_option("-p", "--pause", default=5, type="float", help="the amount of
 
 ### options about gracedb
 parser.add_option("-g", "--gracedb-url", default="https://gracedb.ligo.org/api/", type="string" )
+parser.add_option("", "--max-in-flight", default=0, type="int", help="perform up to this many actions at once in background threads so that a slow upload does not delay later actions. \
+Actions for the same event still happen in order. DEFAULT=0 performs actions one at a time")
 
 ### options about simulation
 parser.add_option("",   "--distrib",    default="uniform", type="string", help="the distribution of events in time. Either \"poisson\" or \"uniform\"")
@@ -180,6 +184,15 @@ waiting ~%.3f seconds to ensure everything is sequenced correctly
 """%opts.pause
 time.sleep( opts.pause )
 
+def reportFailure(future):
+    if future.exception()!=None:
+        future.print_exception()
+
+if opts.max_in_flight > 0:
+    executor = asyncdb.Executor(maxWorkers=opts.max_in_flight)
+else:
+    executor = None
+
 if opts.verbose:
     print "iterating through schedule"
 for action in sched: ### iterate through actions in schedule
@@ -189,9 +202,17 @@ for action in sched: ### iterate through actions in schedule
         print "  ", action
 
     if execute:
+        if executor!=None: ### we cannot stop to ask about failures, so we just report them
+            action.execute_async(executor).add_done_callback(reportFailure)
+            continue
+
         try:
             action.execute() ### actually perform the action
         except Exception:
             traceback.print_exc()
             if raw_input("continue? (yes/no) : ")!="yes":
                 raise KeyboardInterrupt 
+
+if executor!=None:
+    executor.shutdown(wait=True) ### wait for the actions that are still in flight
+schedule.closeGraceDb() ### release the clients shared by all actions
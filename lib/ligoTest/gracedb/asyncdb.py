@@ -0,0 +1,278 @@
+description = "a bounded thread pool and an asynchronous facade for FakeDb (or GraceDb) so that many uploads can be in flight at once"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import sys
+import threading
+import traceback
+
+import Queue
+
+#-------------------------------------------------
+
+class Future(object):
+    '''
+    the result of a call that is running in an Executor. Like concurrent.futures.Future (which we do not have in Python 2)
+        result(timeout)          : blocks until the call finishes and returns its result (or raises its exception)
+        exception(timeout)       : blocks until the call finishes and returns its exception (or None)
+        add_done_callback(foo)   : foo(future) is called once the call finishes, in whichever thread finishes it
+    '''
+
+    def __init__(self):
+        self.__condition__ = threading.Condition()
+        self.__done__ = False
+        self.__result__ = None
+        self.__excInfo__ = None
+        self.__callbacks__ = []
+
+    def done(self):
+        return self.__done__
+
+    def __finish__(self, result, excInfo):
+        with self.__condition__:
+            if self.__done__:
+                raise RuntimeError('this Future has already finished')
+            self.__result__ = result
+            self.__excInfo__ = excInfo
+            self.__done__ = True
+            callbacks = self.__callbacks__
+            self.__callbacks__ = []
+            self.__condition__.notify_all()
+
+        for foo in callbacks:
+            self.__callback__(foo)
+
+    def set_result(self, result):
+        self.__finish__(result, None)
+
+    def set_exception(self, exception, tb=None):
+        self.__finish__(None, (type(exception), exception, tb))
+
+    def __wait__(self, timeout):
+        with self.__condition__:
+            if not self.__done__:
+                self.__condition__.wait(timeout)
+            if not self.__done__:
+                raise RuntimeError('timed out after %.3f sec'%timeout)
+
+    def result(self, timeout=None):
+        self.__wait__(timeout)
+        if self.__excInfo__!=None:
+            raise self.__excInfo__[0], self.__excInfo__[1], self.__excInfo__[2]
+        return self.__result__
+
+    def exception(self, timeout=None):
+        self.__wait__(timeout)
+        if self.__excInfo__!=None:
+            return self.__excInfo__[1]
+        return None
+
+    def print_exception(self, file=None):
+        '''
+        print the traceback of the call that failed, if it did
+        '''
+        if self.__excInfo__!=None:
+            traceback.print_exception(*self.__excInfo__, file=file)
+
+    def add_done_callback(self, foo):
+        with self.__condition__:
+            if not self.__done__:
+                self.__callbacks__.append(foo)
+                return
+        self.__callback__(foo)
+
+    def __callback__(self, foo):
+        try:
+            foo(self)
+        except Exception: ### a broken callback should not take down whoever finished this Future
+            traceback.print_exc()
+
+class Executor(object):
+    '''
+    runs calls in a fixed number of worker threads (maxWorkers).
+    At most maxPending calls may be waiting or running at once. submit() and reserve() block until there is room,
+    which keeps a fast producer (eg: a Schedule) from queueing an unbounded amount of work
+
+    submit(foo, *args, **kwargs) returns a Future for foo(*args, **kwargs).
+    reserve() claims a slot and returns a Future without starting anything, so a call can be started later with start()
+    (eg: once a call it depends on has finished) without blocking whoever starts it
+    '''
+
+    def __init__(self, maxWorkers=4, maxPending=None):
+        if maxWorkers < 1:
+            raise ValueError('maxWorkers must be at least 1')
+        self.maxWorkers = maxWorkers
+        self.maxPending = maxPending if maxPending!=None else 4*maxWorkers
+
+        self.__pending__ = threading.Semaphore(self.maxPending)
+        self.__queue__ = Queue.Queue()
+        self.__shutdown__ = False
+
+        self.__workers__ = []
+        for i in xrange(maxWorkers):
+            worker = threading.Thread(target=self.__work__, name='Executor-%d'%i)
+            worker.daemon = True
+            worker.start()
+            self.__workers__.append(worker)
+
+    def __work__(self):
+        while True:
+            item = self.__queue__.get()
+            if item==None: ### shutdown
+                break
+            future, foo, args, kwargs = item
+            try:
+                result = foo(*args, **kwargs)
+            except BaseException as e:
+                self.__pending__.release()
+                future.set_exception(e, sys.exc_info()[2])
+            else:
+                self.__pending__.release()
+                future.set_result(result)
+
+    def reserve(self):
+        if self.__shutdown__:
+            raise RuntimeError('cannot schedule new calls after shutdown')
+        self.__pending__.acquire()
+        return Future()
+
+    def start(self, future, foo, *args, **kwargs):
+        '''
+        start a call in the slot held by future (see reserve)
+        '''
+        self.__queue__.put( (future, foo, args, kwargs) )
+
+    def submit(self, foo, *args, **kwargs):
+        future = self.reserve()
+        self.start(future, foo, *args, **kwargs)
+        return future
+
+    def shutdown(self, wait=True):
+        '''
+        stop accepting calls. Calls that were already submitted (or reserved) still run. If wait, we block until they have
+        '''
+        self.__shutdown__ = True
+        if wait: ### claim every slot, so that reserved calls have been started and finished before the workers stop
+            for i in xrange(self.maxPending):
+                self.__pending__.acquire()
+            for i in xrange(self.maxPending):
+                self.__pending__.release()
+
+        for worker in self.__workers__:
+            self.__queue__.put(None)
+        if wait:
+            for worker in self.__workers__:
+                worker.join()
+
+#-------------------------------------------------
+
+class AsyncFakeDb(object):
+    '''
+    an asynchronous facade around a FakeDb (or anything with GraceDb's interface, eg: schedule.initGraceDb(url)).
+    Every method has the same signature as the client's but returns a Future immediately and runs the call (along with
+    any file copies and pickle I/O it does) in a bounded Executor, eg:
+
+        adb = AsyncFakeDb(FakeDb(directory), maxWorkers=8)
+        futures = [adb.writeLog(graceid, 'message %d'%i, filename=filename) for i in xrange(100)]
+        responses = [future.result() for future in futures]
+
+    Calls are not ordered with respect to each other. Wait for a Future before making calls that depend on it
+    (eg: the graceid returned by createEvent)
+    '''
+    def __init__(self, client, maxWorkers=4, maxPending=None, executor=None):
+        self.client = client
+        if executor==None:
+            executor = Executor(maxWorkers=maxWorkers, maxPending=maxPending)
+            self.__ownExecutor__ = True
+        else:
+            self.__ownExecutor__ = False
+        self.executor = executor
+
+    ### annotation ###
+
+    def createEvent(self, group, pipeline, filename, search=None, offline=False, filecontents=None, **kwargs):
+        return self.executor.submit(self.client.createEvent, group, pipeline, filename, search=search, offline=offline, filecontents=filecontents, **kwargs)
+
+    def writeLog(self, graceid, message, filename=None, filecontents=None, tagname=[], displayName=None):
+        return self.executor.submit(self.client.writeLog, graceid, message, filename=filename, filecontents=filecontents, tagname=tagname, displayName=displayName)
+
+    def writeFile(self, graceid, filename, filecontents=None):
+        return self.executor.submit(self.client.writeFile, graceid, filename, filecontents=filecontents)
+
+    def writeLabel(self, graceid, label):
+        return self.executor.submit(self.client.writeLabel, graceid, label)
+
+    def removeLabel(self, graceid, label):
+        return self.executor.submit(self.client.removeLabel, graceid, label)
+
+    def writeSignoff(self, graceid, instrument, signoff_type, status):
+        return self.executor.submit(self.client.writeSignoff, graceid, instrument, signoff_type, status)
+
+    def updateSignoff(self, graceid, instrument, signoff_type, status):
+        return self.executor.submit(self.client.updateSignoff, graceid, instrument, signoff_type, status)
+
+    def createTag(self, graceid, n, tagname, displayName=None):
+        return self.executor.submit(self.client.createTag, graceid, n, tagname, displayName=displayName)
+
+    def deleteTag(self, graceid, n, tagname):
+        return self.executor.submit(self.client.deleteTag, graceid, n, tagname)
+
+    def createVOEvent(self, graceid, voevent_type, **kwargs):
+        return self.executor.submit(self.client.createVOEvent, graceid, voevent_type, **kwargs)
+
+    def writeEel(self, graceid, group, waveband, eel_status, obs_status, **kwargs):
+        return self.executor.submit(self.client.writeEel, graceid, group, waveband, eel_status, obs_status, **kwargs)
+
+    def writeEMObservation(self, graceid, group, raList, raWidthList, decList, decWidthList, startTimeList, durationList, comment=None):
+        return self.executor.submit(self.client.writeEMObservation, graceid, group, raList, raWidthList, decList, decWidthList, startTimeList, durationList, comment=comment)
+
+    ### queries ###
+
+    def event(self, graceid):
+        return self.executor.submit(self.client.event, graceid)
+
+    def events(self, query=None, orderby=None, count=None, columns=None):
+        '''
+        returns a Future for a list of events (rather than a generator)
+        '''
+        return self.executor.submit(lambda: list(self.client.events(query=query, orderby=orderby, count=count, columns=columns)))
+
+    def numEvents(self, query=None):
+        return self.executor.submit(self.client.numEvents, query=query)
+
+    def logs(self, graceid, start=0, count=None):
+        if start or (count!=None): ### GraceDb.logs does not know about pages
+            return self.executor.submit(self.client.logs, graceid, start=start, count=count)
+        return self.executor.submit(self.client.logs, graceid)
+
+    def logs_since(self, graceid, n):
+        return self.executor.submit(self.client.logs_since, graceid, n)
+
+    def tags(self, graceid, n):
+        return self.executor.submit(self.client.tags, graceid, n)
+
+    def labels(self, graceid, label=''):
+        return self.executor.submit(self.client.labels, graceid, label=label)
+
+    def files(self, graceid, filename=None, raw=False):
+        return self.executor.submit(self.client.files, graceid, filename=filename, raw=raw)
+
+    def signoffs(self, graceid, signoff_type='', instrument=''):
+        return self.executor.submit(self.client.signoffs, graceid, signoff_type=signoff_type, instrument=instrument)
+
+    def voevents(self, graceid):
+        return self.executor.submit(self.client.voevents, graceid)
+
+    def eels(self, graceid):
+        return self.executor.submit(self.client.eels, graceid)
+
+    def emobservations(self, graceid):
+        return self.executor.submit(self.client.emobservations, graceid)
+
+    def close(self, wait=True):
+        '''
+        wait for outstanding calls (if wait) and stop our Executor if we made it. Does not close the client
+        '''
+        if self.__ownExecutor__:
+            self.executor.shutdown(wait=wait)
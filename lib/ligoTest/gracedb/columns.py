@@ -0,0 +1,229 @@
+description = "a columnar, in-memory table of top-level event attributes used to answer FakeDb queries with vectorized masks"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import numpy as np
+
+from ligoTest.gracedb import query as gdbquery
+
+#-------------------------------------------------
+
+class EventTable(object):
+    '''
+    top-level attributes of many events held in a single NumPy structured array (one row per event)
+        gpstime, far, created             : float64 (NaN if not known)
+        group, pipeline, search, submitter : int16 codes (see self.codes, -1 if not known)
+        instruments                        : uint32 bitmask (see self.instruments)
+        labels                             : uint64 bitmask (see self.labels)
+
+    rows are added with add() and labels with label(), so the table can be updated incrementally as events are written.
+    Masks are boolean arrays over self.data, eg:
+        mask = (table['far'] < 1e-7) & table.hasLabel('EM_READY') & table.equals('pipeline', ['gstlal'])
+        table.graceids(mask)
+    '''
+    __codedKeys__ = ['group', 'pipeline', 'search', 'submitter']
+    __floatKeys__ = ['gpstime', 'far', 'created']
+
+    __dtype__ = [('graceid', 'S16'),
+                 ('gpstime', 'f8'),
+                 ('far', 'f8'),
+                 ('created', 'f8'),
+                 ('group', 'i2'),
+                 ('pipeline', 'i2'),
+                 ('search', 'i2'),
+                 ('submitter', 'i2'),
+                 ('instruments', 'u4'),
+                 ('labels', 'u8'),
+                ]
+
+    __maxInstruments__ = 32
+    __maxLabels__ = 64
+
+    def __init__(self, capacity=1024):
+        self.__data__ = np.empty(capacity, dtype=self.__dtype__)
+        self.size = 0
+        self.rows = dict() ### graceid -> row
+
+        self.codes = dict((key, dict()) for key in self.__codedKeys__) ### key -> {value.lower() : code}
+        self.instruments = dict() ### instrument -> bit
+        self.labels = dict() ### label -> bit
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def data(self):
+        '''
+        a view of the rows that are filled
+        '''
+        return self.__data__[:self.size]
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    ### encoding ###
+
+    def __code__(self, key, value, create=False):
+        if value==None:
+            return -1
+        codes = self.codes[key]
+        value = value.lower()
+        if not codes.has_key(value):
+            if not create:
+                return -2 ### a code no row has
+            codes[value] = len(codes)
+        return codes[value]
+
+    def __bit__(self, bits, name, maximum, create=False):
+        if not bits.has_key(name):
+            if not create:
+                return None
+            if len(bits)==maximum:
+                raise ValueError('EventTable can only track %d distinct values (could not add %s)'%(maximum, name))
+            bits[name] = len(bits)
+        return bits[name]
+
+    def __instrumentMask__(self, instruments, create=False):
+        mask = 0
+        for instrument in instruments:
+            bit = self.__bit__(self.instruments, instrument, self.__maxInstruments__, create=create)
+            if bit==None:
+                return None
+            mask |= 1<<bit
+        return mask
+
+    ### incremental updates ###
+
+    def add(self, topLevel, labels=[]):
+        '''
+        add a row for an event described by its top-level attributes (the dictionary written by FakeDb.createEvent)
+        '''
+        graceid = topLevel['graceid']
+        if self.rows.has_key(graceid):
+            row = self.rows[graceid]
+        else:
+            if self.size==len(self.__data__): ### grow geometrically so that adding events stays cheap
+                self.__data__ = np.resize(self.__data__, 2*len(self.__data__))
+            row = self.size
+            self.size += 1
+            self.rows[graceid] = row
+
+        entry = self.__data__[row]
+        entry['graceid'] = graceid
+        for key in self.__floatKeys__:
+            value = topLevel.get(key)
+            entry[key] = value if value!=None else np.nan
+        for key in self.__codedKeys__:
+            entry[key] = self.__code__(key, topLevel.get(key), create=True)
+
+        instruments = topLevel.get('instruments') or ''
+        entry['instruments'] = self.__instrumentMask__([instrument.strip() for instrument in instruments.split(',') if instrument.strip()], create=True)
+
+        entry['labels'] = 0
+        for label in labels:
+            self.label(graceid, label)
+
+    def label(self, graceid, label):
+        '''
+        record that label was applied to graceid
+        '''
+        bit = self.__bit__(self.labels, label, self.__maxLabels__, create=True)
+        self.__data__['labels'][self.rows[graceid]] |= np.uint64(1<<bit)
+
+    def unlabel(self, graceid, label):
+        '''
+        record that label was removed from graceid
+        '''
+        bit = self.__bit__(self.labels, label, self.__maxLabels__)
+        if (bit!=None) and self.rows.has_key(graceid):
+            self.__data__['labels'][self.rows[graceid]] &= ~np.uint64(1<<bit)
+
+    ### masks ###
+
+    def graceids(self, mask=None):
+        if mask is None: ### mask==None would compare elementwise
+            return [str(graceid) for graceid in self.data['graceid']]
+        return [str(graceid) for graceid in self.data['graceid'][mask]]
+
+    def all(self):
+        return np.ones(self.size, dtype=bool)
+
+    def none(self):
+        return np.zeros(self.size, dtype=bool)
+
+    def hasLabel(self, label):
+        bit = self.__bit__(self.labels, label, self.__maxLabels__)
+        if bit==None:
+            return self.none()
+        return (self.data['labels'] & np.uint64(1<<bit)) > 0
+
+    def hasInstruments(self, instruments):
+        '''
+        events that involve every one of instruments
+        '''
+        mask = self.__instrumentMask__(instruments)
+        if mask==None:
+            return self.none()
+        return (self.data['instruments'] & np.uint32(mask)) == mask
+
+    def equals(self, key, values):
+        '''
+        events whose coded attribute (group, pipeline, search, submitter) is one of values, ignoring case
+        '''
+        return np.in1d(self.data[key], [self.__code__(key, value) for value in values])
+
+    def between(self, key, low=None, high=None, lowStrict=False, highStrict=False):
+        column = self.data[key]
+        mask = ~np.isnan(column)
+        if low!=None:
+            mask &= (column > low) if lowStrict else (column >= low)
+        if high!=None:
+            mask &= (column < high) if highStrict else (column <= high)
+        return mask
+
+    def mask(self, node):
+        '''
+        evaluate a node from a compiled query (see ligoTest.gracedb.query) as a vectorized mask
+        '''
+        if isinstance(node, gdbquery.AllNode):
+            return self.all()
+
+        elif isinstance(node, gdbquery.AndNode):
+            mask = self.all()
+            for child in node.children:
+                mask &= self.mask(child)
+            return mask
+
+        elif isinstance(node, gdbquery.OrNode):
+            mask = self.none()
+            for child in node.children:
+                mask |= self.mask(child)
+            return mask
+
+        elif isinstance(node, gdbquery.NotNode):
+            return ~self.mask(node.child)
+
+        elif isinstance(node, gdbquery.LabelNode):
+            return self.hasLabel(node.label)
+
+        elif isinstance(node, gdbquery.GraceIDNode):
+            return self.data['graceid'] == node.graceid
+
+        elif isinstance(node, gdbquery.RangeNode):
+            return self.between(node.key, low=node.low, high=node.high, lowStrict=node.lowStrict, highStrict=node.highStrict)
+
+        elif isinstance(node, gdbquery.EqualsNode):
+            return self.equals(node.key, node.values)
+
+        elif isinstance(node, gdbquery.InstrumentsNode):
+            return self.hasInstruments(node.instruments)
+
+        else:
+            raise ValueError('do not know how to evaluate %s as a mask'%type(node).__name__)
+
+    def select(self, plan):
+        '''
+        the sorted graceids that satisfy a compiled query (ligoTest.gracedb.query.Plan)
+        '''
+        return sorted(self.graceids(self.mask(plan.root)))
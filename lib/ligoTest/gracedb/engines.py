@@ -0,0 +1,2073 @@
+description = "storage engines that hold the events managed by FakeDb"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import shutil
+import urllib
+import fcntl
+import tempfile
+
+import cPickle as pickle
+import json
+import struct
+import copy
+import hashlib
+
+import bisect
+
+import sqlite3
+
+import threading
+import Queue
+
+from contextlib import contextmanager
+
+import numpy as np
+
+from ligoTest.lvalert import lvalertTestUtils as lvutils
+from ligoTest.gracedb import footprints as fp
+
+#-------------------------------------------------
+
+def initEngine(url, layout=None):
+    '''
+    a method that decides which storage engine backs a FakeDb based on the url
+        sqlite:///path/to/db -> SQLiteEngine
+        mem://name, :memory: -> MemoryEngine
+        anything else        -> DirectoryEngine (url is a path)
+    layout is only used by DirectoryEngine (see DirectoryEngine.__layouts__)
+    '''
+    if url.startswith(SQLiteEngine.scheme):
+        return SQLiteEngine(url)
+    elif url.startswith(MemoryEngine.scheme) or (url==MemoryEngine.anonymous):
+        return MemoryEngine(url)
+    else:
+        return DirectoryEngine(url, layout=layout) ### expects url to be a path
+
+def tagnames(tagname):
+    '''
+    GraceDb accepts a single tagname or a list of them, and schedule.WriteLog passes None for untagged logs.
+    Logs store whatever they were given as tag_names, so anything that reads tag_names back should go through this
+    '''
+    if not tagname:
+        return []
+    if isinstance(tagname, basestring):
+        return [tagname]
+    return list(tagname)
+
+#-------------------------------------------------
+
+def fileDigest(filename, chunkSize=1048576):
+    '''
+    the sha256 hexdigest of filename's contents
+    '''
+    sha = hashlib.sha256()
+    file_obj = open(filename, 'rb')
+    try:
+        chunk = file_obj.read(chunkSize)
+        while chunk:
+            sha.update(chunk)
+            chunk = file_obj.read(chunkSize)
+    finally:
+        file_obj.close()
+    return sha.hexdigest()
+
+attachModes = ['copy', 'hardlink', 'reflink', 'symlink', 'dedup']
+
+__FICLONE__ = 0x40049409 ### linux ioctl that shares extents between two files on btrfs, xfs, etc
+
+def __reflink__(source, target):
+    '''
+    a copy-on-write clone of source. Raises IOError if the filesystem does not support it
+    '''
+    src = os.open(source, os.O_RDONLY)
+    try:
+        dst = os.open(target, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0644)
+        try:
+            fcntl.ioctl(dst, __FICLONE__, src)
+        except:
+            os.close(dst)
+            os.remove(target)
+            raise
+        os.close(dst)
+    finally:
+        os.close(src)
+
+def attachFile(source, target, mode='copy'):
+    '''
+    put the contents of source at target according to mode
+        copy     -> a full copy (shutil.copyfile)
+        hardlink -> another name for the same inode (source and target must share a filesystem)
+        reflink  -> a copy-on-write clone where the filesystem supports it
+        symlink  -> a link to the absolute path of source
+    If mode is not supported for these paths, we fall back to copy.
+    NOTE: with hardlink and symlink, modifying source later also modifies the attachment
+    dedup is handled by StorageEngine through a BlobStore and is not understood here
+    '''
+    if (mode not in attachModes) or (mode=='dedup'):
+        raise ValueError('attachMode=%s not understood. Must be one of : %s'%(mode, ', '.join(attachModes)))
+
+    ### we build the attachment under a temporary name and rename it into place. This replaces an existing target without
+    ### writing through it (it may be a link into someone else's file) and concurrent uploads of the same name cannot collide
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)), prefix='.'+os.path.basename(target)+'-')
+    os.close(fd)
+    try:
+        linked = False
+        if mode!='copy':
+            os.remove(tmp) ### links and clones must create tmp themselves
+            try:
+                if mode=='hardlink':
+                    os.link(source, tmp)
+                elif mode=='reflink':
+                    __reflink__(source, tmp)
+                elif mode=='symlink':
+                    os.symlink(os.path.abspath(source), tmp)
+                linked = True
+            except (OSError, IOError):
+                pass ### eg: cross-device links, unsupported filesystems
+
+        if not linked:
+            shutil.copyfile(source, tmp)
+            os.chmod(tmp, 0644) ### mkstemp only gives the owner access
+
+        os.rename(tmp, target)
+    finally:
+        if os.path.lexists(tmp): ### we failed, or tmp and target were already the same file (rename does nothing then)
+            os.remove(tmp)
+
+    return target
+
+def writeAttachment(data, target):
+    '''
+    write data (a string) at target. A new target is written in place, since nobody knows about it until its caller records it.
+    An existing target is replaced like attachFile does, by writing a temporary file and renaming it into place
+    '''
+    try:
+        fd = os.open(target, os.O_WRONLY|os.O_CREAT|os.O_EXCL, 0644)
+    except OSError:
+        fd = None
+
+    if fd!=None:
+        file_obj = os.fdopen(fd, 'wb')
+        file_obj.write(data)
+        file_obj.close()
+        return target
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(target)), prefix='.'+os.path.basename(target)+'-')
+    try:
+        file_obj = os.fdopen(fd, 'wb')
+        file_obj.write(data)
+        file_obj.close()
+        os.chmod(tmp, 0644) ### mkstemp only gives the owner access
+        os.rename(tmp, target)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return target
+
+class BlobStore(object):
+    '''
+    a content-addressed store of uploaded files, keyed by sha256
+
+        root/
+            .lock
+            ab/
+                abcdef...  (the full hexdigest)
+
+    events reference a blob through a hardlink named after the original basename, so files() is unchanged
+    and the number of references to a blob is simply st_nlink-1. gc() removes blobs nobody references anymore.
+    put() holds a shared lock and gc() an exclusive one so we never remove a blob while it is being linked
+    '''
+    def __init__(self, root):
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root)
+
+    def path(self, digest):
+        return os.path.join(self.root, digest[:2], digest)
+
+    @contextmanager
+    def __lock__(self, exclusive=False):
+        file_obj = open(os.path.join(self.root, '.lock'), 'a')
+        try:
+            fcntl.flock(file_obj, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+        finally:
+            file_obj.close() ### releases the lock
+
+    def digest(self, filename):
+        return fileDigest(filename)
+
+    def put(self, source, target):
+        '''
+        make target reference the blob holding source's contents, storing that blob if we have not seen it before
+        '''
+        digest = self.digest(source)
+        blob = self.path(digest)
+        with self.__lock__():
+            if not os.path.exists(blob): ### copy into a temporary file first so other processes never see a partial blob
+                directory = os.path.dirname(blob)
+                if not os.path.exists(directory):
+                    try:
+                        os.makedirs(directory)
+                    except OSError: ### someone else made it first
+                        pass
+                fd, tmp = tempfile.mkstemp(dir=directory)
+                os.close(fd)
+                shutil.copyfile(source, tmp)
+                os.chmod(tmp, 0644)
+                os.rename(tmp, blob) ### identical contents, so it does not matter who wins a race
+
+            if os.path.lexists(target):
+                os.remove(target)
+            try:
+                os.link(blob, target)
+            except OSError: ### filesystem without hardlinks
+                shutil.copyfile(blob, target)
+        return target
+
+    def refcount(self, digest):
+        '''
+        the number of attachments that reference this blob
+        '''
+        try:
+            return os.stat(self.path(digest)).st_nlink - 1
+        except OSError:
+            return 0
+
+    def gc(self):
+        '''
+        remove blobs that are no longer referenced (eg: after an event directory was deleted) and return their digests
+        '''
+        removed = []
+        with self.__lock__(exclusive=True):
+            for directory in os.listdir(self.root):
+                directory = os.path.join(self.root, directory)
+                if not os.path.isdir(directory):
+                    continue
+                for digest in os.listdir(directory):
+                    path = os.path.join(directory, digest)
+                    if os.stat(path).st_nlink==1:
+                        os.remove(path)
+                        removed.append(digest)
+        return removed
+
+#-------------------------------------------------
+
+class StorageEngine(object):
+    '''
+    the interface FakeDb uses to store and query events.
+
+    Each event stores a few kinds of data, referenced by name
+        documents : 'toplevel', 'signoffs'                  (read and overwritten as a whole)
+        records   : 'logs', 'labels', 'files', 'voevents',
+                    'emobservations', 'eels',
+                    'signoffhistory'                        (lists that only ever grow)
+    along with the sky footprints of its EM observations, which are stored as NumPy arrays (see appendFootprints)
+
+    Children must overwrite all of these methods.
+    '''
+    __documentKinds__ = ['toplevel', 'signoffs']
+    __recordKinds__ = ['logs', 'labels', 'files', 'voevents', 'emobservations', 'eels', 'signoffhistory']
+
+    def __init__(self, url):
+        self.url = url
+        self.lvalert = None ### file into which FakeDb writes lvalert messages
+        self.lvalertWriter = None ### opened on the first message
+        self.lvalertPolicy = dict() ### kwargs for lvutils.LVAlertWriter, set through FakeDb
+        self.attachMode = 'copy' ### how attach stores uploaded files, one of attachModes
+        self.__blobs__ = None ### BlobStore used when attachMode=='dedup', made on first use
+
+    def link(self, graceid=None, kind=None):
+        '''
+        a string that identifies where something is stored. Used to fill in 'self' and 'links' in FakeDb's responses
+        '''
+        raise NotImplementedError
+
+    def get(self, url):
+        '''
+        the data referenced by a string returned from self.link
+        '''
+        raise NotImplementedError
+
+    def sendlvalert(self, line):
+        '''
+        record a single (formatted) lvalert message
+        '''
+        if self.lvalertWriter==None:
+            self.lvalertWriter = lvutils.LVAlertWriter(self.lvalert, **self.lvalertPolicy)
+        self.lvalertWriter.write(line)
+
+    def flush(self):
+        '''
+        write any buffered lvalert messages
+        '''
+        if self.lvalertWriter!=None:
+            self.lvalertWriter.flush()
+
+    def close(self):
+        if self.lvalertWriter!=None:
+            self.lvalertWriter.close()
+            self.lvalertWriter = None
+
+    ### events ###
+
+    def exists(self, graceid):
+        raise NotImplementedError
+
+    def stamp(self, graceid):
+        '''
+        something that changes whenever graceid is (re)created, used by FakeDb to validate cached metadata.
+        Returns None if graceid does not exist
+        '''
+        raise NotImplementedError
+
+    def graceids(self):
+        raise NotImplementedError
+
+    def genGraceID(self, letter):
+        '''
+        allocate a new graceid starting with letter. Must never hand out the same graceid twice
+        '''
+        raise NotImplementedError
+
+    def create(self, graceid):
+        '''
+        set up empty storage for graceid. Raises ValueError if graceid already exists
+        '''
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(self, graceid):
+        '''
+        hold an exclusive lock on graceid so that read-modify-write sequences (eg: signoffs, numbering logs) are atomic.
+        Children's write and append take this lock themselves, so it must be reentrant within a thread
+        '''
+        raise NotImplementedError
+        yield
+
+    ### reading and writing data ###
+
+    def read(self, graceid, kind):
+        raise NotImplementedError
+
+    def write(self, graceid, kind, stuff):
+        '''
+        overwrite a document
+        '''
+        raise NotImplementedError
+
+    def append(self, graceid, kind, stuff):
+        '''
+        append a record and return its index
+        '''
+        raise NotImplementedError
+
+    def removeLabel(self, graceid, label):
+        '''
+        remove every application of label from graceid's labels and from the label index. Returns False if there were none
+        '''
+        raise NotImplementedError
+
+    def readRange(self, graceid, kind, start=0, stop=None):
+        '''
+        records start through stop-1 (through the last record if stop is None), like self.read(graceid, kind)[start:stop].
+        Children should overwrite this so that records before start are never loaded
+        '''
+        return self.read(graceid, kind)[start:stop]
+
+    def count(self, graceid, kind):
+        '''
+        the number of records
+        '''
+        raise NotImplementedError
+
+    def filename(self, graceid, filename):
+        '''
+        where an uploaded file will be stored
+        '''
+        raise NotImplementedError
+
+    def attachData(self, graceid, filename, data):
+        '''
+        store data (a string) as graceid's file called filename and return the path it can be read from (see readAttachment)
+        '''
+        target = self.filename(graceid, filename)
+        directory = os.path.dirname(target)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return writeAttachment(data, target)
+
+    def readAttachment(self, path):
+        '''
+        the contents of a file returned by attach or attachData
+        '''
+        file_obj = open(path, 'rb')
+        data = file_obj.read()
+        file_obj.close()
+        return data
+
+    def attach(self, graceid, filename):
+        '''
+        store a copy of an uploaded file (according to self.attachMode) and return where it lives
+        '''
+        raise NotImplementedError
+
+    ### tags ###
+
+    def tags(self, graceid):
+        '''
+        the tag index for graceid : {tagname : sorted list of the numbers (N) of the logs that carry it}
+        '''
+        raise NotImplementedError
+
+    def addTag(self, graceid, N, tagname):
+        '''
+        record that log N of graceid carries tagname. Returns False if it already did
+        '''
+        raise NotImplementedError
+
+    def removeTag(self, graceid, N, tagname):
+        '''
+        record that log N of graceid no longer carries tagname. Returns False if it did not
+        '''
+        raise NotImplementedError
+
+    ### signoffs ###
+
+    def __signoffKey__(self, signoff):
+        return (signoff['signoff_type'], signoff['instrument'] or '') ### advocates sign off without an instrument
+
+    def __legacySignoffs__(self, document):
+        '''
+        events made before we keyed signoffs stored {'signoff' : [every signoff, in order], ...} in their signoffs document.
+        Returns that list, or None if document is already keyed
+        '''
+        if isinstance(document.get('signoff'), list):
+            return document['signoff']
+        return None
+
+    def signoffs(self, graceid):
+        '''
+        graceid's current signoffs : {(signoff_type, instrument) : signoff}, where instrument is '' for signoffs without one.
+        Every signoff ever written (including the ones later replaced) is kept in the 'signoffhistory' records
+        '''
+        document = self.read(graceid, 'signoffs')
+        legacy = self.__legacySignoffs__(document)
+        if legacy!=None: ### replay the old list so the latest signoff for each key wins
+            return dict((self.__signoffKey__(signoff), signoff) for signoff in legacy)
+        return document
+
+    def setSignoff(self, graceid, signoff):
+        '''
+        make signoff graceid's current signoff for its (signoff_type, instrument), replacing any it already had, and
+        append it to graceid's signoffhistory. Returns the signoff it replaced (or None)
+        '''
+        with self.lock(graceid):
+            document = self.read(graceid, 'signoffs')
+            legacy = self.__legacySignoffs__(document)
+            if legacy!=None: ### converted on the first write, so we move the old list into the history first
+                for old in legacy:
+                    self.append(graceid, 'signoffhistory', old)
+                document = dict((self.__signoffKey__(old), old) for old in legacy)
+
+            key = self.__signoffKey__(signoff)
+            previous = document.get(key)
+            document[key] = signoff
+            self.write(graceid, 'signoffs', document)
+            self.append(graceid, 'signoffhistory', signoff)
+
+        return previous
+
+    ### EM footprints ###
+
+    def appendFootprints(self, graceid, rows):
+        '''
+        store rows (a structured array with footprints.footprintDtype) after graceid's other footprints
+        '''
+        raise NotImplementedError
+
+    def footprints(self, graceid):
+        '''
+        every footprint stored for graceid (footprints.footprintDtype), in the order they were stored
+        '''
+        raise NotImplementedError
+
+    def allFootprints(self, start=None, stop=None):
+        '''
+        the footprints of every event (footprints.indexDtype). Children may leave out footprints that certainly were not
+        observed between start and stop (unix timestamps), but need not, so callers must still check
+        '''
+        raise NotImplementedError
+
+    def blobDirectory(self):
+        '''
+        where the BlobStore lives when attachMode=='dedup'
+        '''
+        raise NotImplementedError
+
+    def blobs(self):
+        if self.__blobs__==None:
+            self.__blobs__ = BlobStore(self.blobDirectory())
+        return self.__blobs__
+
+    def __attachFile__(self, source, target):
+        '''
+        used by children to put source at target according to self.attachMode
+        '''
+        if self.attachMode=='dedup':
+            return self.blobs().put(source, target)
+        else:
+            return attachFile(source, target, mode=self.attachMode)
+
+    ### indexes ###
+
+    def label2graceids(self, label):
+        '''
+        all graceids that have had this label applied
+        '''
+        raise NotImplementedError
+
+    def gps2graceids(self, gpsstart, gpsstop):
+        '''
+        all graceids with gpsstart <= gpstime <= gpsstop
+        '''
+        raise NotImplementedError
+
+    def graceid2gpstime(self, graceid):
+        raise NotImplementedError
+
+    def tag2graceids(self, tagname):
+        '''
+        all graceids that have had tagname applied to one of their logs. Like label2graceids, this may include
+        events whose tag was later removed, so check self.tags(graceid) when that matters
+        '''
+        raise NotImplementedError
+
+    def attribute2graceids(self, key, value):
+        '''
+        all graceids whose top-level attribute key (group, pipeline or search) equals value, ignoring case.
+        Returns None if we do not index key, in which case FakeDb checks each event itself
+        '''
+        return None
+
+#-------------------------------------------------
+
+class DirectoryEngine(StorageEngine):
+    '''
+    stores each event in its own directory of pickle files. This is the original FakeDb layout
+
+        service_url/
+            lvalert.out
+            graceid.counter
+            format.json (records the layout and format version, missing for older databases)
+            index/ (labels/, tags/, gpstimes and emfootprints.dat)
+            blobs/ (only with attachMode='dedup', see BlobStore)
+            G000000/
+                .lock
+                toplevel.pkl
+                signoffs.pkl ((signoff_type, instrument) -> current signoff)
+                logs.pkl (+ logs.pkl.idx)
+                tags.pkl (tagname -> log numbers)
+                labels.pkl (+ labels.pkl.idx)
+                files.pkl (+ files.pkl.idx)
+                voevents.pkl (+ voevents.pkl.idx)
+                emobservations.pkl (+ emobservations.pkl.idx)
+                eels.pkl (+ eels.pkl.idx)
+                signoffhistory.pkl (+ signoffhistory.pkl.idx)
+                emfootprints.dat (raw footprints.footprintDtype rows)
+                ...uploaded files...
+
+    Large databases can use a sharded layout instead, so no directory holds more than ~100 entries
+        service_url/
+            T/
+                00/
+                    01/
+                        T000123/
+                            ...
+    The layout is chosen when the database is created and recorded in format.json. Use relayout (or bin/migrate_FakeDb.py)
+    to convert an existing database
+
+    format.json also records the version of the on-disk format, which determines the pickle protocol we write
+        1 : protocol 0 (text). Databases without format.json or without a version
+        2 : pickle.HIGHEST_PROTOCOL (binary)
+    Use upgrade (or bin/migrate_FakeDb.py) to rewrite older databases in the current format
+    '''
+    __layouts__ = ['flat', 'sharded']
+
+    __formatVersion__ = 2
+    __version2protocol__ = {1 : 0,
+                            2 : pickle.HIGHEST_PROTOCOL,
+                           }
+
+    __kind2filename__ = {'toplevel' : 'toplevel.pkl',
+                         'signoffs' : 'signoffs.pkl',
+                         'logs'     : 'logs.pkl',
+                         'labels'   : 'labels.pkl',
+                         'files'    : 'files.pkl',
+                         'voevents' : 'voevents.pkl',
+                         'tags'     : 'tags.pkl',
+                         'emobservations' : 'emobservations.pkl',
+                         'eels'           : 'eels.pkl',
+                         'signoffhistory' : 'signoffhistory.pkl',
+                        }
+    __documentKinds__ = StorageEngine.__documentKinds__+['tags'] ### so relayout and upgrade rewrite the tag index too
+
+    __recordStruct__ = struct.Struct('>I') ### length prefix for each record in an append-only file
+    __offsetStruct__ = struct.Struct('>Q') ### byte offset of each record, stored in the sidecar
+
+    def __init__(self, directory='.', layout=None):
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        super(DirectoryEngine, self).__init__(directory)
+        self.service_url = directory
+        self.lvalert = os.path.join(directory, 'lvalert.out')
+
+        self.layout = 'flat' ### until we know better
+        self.format = self.__readFormat__()
+        if self.format==None:
+            if self.graceids(): ### made before we recorded the format
+                self.format = {'layout':'flat', 'version':1}
+            else: ### a new database
+                self.format = {'layout':layout or 'flat', 'version':self.__formatVersion__}
+                self.__writeFormat__()
+        self.format.setdefault('version', 1) ### recorded the layout before we versioned the format
+
+        if self.format['version'] > self.__formatVersion__:
+            raise ValueError('%s uses format version=%d, but we only understand up to version=%d'%(directory, self.format['version'], self.__formatVersion__))
+        self.__protocol__ = self.__version2protocol__[self.format['version']]
+
+        self.layout = self.format['layout']
+        if layout==None:
+            pass
+        elif layout not in self.__layouts__:
+            raise ValueError('layout=%s not understood. Must be one of : %s'%(layout, ', '.join(self.__layouts__)))
+        elif layout!=self.layout:
+            if self.graceids(): ### an existing database, which we will not silently reorganize
+                raise ValueError('%s uses layout=%s. Use bin/migrate_FakeDb.py to convert it to layout=%s'%(directory, self.layout, layout))
+            self.layout = layout
+            self.format['layout'] = layout
+            self.__writeFormat__()
+
+        ### in-memory view of the gpstime index, kept in sync with index/gpstimes by __refreshGpsIndex__
+        self.__gpsIndex__ = [] ### sorted list of (gpstime, graceid)
+        self.__graceid2gps__ = dict()
+        self.__gpsIndexOffset__ = 0 ### how much of index/gpstimes we have already read
+
+        self.__eventLocks__ = dict() ### graceid -> [threading.RLock, locked file object, depth, threads using it], see lock()
+        self.__eventLocksLock__ = threading.Lock()
+
+        if not os.path.exists(self.__indexDirectory__()): ### older databases do not have indexes, so we build them once
+            self.__buildIndex__()
+        elif not os.path.exists(self.__tagIndexDirectory__()): ### indexes made before we indexed tags
+            self.__buildTagIndex__()
+
+    ### format ###
+
+    def __formatPath__(self):
+        return os.path.join(self.service_url, 'format.json')
+
+    def __readFormat__(self):
+        path = self.__formatPath__()
+        if not os.path.exists(path):
+            return None
+
+        file_obj = open(path, 'r')
+        format = json.load(file_obj)
+        file_obj.close()
+        return format
+
+    def __writeFormat__(self):
+        fd, tmp = tempfile.mkstemp(dir=self.service_url, prefix='.format-')
+        file_obj = os.fdopen(fd, 'w')
+        json.dump(self.format, file_obj, indent=4, sort_keys=True)
+        file_obj.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, self.__formatPath__())
+
+    ### paths ###
+
+    def __flatDirectory__(self, graceid):
+        return os.path.join(self.service_url, graceid)
+
+    def __shardedDirectory__(self, graceid):
+        '''
+        T000123 -> T/00/01/T000123
+        '''
+        num = int(graceid[1:])
+        return os.path.join(self.service_url, graceid[0], '%02d'%(num/10000), '%02d'%((num/100)%100), graceid)
+
+    def __directory__(self, graceid):
+        '''
+        generates the directory associated with this graceid
+        '''
+        if self.layout=='flat':
+            return self.__flatDirectory__(graceid)
+
+        directory = self.__shardedDirectory__(graceid)
+        if not os.path.exists(directory): ### an event left behind by an interrupted relayout
+            flat = self.__flatDirectory__(graceid)
+            if os.path.exists(flat):
+                return flat
+        return directory
+
+    def __path__(self, graceid, kind):
+        return os.path.join(self.__directory__(graceid), self.__kind2filename__[kind])
+
+    def __lockPath__(self, graceid):
+        return os.path.join(self.__directory__(graceid), '.lock')
+
+    def link(self, graceid=None, kind=None):
+        if graceid==None:
+            return self.service_url
+        elif kind==None:
+            return self.__directory__(graceid)
+        else:
+            return self.__path__(graceid, kind)
+
+    def get(self, url):
+        return self.__extract__(url)
+
+    ### events ###
+
+    def __is_graceid__(self, name):
+        return (len(name)>1) and name[0].isupper() and name[1:].isdigit()
+
+    def exists(self, graceid):
+        return os.path.exists(self.__directory__(graceid))
+
+    def stamp(self, graceid):
+        try:
+            stat = os.stat(self.__directory__(graceid))
+        except OSError: ### does not exist
+            return None
+        return (stat.st_ino, stat.st_mtime)
+
+    def graceids(self):
+        graceids = []
+        for path in os.listdir(self.service_url):
+            path = os.path.basename(path)
+            if self.__is_graceid__(path):
+                graceids.append( path )
+
+            elif (self.layout=='sharded') and (len(path)==1) and path.isupper(): ### letter/shard/shard/graceid
+                letterDir = os.path.join(self.service_url, path)
+                for shard1 in sorted(os.listdir(letterDir)):
+                    shardDir = os.path.join(letterDir, shard1)
+                    for shard2 in sorted(os.listdir(shardDir)):
+                        graceids += [graceid for graceid in sorted(os.listdir(os.path.join(shardDir, shard2))) if self.__is_graceid__(graceid)]
+
+        return graceids
+
+    def __counterPath__(self):
+        '''
+        the file holding the next GraceID number to hand out
+        '''
+        return os.path.join(self.service_url, 'graceid.counter')
+
+    def genGraceID(self, letter):
+        '''
+        allocates the next GraceID from a counter stored within the directory.
+        The counter is held under an exclusive lock while we read and bump it, so several processes
+        sharing this directory never hand out the same GraceID.
+        if the counter does not exist, we rebuild it from the known GraceIDs within the directory
+        (the biggest one +1, or 000000 if none exist)
+        '''
+        fd = os.open(self.__counterPath__(), os.O_RDWR|os.O_CREAT, 0644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX) ### released when we close fd
+
+            data = os.read(fd, 64).strip()
+            if data:
+                ind = int(data)
+            else: ### missing or empty counter, so we fall back to the directory listing
+                existing = [int(graceid[1:]) for graceid in self.graceids()]
+                if existing:
+                    ind = max(existing)+1
+                else:
+                    ind = 0
+
+            while os.path.exists(self.__directory__("%s%06d"%(letter, ind))): ### events created without updating the counter
+                ind += 1
+
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, "%d\n"%(ind+1))
+
+        finally:
+            os.close(fd)
+
+        return "%s%06d"%(letter, ind)
+
+    def create(self, graceid):
+        '''
+        generate local data structure for this graceid
+        '''
+        if self.exists(graceid):
+            raise ValueError('graceid=%s already exists!'%graceid)
+
+        d = self.__directory__(graceid)
+        parent = os.path.dirname(d)
+        if not os.path.exists(parent): ### shards are made as needed
+            try:
+                os.makedirs(parent)
+            except OSError: ### someone else made it first
+                pass
+        try:
+            os.mkdir(d) ### make directory. This is atomic, so only one process can create graceid
+        except OSError:
+            raise ValueError('graceid=%s already exists!'%graceid)
+
+        with self.lock(graceid):
+            ### touch a bunch of files to make sure they exist
+            for kind in self.__recordKinds__:
+                self.__createRecords__(self.__path__(graceid, kind), [])
+            self.__write__(dict(), self.__path__(graceid, 'tags'))
+
+    @contextmanager
+    def lock(self, graceid):
+        '''
+        an advisory fcntl.flock on graceid/.lock, so only events that are actually being written wait on each other.
+        flock does not distinguish between threads, so we also hold a threading.RLock per graceid, which makes this reentrant
+        '''
+        with self.__eventLocksLock__:
+            entry = self.__eventLocks__.setdefault(graceid, [threading.RLock(), None, 0, 0])
+            entry[3] += 1 ### the number of threads holding or waiting for this entry
+
+        try:
+            with entry[0]:
+                if entry[2]==0:
+                    file_obj = open(self.__lockPath__(graceid), 'a')
+                    fcntl.flock(file_obj, fcntl.LOCK_EX)
+                    entry[1] = file_obj
+                entry[2] += 1
+                try:
+                    yield
+                finally:
+                    entry[2] -= 1
+                    if entry[2]==0:
+                        entry[1].close() ### releases the flock
+                        entry[1] = None
+        finally:
+            with self.__eventLocksLock__: ### forget about graceid once no thread holds or waits for its lock
+                entry[3] -= 1
+                if entry[3]==0:
+                    self.__eventLocks__.pop(graceid, None)
+
+    ### reading and writing data ###
+
+    def __isMissing__(self, path, kind):
+        '''
+        events created before we stored some kinds of records do not have their files, which we treat as empty
+        '''
+        return (kind in self.__recordKinds__) and (not os.path.exists(path))
+
+    def read(self, graceid, kind):
+        path = self.__path__(graceid, kind)
+        if self.__isMissing__(path, kind):
+            return []
+        return self.__extract__(path)
+
+    def write(self, graceid, kind, stuff):
+        with self.lock(graceid):
+            self.__write__(stuff, self.__path__(graceid, kind))
+
+            if kind=='toplevel':
+                self.__indexGpstime__( graceid, stuff['gpstime'] )
+
+    def append(self, graceid, kind, stuff):
+        with self.lock(graceid):
+            path = self.__path__(graceid, kind)
+            if self.__isMissing__(path, kind):
+                self.__createRecords__(path, [])
+            ind = self.__append__(stuff, path)
+
+            if kind=='labels':
+                self.__indexLabel__( graceid, stuff['name'] )
+
+        return ind
+
+    def removeLabel(self, graceid, label):
+        with self.lock(graceid):
+            path = self.__path__(graceid, 'labels')
+            if self.__isMissing__(path, 'labels'):
+                return False
+            labels = self.__extract__(path)
+            kept = [entry for entry in labels if entry['name']!=label]
+            if len(kept)==len(labels):
+                return False
+            self.__createRecords__(path, kept)
+            self.__unindexLabel__( graceid, label )
+        return True
+
+    def tags(self, graceid):
+        path = self.__path__(graceid, 'tags')
+        if os.path.exists(path):
+            return self.__extract__(path)
+
+        with self.lock(graceid): ### made before we indexed tags, so we build the index from the logs once
+            if os.path.exists(path):
+                return self.__extract__(path)
+            index = dict()
+            for log in self.read(graceid, 'logs'):
+                for tagname in tagnames(log['tag_names']):
+                    Ns = index.setdefault(tagname, [])
+                    if log['N'] not in Ns:
+                        Ns.append(log['N'])
+            self.__write__(index, path)
+            return index
+
+    def addTag(self, graceid, N, tagname):
+        with self.lock(graceid):
+            index = self.tags(graceid)
+            Ns = index.setdefault(tagname, [])
+            if N in Ns:
+                return False
+            bisect.insort(Ns, N)
+            self.__write__(index, self.__path__(graceid, 'tags'))
+            self.__indexTag__(graceid, tagname)
+        return True
+
+    def removeTag(self, graceid, N, tagname):
+        with self.lock(graceid):
+            index = self.tags(graceid)
+            Ns = index.get(tagname, [])
+            if N not in Ns:
+                return False
+            Ns.remove(N)
+            if not Ns:
+                index.pop(tagname)
+            self.__write__(index, self.__path__(graceid, 'tags'))
+        return True
+
+    def readRange(self, graceid, kind, start=0, stop=None):
+        path = self.__path__(graceid, kind)
+        if self.__isMissing__(path, kind):
+            return []
+        if self.__isRecordFile__(path):
+            return self.__readRecordRange__(path, start, stop)
+        return self.__extract__(path)[start:stop] ### old format, there is no sidecar to seek with
+
+    def count(self, graceid, kind):
+        path = self.__path__(graceid, kind)
+        if self.__isMissing__(path, kind):
+            return 0
+        return self.__path2len__(path)
+
+    def __footprintPath__(self, graceid):
+        return os.path.join(self.__directory__(graceid), 'emfootprints.dat')
+
+    def appendFootprints(self, graceid, rows):
+        rows = np.asarray(rows, dtype=fp.footprintDtype)
+        with self.lock(graceid):
+            self.__appendRows__(rows, self.__footprintPath__(graceid))
+            self.__indexFootprints__(graceid, rows)
+
+    def footprints(self, graceid):
+        return self.__readRows__(self.__footprintPath__(graceid), fp.footprintDtype)
+
+    def allFootprints(self, start=None, stop=None):
+        return self.__readRows__(self.__footprintIndexPath__(), fp.indexDtype)
+
+    def filename(self, graceid, filename):
+        return os.path.join(self.__directory__(graceid), os.path.basename(filename))
+
+    def attach(self, graceid, filename):
+        return self.__attachFile__(filename, self.filename(graceid, filename))
+
+    def blobDirectory(self):
+        return os.path.join(self.service_url, 'blobs')
+
+    ### converting between layouts ###
+
+    def __rewritePaths__(self, stuff, old, new):
+        '''
+        replace the prefix old with new in every path stored within stuff
+        '''
+        if isinstance(stuff, basestring):
+            if (stuff==old) or stuff.startswith(old+os.sep):
+                return new+stuff[len(old):]
+            return stuff
+        elif isinstance(stuff, dict):
+            return dict((key, self.__rewritePaths__(value, old, new)) for key, value in stuff.items())
+        elif isinstance(stuff, list):
+            return [self.__rewritePaths__(value, old, new) for value in stuff]
+        elif isinstance(stuff, tuple):
+            return tuple(self.__rewritePaths__(value, old, new) for value in stuff)
+        return stuff
+
+    def relayout(self, layout, verbose=False):
+        '''
+        move every event into layout and rewrite the paths stored within them.
+        No other process may write to this database while we do this. If we are interrupted, events stay readable
+        (see __directory__) and calling relayout again finishes the job
+        '''
+        if layout not in self.__layouts__:
+            raise ValueError('layout=%s not understood. Must be one of : %s'%(layout, ', '.join(self.__layouts__)))
+        if layout=='flat':
+            target = self.__flatDirectory__
+        else:
+            target = self.__shardedDirectory__
+
+        ### while we work, events live in both places. The sharded layout falls back to the flat one (and lists both),
+        ### so that is what we record until every event has moved. Only then do we settle on layout
+        self.layout = 'sharded'
+        self.format['layout'] = 'sharded'
+        self.format['relayout'] = layout ### the layout we are moving to, in case we are interrupted
+        self.__writeFormat__()
+
+        for graceid in self.graceids():
+            old = self.__directory__(graceid)
+            new = target(graceid)
+            if old==new:
+                continue
+            if verbose:
+                print "%s -> %s"%(old, new)
+
+            for kind in self.__documentKinds__+self.__recordKinds__:
+                path = self.__path__(graceid, kind)
+                if not os.path.exists(path):
+                    continue
+                stuff = self.__extract__(path)
+                rewritten = self.__rewritePaths__(stuff, old, new)
+                if rewritten!=stuff:
+                    if kind in self.__recordKinds__:
+                        self.__createRecords__(path, rewritten)
+                    else:
+                        self.__write__(rewritten, path)
+
+            parent = os.path.dirname(new)
+            if not os.path.exists(parent):
+                os.makedirs(parent)
+            os.rename(old, new)
+
+        self.layout = layout
+        self.format['layout'] = layout
+        self.format.pop('relayout')
+        self.__writeFormat__()
+
+        if layout=='flat': ### remove the (now empty) shards
+            for path in os.listdir(self.service_url):
+                if (len(path)==1) and path.isupper():
+                    for root, dirs, files in os.walk(os.path.join(self.service_url, path), topdown=False):
+                        if not files:
+                            os.rmdir(root)
+
+    def upgrade(self, verbose=False):
+        '''
+        rewrite every pickle file in the current format version and record that in format.json.
+        No other process may write to this database while we do this. Readers understand every version, so if we
+        are interrupted events stay readable and calling upgrade again finishes the job
+        '''
+        if self.format['version']==self.__formatVersion__:
+            return
+
+        self.__protocol__ = self.__version2protocol__[self.__formatVersion__]
+        for graceid in self.graceids():
+            if verbose:
+                print "%s : version=%d -> %d"%(graceid, self.format['version'], self.__formatVersion__)
+
+            for kind in self.__documentKinds__+self.__recordKinds__:
+                path = self.__path__(graceid, kind)
+                if not os.path.exists(path):
+                    continue
+                if kind in self.__recordKinds__:
+                    self.__createRecords__(path, self.__extract__(path))
+                else:
+                    self.__write__(self.__extract__(path), path)
+
+        self.format['version'] = self.__formatVersion__
+        self.__writeFormat__()
+
+    ### pickle files ###
+
+    def __indexPath__(self, path):
+        '''
+        the sidecar holding the byte-offset of each record within an append-only record file
+        '''
+        return path+'.idx'
+
+    def __isRecordFile__(self, path):
+        '''
+        lists (logs, labels, files, voevents) are stored as length-prefixed pickled records with an offset sidecar.
+        Older databases store a single pickled list without a sidecar, and we still read those.
+        '''
+        return os.path.exists(self.__indexPath__(path))
+
+    def __path2len__(self, path):
+        if self.__isRecordFile__(path): ### number of offsets stored in the sidecar
+            return os.path.getsize(self.__indexPath__(path))/self.__offsetStruct__.size
+        else:
+            return len(self.__extract__(path))
+
+    def __createRecords__(self, path, stuff=[]):
+        '''
+        create an append-only record file and its offset sidecar containing stuff.
+        Both are written to temporary files and renamed into place, so rewriting existing records never truncates them
+        '''
+        directory = os.path.dirname(path)
+        prefix = '.'+os.path.basename(path)+'-'
+
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix=prefix)
+        file_obj = os.fdopen(fd, 'wb')
+        offsets = []
+        for thing in stuff:
+            offsets.append( file_obj.tell() )
+            self.__writeRecord__(thing, file_obj)
+        file_obj.close()
+
+        fd, tmpIndex = tempfile.mkstemp(dir=directory, prefix=prefix)
+        file_obj = os.fdopen(fd, 'wb')
+        file_obj.write( ''.join(self.__offsetStruct__.pack(offset) for offset in offsets) )
+        file_obj.close()
+
+        for tmp, target in [(tmp, path), (tmpIndex, self.__indexPath__(path))]:
+            os.chmod(tmp, 0644) ### mkstemp only gives the owner access
+            os.rename(tmp, target)
+
+    def __writeRecord__(self, stuff, file_obj):
+        '''write a single length-prefixed record'''
+        payload = pickle.dumps(stuff, self.__protocol__)
+        file_obj.write( self.__recordStruct__.pack(len(payload)) + payload )
+
+    def __readRecords__(self, path):
+        '''
+        read all records from an append-only record file.
+        The sidecar is the source of truth, so we stop after the records it indexes and ignore any unindexed tail
+        '''
+        file_obj = open(path, 'rb')
+        data = file_obj.read()
+        file_obj.close()
+
+        ans = []
+        start = 0
+        N = len(data)
+        count = self.__path2len__(path)
+        while (len(ans) < count) and (start+self.__recordStruct__.size <= N):
+            size, = self.__recordStruct__.unpack_from(data, start)
+            start += self.__recordStruct__.size
+            if start+size > N: ### a truncated record (interrupted write), ignore it
+                break
+            ans.append( pickle.loads(data[start:start+size]) )
+            start += size
+
+        return ans
+
+    def __readRecordRange__(self, path, start, stop):
+        '''
+        read records start through stop-1 from an append-only record file.
+        We look up their byte-offsets in the sidecar and seek to each one, so earlier records are never read or unpickled
+        '''
+        size = self.__offsetStruct__.size
+        file_obj = open(self.__indexPath__(path), 'rb')
+        file_obj.seek(start*size)
+        if stop==None:
+            data = file_obj.read()
+        else:
+            data = file_obj.read(max(stop-start, 0)*size)
+        file_obj.close()
+        offsets = [self.__offsetStruct__.unpack_from(data, i*size)[0] for i in xrange(len(data)/size)]
+
+        ans = []
+        if not offsets:
+            return ans
+
+        file_obj = open(path, 'rb')
+        for offset in offsets:
+            file_obj.seek(offset)
+            header = file_obj.read(self.__recordStruct__.size)
+            if len(header) < self.__recordStruct__.size: ### a truncated record (interrupted write), ignore it
+                break
+            payload_size, = self.__recordStruct__.unpack(header)
+            payload = file_obj.read(payload_size)
+            if len(payload) < payload_size:
+                break
+            ans.append( pickle.loads(payload) )
+        file_obj.close()
+
+        return ans
+
+    def __indexedEnd__(self, path, count):
+        '''the byte-offset just past the last of the count records listed in the sidecar'''
+        if not count:
+            return 0
+        file_obj = open(self.__indexPath__(path), 'rb')
+        file_obj.seek((count-1)*self.__offsetStruct__.size)
+        offset, = self.__offsetStruct__.unpack(file_obj.read(self.__offsetStruct__.size))
+        file_obj.close()
+
+        file_obj = open(path, 'rb')
+        file_obj.seek(offset)
+        payload_size, = self.__recordStruct__.unpack(file_obj.read(self.__recordStruct__.size))
+        file_obj.close()
+        return offset + self.__recordStruct__.size + payload_size
+
+    def __append__(self, stuff, path):
+        '''
+        append a single record to the pkl file.
+        Only the new record and its offset are written, so this does not depend on how many records already exist.
+        The sidecar is the source of truth: anything an interrupted append left beyond its last offset is truncated first
+        '''
+        if not self.__isRecordFile__(path): ### old format, convert this once so future appends are cheap
+            self.__createRecords__(path, self.__extract__(path))
+
+        count = self.__path2len__(path)
+        offset = self.__indexedEnd__(path, count)
+        file_obj = open(path, 'r+b')
+        file_obj.truncate(offset)
+        file_obj.seek(offset)
+        self.__writeRecord__(stuff, file_obj)
+        file_obj.close()
+
+        file_obj = open(self.__indexPath__(path), 'r+b')
+        file_obj.truncate(count*self.__offsetStruct__.size) ### drop a partially written offset
+        file_obj.seek(count*self.__offsetStruct__.size)
+        file_obj.write( self.__offsetStruct__.pack(offset) )
+        file_obj.close()
+
+        return count
+
+    def __write__(self, stuff, path):
+        '''
+        write stuff into pkl file.
+        We write a temporary file and rename it into place so readers never see a partially written pickle
+        '''
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.'+os.path.basename(path)+'-')
+        file_obj = os.fdopen(fd, 'wb')
+        try:
+            pickle.dump(stuff, file_obj, self.__protocol__)
+        except:
+            file_obj.close()
+            os.remove(tmp)
+            raise
+        file_obj.close()
+        os.chmod(tmp, 0644) ### mkstemp only gives the owner access
+        os.rename(tmp, path)
+
+    def __extract__(self, path):
+        '''read from pkl file'''
+        if self.__isRecordFile__(path):
+            return self.__readRecords__(path)
+
+        file_obj = open(path, 'rb')
+        ans = pickle.load(file_obj)
+        file_obj.close()
+
+        return ans
+
+    ### NumPy files ###
+
+    def __appendRows__(self, rows, path):
+        '''
+        append the raw bytes of rows to path. We hold an flock on path while we write so that rows from different
+        processes are never interleaved
+        '''
+        file_obj = open(path, 'ab')
+        try:
+            fcntl.flock(file_obj, fcntl.LOCK_EX)
+            file_obj.write( rows.tostring() )
+        finally:
+            file_obj.close() ### releases the flock
+
+    def __readRows__(self, path, dtype):
+        '''
+        every complete row stored in path. A partially written row at the end (an interrupted append) is ignored
+        '''
+        if not os.path.exists(path):
+            return np.empty(0, dtype=dtype)
+        return np.fromfile(path, dtype=dtype, count=os.path.getsize(path)//dtype.itemsize)
+
+    ### secondary indexes used to answer queries without loading every event ###
+
+    def __indexDirectory__(self):
+        return os.path.join(self.service_url, 'index')
+
+    def __labelIndexPath__(self, label):
+        '''
+        a list of graceids (one per line) that have had this label applied
+        '''
+        return os.path.join(self.__indexDirectory__(), 'labels', label)
+
+    def __tagIndexDirectory__(self):
+        '''
+        one file per tag listing the graceids (one per line) that have had it applied to one of their logs
+        '''
+        return os.path.join(self.__indexDirectory__(), 'tags')
+
+    def __tagIndexPath__(self, tagname, directory=None):
+        '''
+        the file in directory (DEFAULT: the tag index) listing the graceids that have had tagname applied. Tag names are
+        chosen by clients, so we percent-encode them to keep separators and names like ".." from escaping directory
+        '''
+        name = urllib.quote(tagname, safe='')
+        if not name.strip('.'): ### "." and ".."
+            name = name.replace('.', '%2E')
+        return os.path.join(directory or self.__tagIndexDirectory__(), name)
+
+    def __gpsIndexPath__(self):
+        '''
+        a list of "gpstime graceid" (one per line) in the order events were created
+        '''
+        return os.path.join(self.__indexDirectory__(), 'gpstimes')
+
+    def __footprintIndexPath__(self):
+        '''
+        the footprints of every event (raw footprints.indexDtype rows) in the order they were stored.
+        Indexes made before we stored footprints do not have this, but then there are no footprints to index either
+        '''
+        return os.path.join(self.__indexDirectory__(), 'emfootprints.dat')
+
+    def __buildIndex__(self):
+        '''
+        build the label, gpstime, tag and footprint indexes from scratch by scanning every event.
+        We build into a temporary directory and move it into place so that concurrent processes never see a partial index
+        '''
+        tmpdir = tempfile.mkdtemp(dir=self.service_url, prefix='.index-')
+        os.makedirs(os.path.join(tmpdir, 'labels'))
+
+        gps_obj = open(os.path.join(tmpdir, 'gpstimes'), 'w')
+        footprint_obj = open(os.path.join(tmpdir, 'emfootprints.dat'), 'wb')
+        for graceid in sorted(self.graceids()):
+            if not os.path.exists(self.__path__(graceid, 'toplevel')): ### event creation is not finished, so it will index itself
+                continue
+            print >> gps_obj, "%r %s"%(self.read(graceid, 'toplevel')['gpstime'], graceid)
+
+            for label in self.read(graceid, 'labels'):
+                file_obj = open(os.path.join(tmpdir, 'labels', label['name']), 'a')
+                print >> file_obj, graceid
+                file_obj.close()
+
+            footprint_obj.write( fp.indexRows(graceid, self.footprints(graceid)).tostring() )
+        gps_obj.close()
+        footprint_obj.close()
+
+        self.__writeTagIndex__(os.path.join(tmpdir, 'tags'))
+
+        try:
+            os.rename(tmpdir, self.__indexDirectory__())
+        except OSError: ### someone else built the index first
+            shutil.rmtree(tmpdir)
+
+    def __writeTagIndex__(self, directory):
+        '''
+        write the tag index for every event into directory, which must not exist yet
+        '''
+        os.makedirs(directory)
+        for graceid in sorted(self.graceids()):
+            if not os.path.exists(self.__path__(graceid, 'toplevel')): ### event creation is not finished, so it will index itself
+                continue
+            for tagname in self.tags(graceid).keys():
+                file_obj = open(self.__tagIndexPath__(tagname, directory=directory), 'a')
+                print >> file_obj, graceid
+                file_obj.close()
+
+    def __buildTagIndex__(self):
+        '''
+        add the tag index to an existing index directory, just like __buildIndex__
+        '''
+        tmpdir = tempfile.mkdtemp(dir=self.__indexDirectory__(), prefix='.tags-')
+        self.__writeTagIndex__(os.path.join(tmpdir, 'tags'))
+        try:
+            os.rename(os.path.join(tmpdir, 'tags'), self.__tagIndexDirectory__())
+        except OSError: ### someone else built the index first
+            pass
+        shutil.rmtree(tmpdir)
+
+    def __indexLabel__(self, graceid, label):
+        '''
+        record that label was applied to graceid. Appending a single line is atomic, so we do not need a lock
+        '''
+        file_obj = open(self.__labelIndexPath__(label), 'a')
+        print >> file_obj, graceid
+        file_obj.close()
+
+    def __unindexLabel__(self, graceid, label):
+        '''
+        record that label was removed from graceid. We append "-graceid" rather than rewriting the index, which other writers append to without a lock
+        '''
+        file_obj = open(self.__labelIndexPath__(label), 'a')
+        print >> file_obj, '-'+graceid
+        file_obj.close()
+
+    def __indexTag__(self, graceid, tagname):
+        '''
+        record that tagname was applied to one of graceid's logs
+        '''
+        file_obj = open(self.__tagIndexPath__(tagname), 'a')
+        print >> file_obj, graceid
+        file_obj.close()
+
+    def __indexFootprints__(self, graceid, rows):
+        '''
+        record graceid's new footprints
+        '''
+        self.__appendRows__(fp.indexRows(graceid, rows), self.__footprintIndexPath__())
+
+    def __indexGpstime__(self, graceid, gpstime):
+        '''
+        record the gpstime of a newly created event
+        '''
+        file_obj = open(self.__gpsIndexPath__(), 'a')
+        print >> file_obj, "%r %s"%(gpstime, graceid)
+        file_obj.close()
+
+    def label2graceids(self, label):
+        return self.__readGraceidIndex__(self.__labelIndexPath__(label))
+
+    def tag2graceids(self, tagname):
+        return self.__readGraceidIndex__(self.__tagIndexPath__(tagname))
+
+    def __readGraceidIndex__(self, path):
+        '''
+        the distinct graceids listed in an index file, in the order they were added.
+        A line like "-graceid" removes graceid until it is added again
+        '''
+        if not os.path.exists(path):
+            return []
+
+        file_obj = open(path, 'r')
+        graceids = file_obj.read().split()
+        file_obj.close()
+
+        ans = []
+        seen = set()
+        for graceid in graceids: ### labels and tags may be applied more than once
+            if graceid[0]=='-':
+                graceid = graceid[1:]
+                if graceid in seen:
+                    seen.remove(graceid)
+                    ans.remove(graceid)
+            elif graceid not in seen:
+                seen.add(graceid)
+                ans.append(graceid)
+        return ans
+
+    def __refreshGpsIndex__(self):
+        '''
+        read anything appended to the gpstime index since we last looked and insert it into our sorted list
+        '''
+        file_obj = open(self.__gpsIndexPath__(), 'r')
+        file_obj.seek(self.__gpsIndexOffset__)
+        data = file_obj.read()
+        file_obj.close()
+
+        data = data[:data.rfind('\n')+1] ### only consume complete lines
+        for line in data.splitlines():
+            gpstime, graceid = line.split()
+            if not self.__graceid2gps__.has_key(graceid):
+                gpstime = float(gpstime)
+                self.__graceid2gps__[graceid] = gpstime
+                bisect.insort(self.__gpsIndex__, (gpstime, graceid))
+        self.__gpsIndexOffset__ += len(data)
+
+    def gps2graceids(self, gpsstart, gpsstop):
+        '''
+        look up all graceids with gpsstart <= gpstime <= gpsstop via bisection
+        '''
+        self.__refreshGpsIndex__()
+        start = bisect.bisect_left(self.__gpsIndex__, (gpsstart,))
+        stop = bisect.bisect_right(self.__gpsIndex__, (gpsstop, chr(255)))
+        return [graceid for gpstime, graceid in self.__gpsIndex__[start:stop]]
+
+    def graceid2gpstime(self, graceid):
+        self.__refreshGpsIndex__()
+        if self.__graceid2gps__.has_key(graceid):
+            return self.__graceid2gps__[graceid]
+        else: ### not indexed, so go to the source
+            return self.read(graceid, 'toplevel')['gpstime']
+
+#-------------------------------------------------
+
+class SQLiteEngine(StorageEngine):
+    '''
+    stores all events in a single SQLite database (WAL mode), selected via urls like sqlite:///path/to/db
+
+    uploaded files are copied into path/to/db.files/graceid/ and lvalert messages are written to path/to/lvalert.out
+    so that lvalertTest_listen and friends can monitor path/to
+
+    sqlite3 connections cannot be shared between threads, so each thread that uses this engine gets its own
+    '''
+    scheme = 'sqlite://'
+
+    __schema__ = [
+        'CREATE TABLE IF NOT EXISTS events (graceid TEXT PRIMARY KEY, gpstime REAL, grp TEXT, pipeline TEXT, search TEXT, created REAL, record BLOB)',
+        'CREATE TABLE IF NOT EXISTS logs (graceid TEXT, n INTEGER, record BLOB, PRIMARY KEY (graceid, n))',
+        'CREATE TABLE IF NOT EXISTS labels (graceid TEXT, n INTEGER, name TEXT, record BLOB, PRIMARY KEY (graceid, n))',
+        'CREATE TABLE IF NOT EXISTS files (graceid TEXT, n INTEGER, filename TEXT, record BLOB, PRIMARY KEY (graceid, n))',
+        'CREATE TABLE IF NOT EXISTS voevents (graceid TEXT, n INTEGER, record BLOB, PRIMARY KEY (graceid, n))',
+        'CREATE TABLE IF NOT EXISTS signoffs (graceid TEXT PRIMARY KEY, record BLOB)',
+        'CREATE TABLE IF NOT EXISTS signoffhistory (graceid TEXT, n INTEGER, record BLOB, PRIMARY KEY (graceid, n))',
+        'CREATE TABLE IF NOT EXISTS tags (graceid TEXT, n INTEGER, name TEXT, PRIMARY KEY (graceid, n, name))',
+        'CREATE TABLE IF NOT EXISTS emobservations (graceid TEXT, n INTEGER, record BLOB, PRIMARY KEY (graceid, n))',
+        'CREATE TABLE IF NOT EXISTS eels (graceid TEXT, n INTEGER, record BLOB, PRIMARY KEY (graceid, n))',
+        'CREATE TABLE IF NOT EXISTS emfootprints (graceid TEXT, n INTEGER, start REAL, stop REAL, rows BLOB, PRIMARY KEY (graceid, n))',
+        'CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)',
+        'CREATE INDEX IF NOT EXISTS events_gpstime ON events (gpstime)',
+        'CREATE INDEX IF NOT EXISTS events_pipeline ON events (pipeline)',
+        'CREATE INDEX IF NOT EXISTS labels_name ON labels (name)',
+        'CREATE INDEX IF NOT EXISTS tags_name ON tags (name)',
+        'CREATE INDEX IF NOT EXISTS emfootprints_start ON emfootprints (start)',
+    ]
+
+    def __init__(self, url):
+        super(SQLiteEngine, self).__init__(url)
+        self.path = url[len(self.scheme):] ### sqlite:///abs/path -> /abs/path, sqlite://rel/path -> rel/path
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.lvalert = os.path.join(directory, 'lvalert.out')
+
+        self.__local__ = threading.local() ### conn and transactionDepth for each thread
+        self.__conns__ = [] ### every connection we opened, so close() can close them all
+        self.__connsLock__ = threading.Lock()
+
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        with self.__transaction__() as cursor:
+            tables = set(name for name, in cursor.execute("SELECT name FROM sqlite_master WHERE type='table'"))
+            for statement in self.__schema__:
+                cursor.execute(statement)
+
+            if ('logs' in tables) and ('tags' not in tables): ### made before we indexed tags, so we build the index from the logs once
+                for graceid, record in cursor.execute('SELECT graceid, record FROM logs').fetchall():
+                    log = self.__loads__(record)
+                    for tagname in tagnames(log['tag_names']):
+                        cursor.execute('INSERT OR IGNORE INTO tags (graceid, n, name) VALUES (?, ?, ?)', (graceid, log['N'], tagname))
+
+    @property
+    def conn(self):
+        '''
+        this thread's connection, opened the first time it is needed
+        '''
+        conn = getattr(self.__local__, 'conn', None)
+        if conn==None:
+            ### we manage transactions ourselves. Only this thread uses conn, but close() may close it from another
+            conn = sqlite3.connect(self.path, timeout=60, isolation_level=None, check_same_thread=False)
+            conn.text_factory = str
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self.__local__.conn = conn
+            self.__local__.transactionDepth = 0
+            with self.__connsLock__:
+                self.__conns__.append(conn)
+        return conn
+
+    @contextmanager
+    def __transaction__(self):
+        '''
+        take the write lock up front so that read-modify-write sequences are atomic across processes.
+        Nested transactions simply join the outermost one
+        '''
+        cursor = self.conn.cursor()
+        local = self.__local__
+        if local.transactionDepth:
+            local.transactionDepth += 1
+            try:
+                yield cursor
+            finally:
+                local.transactionDepth -= 1
+            return
+
+        cursor.execute('BEGIN IMMEDIATE')
+        local.transactionDepth = 1
+        try:
+            yield cursor
+        except:
+            local.transactionDepth = 0
+            cursor.execute('ROLLBACK')
+            raise
+        else:
+            local.transactionDepth = 0
+            cursor.execute('COMMIT')
+
+    @contextmanager
+    def lock(self, graceid):
+        '''
+        SQLite only locks the whole database, so this is a write transaction that covers every statement inside it
+        '''
+        with self.__transaction__():
+            yield
+
+    def __dumps__(self, stuff):
+        return sqlite3.Binary(pickle.dumps(stuff, pickle.HIGHEST_PROTOCOL))
+
+    def __loads__(self, blob):
+        return pickle.loads(str(blob))
+
+    def link(self, graceid=None, kind=None):
+        if graceid==None:
+            return self.url
+        elif kind==None:
+            return "%s/%s"%(self.url, graceid)
+        else:
+            return "%s/%s/%s.pkl"%(self.url, graceid, kind)
+
+    def get(self, url):
+        graceid, kind = url[len(self.url):].strip('/').split('/')
+        return self.read(graceid, kind.replace('.pkl', ''))
+
+    def close(self):
+        super(SQLiteEngine, self).close()
+        with self.__connsLock__:
+            for conn in self.__conns__:
+                conn.close()
+            self.__conns__ = []
+        self.__local__ = threading.local()
+
+    ### events ###
+
+    def exists(self, graceid):
+        return self.conn.execute('SELECT 1 FROM events WHERE graceid=?', (graceid,)).fetchone()!=None
+
+    def stamp(self, graceid):
+        row = self.conn.execute('SELECT rowid FROM events WHERE graceid=?', (graceid,)).fetchone()
+        if row==None:
+            return None
+        return row[0]
+
+    def graceids(self):
+        return [graceid for graceid, in self.conn.execute('SELECT graceid FROM events ORDER BY graceid')]
+
+    def genGraceID(self, letter):
+        '''
+        bump a counter within a single transaction. If the counter is missing, rebuild it from the known events
+        '''
+        with self.__transaction__() as cursor:
+            row = cursor.execute("SELECT value FROM counters WHERE name='graceid'").fetchone()
+            if row:
+                ind = row[0]
+            else:
+                ind = cursor.execute('SELECT MAX(CAST(SUBSTR(graceid, 2) AS INTEGER)) FROM events').fetchone()[0]
+                ind = 0 if ind==None else ind+1
+
+            while cursor.execute('SELECT 1 FROM events WHERE graceid=?', ("%s%06d"%(letter, ind),)).fetchone():
+                ind += 1
+
+            cursor.execute("INSERT OR REPLACE INTO counters (name, value) VALUES ('graceid', ?)", (ind+1,))
+
+        return "%s%06d"%(letter, ind)
+
+    def create(self, graceid):
+        try:
+            with self.__transaction__() as cursor:
+                cursor.execute('INSERT INTO events (graceid) VALUES (?)', (graceid,))
+        except sqlite3.IntegrityError:
+            raise ValueError('graceid=%s already exists!'%graceid)
+
+    ### reading and writing data ###
+
+    def read(self, graceid, kind):
+        if kind=='toplevel':
+            return self.__loads__(self.conn.execute('SELECT record FROM events WHERE graceid=?', (graceid,)).fetchone()[0])
+
+        elif kind=='signoffs':
+            return self.__loads__(self.conn.execute('SELECT record FROM signoffs WHERE graceid=?', (graceid,)).fetchone()[0])
+
+        elif kind in self.__recordKinds__:
+            return [self.__loads__(record) for record, in self.conn.execute('SELECT record FROM %s WHERE graceid=? ORDER BY n'%kind, (graceid,))]
+
+        else:
+            raise ValueError('kind=%s not understood'%kind)
+
+    def write(self, graceid, kind, stuff):
+        with self.__transaction__() as cursor:
+            if kind=='toplevel':
+                cursor.execute('UPDATE events SET gpstime=?, grp=?, pipeline=?, search=?, created=?, record=? WHERE graceid=?',
+                    (stuff.get('gpstime'), stuff.get('group'), stuff.get('pipeline'), stuff.get('search'), stuff.get('created'), self.__dumps__(stuff), graceid)
+                )
+
+            elif kind=='signoffs':
+                cursor.execute('INSERT OR REPLACE INTO signoffs (graceid, record) VALUES (?, ?)', (graceid, self.__dumps__(stuff)))
+
+            else:
+                raise ValueError('kind=%s is not a document'%kind)
+
+    def append(self, graceid, kind, stuff):
+        if kind not in self.__recordKinds__:
+            raise ValueError('kind=%s is not a record'%kind)
+
+        with self.__transaction__() as cursor:
+            ind = self.__count__(cursor, graceid, kind)
+            if kind=='labels':
+                cursor.execute('INSERT INTO labels (graceid, n, name, record) VALUES (?, ?, ?, ?)', (graceid, ind, stuff['name'], self.__dumps__(stuff)))
+            elif kind=='files':
+                cursor.execute('INSERT INTO files (graceid, n, filename, record) VALUES (?, ?, ?, ?)', (graceid, ind, stuff, self.__dumps__(stuff)))
+            else:
+                cursor.execute('INSERT INTO %s (graceid, n, record) VALUES (?, ?, ?)'%kind, (graceid, ind, self.__dumps__(stuff)))
+
+        return ind
+
+    def removeLabel(self, graceid, label):
+        with self.__transaction__() as cursor:
+            if not cursor.execute('DELETE FROM labels WHERE graceid=? AND name=?', (graceid, label)).rowcount:
+                return False
+            ### renumber the remaining labels so they are still 0, 1, 2, ... (see __count__)
+            for n, (old,) in enumerate(cursor.execute('SELECT n FROM labels WHERE graceid=? ORDER BY n', (graceid,)).fetchall()):
+                if n!=old:
+                    cursor.execute('UPDATE labels SET n=? WHERE graceid=? AND n=?', (n, graceid, old))
+        return True
+
+    def readRange(self, graceid, kind, start=0, stop=None):
+        if kind not in self.__recordKinds__:
+            raise ValueError('kind=%s is not a record'%kind)
+
+        if stop==None:
+            cursor = self.conn.execute('SELECT record FROM %s WHERE graceid=? AND n>=? ORDER BY n'%kind, (graceid, start))
+        else:
+            cursor = self.conn.execute('SELECT record FROM %s WHERE graceid=? AND n>=? AND n<? ORDER BY n'%kind, (graceid, start, stop))
+        return [self.__loads__(record) for record, in cursor]
+
+    def __count__(self, cursor, graceid, table):
+        '''
+        records are numbered 0, 1, 2, ... so the largest n tells us how many there are. Unlike COUNT(*), this is a single
+        lookup in the primary key rather than a scan over every record
+        '''
+        return cursor.execute('SELECT COALESCE(MAX(n)+1, 0) FROM %s WHERE graceid=?'%table, (graceid,)).fetchone()[0]
+
+    def count(self, graceid, kind):
+        if kind not in self.__recordKinds__:
+            raise ValueError('kind=%s is not a record'%kind)
+        return self.__count__(self.conn, graceid, kind)
+
+    def tags(self, graceid):
+        index = dict()
+        for name, n in self.conn.execute('SELECT name, n FROM tags WHERE graceid=? ORDER BY name, n', (graceid,)):
+            index.setdefault(name, []).append(n)
+        return index
+
+    def addTag(self, graceid, N, tagname):
+        with self.__transaction__() as cursor:
+            return cursor.execute('INSERT OR IGNORE INTO tags (graceid, n, name) VALUES (?, ?, ?)', (graceid, N, tagname)).rowcount==1
+
+    def removeTag(self, graceid, N, tagname):
+        with self.__transaction__() as cursor:
+            return cursor.execute('DELETE FROM tags WHERE graceid=? AND n=? AND name=?', (graceid, N, tagname)).rowcount==1
+
+    def appendFootprints(self, graceid, rows):
+        '''
+        each call stores its rows as a single blob along with the times they span, which allFootprints filters on
+        '''
+        rows = np.asarray(rows, dtype=fp.footprintDtype)
+        if not len(rows):
+            return
+        with self.__transaction__() as cursor:
+            ind = self.__count__(cursor, graceid, 'emfootprints')
+            cursor.execute('INSERT INTO emfootprints (graceid, n, start, stop, rows) VALUES (?, ?, ?, ?, ?)',
+                (graceid, ind, float(np.min(rows['start'])), float(np.max(rows['start']+rows['duration'])), sqlite3.Binary(rows.tostring()))
+            )
+
+    def __blobs2rows__(self, blobs, dtype):
+        return np.fromstring(''.join(str(blob) for blob in blobs), dtype=dtype)
+
+    def footprints(self, graceid):
+        cursor = self.conn.execute('SELECT rows FROM emfootprints WHERE graceid=? ORDER BY n', (graceid,))
+        return self.__blobs2rows__([blob for blob, in cursor], fp.footprintDtype)
+
+    def allFootprints(self, start=None, stop=None):
+        query = 'SELECT graceid, rows FROM emfootprints'
+        conditions = []
+        args = []
+        if start!=None:
+            conditions.append('stop>=?')
+            args.append(start)
+        if stop!=None:
+            conditions.append('start<=?')
+            args.append(stop)
+        if conditions:
+            query += ' WHERE '+' AND '.join(conditions)
+
+        ans = [fp.indexRows(graceid, self.__blobs2rows__([blob], fp.footprintDtype)) for graceid, blob in self.conn.execute(query+' ORDER BY rowid', args)]
+        if ans:
+            return np.concatenate(ans)
+        return np.empty(0, dtype=fp.indexDtype)
+
+    def filename(self, graceid, filename):
+        return os.path.join(self.path+'.files', graceid, os.path.basename(filename))
+
+    def attach(self, graceid, filename):
+        newFilename = self.filename(graceid, filename)
+        directory = os.path.dirname(newFilename)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        return self.__attachFile__(filename, newFilename)
+
+    def blobDirectory(self):
+        return self.path+'.blobs'
+
+    ### indexes ###
+
+    def label2graceids(self, label):
+        return [graceid for graceid, in self.conn.execute('SELECT DISTINCT graceid FROM labels WHERE name=? ORDER BY graceid', (label,))]
+
+    def tag2graceids(self, tagname):
+        return [graceid for graceid, in self.conn.execute('SELECT DISTINCT graceid FROM tags WHERE name=? ORDER BY graceid', (tagname,))]
+
+    def gps2graceids(self, gpsstart, gpsstop):
+        return [graceid for graceid, in self.conn.execute('SELECT graceid FROM events WHERE gpstime BETWEEN ? AND ? ORDER BY gpstime', (gpsstart, gpsstop))]
+
+    def graceid2gpstime(self, graceid):
+        return self.conn.execute('SELECT gpstime FROM events WHERE graceid=?', (graceid,)).fetchone()[0]
+
+    __attribute2column__ = {'group':'grp', 'pipeline':'pipeline', 'search':'search'}
+
+    def attribute2graceids(self, key, value):
+        if not self.__attribute2column__.has_key(key):
+            return None
+        return [graceid for graceid, in self.conn.execute('SELECT graceid FROM events WHERE %s=? COLLATE NOCASE'%self.__attribute2column__[key], (value,))]
+
+#-------------------------------------------------
+
+class MemoryStore(object):
+    '''
+    the Python structures backing a MemoryEngine. Named stores are shared by every MemoryEngine in this process with the same name
+    '''
+
+    def __init__(self):
+        self.lock = threading.RLock() ### guards all mutations
+        self.counter = 0
+
+        self.events = dict() ### graceid -> {kind : document or list of records}
+        self.order = [] ### graceids in the order they were created
+
+        self.labels = dict() ### label -> list of graceids
+        self.tags = dict() ### tagname -> list of graceids
+        self.footprints = [] ### arrays of footprints.indexDtype, see MemoryEngine.allFootprints
+        self.gpsIndex = [] ### sorted list of (gpstime, graceid)
+        self.graceid2gps = dict()
+
+        self.attachments = dict() ### link -> data stored through MemoryEngine.attachData
+        self.alerts = Queue.Queue() ### lvalert lines, in the order they were sent
+        self.lvalert = None ### optional file into which we also write lvalert messages
+
+class MemoryEngine(StorageEngine):
+    '''
+    keeps all events in Python structures so that FakeDb never touches the disk. Selected via
+        :memory:                     -> a private store, discarded along with this engine
+        mem://name                   -> a store shared by every FakeDb in this process that uses the same name
+        mem://name?lvalert=/path/to  -> also write lvalert messages into this file (remembered by the named store)
+
+    lvalert messages are put into self.alerts (a Queue.Queue of formatted lines) instead of lvalert.out.
+    Uploaded files are read into self.store.attachments and referenced by links like mem://name/graceid/filename.
+    '''
+    scheme = 'mem://'
+    anonymous = ':memory:'
+
+    __stores__ = dict() ### name -> MemoryStore, shared across this process
+
+    def __init__(self, url=anonymous):
+        super(MemoryEngine, self).__init__(url)
+
+        if url==self.anonymous:
+            self.name = None
+            self.store = MemoryStore()
+
+        else:
+            self.name, _, query = url[len(self.scheme):].partition('?')
+            if not self.__stores__.has_key(self.name):
+                self.__stores__[self.name] = MemoryStore()
+            self.store = self.__stores__[self.name]
+
+            for key, value in [param.split('=', 1) for param in query.split('&') if param]:
+                if key=='lvalert':
+                    self.store.lvalert = value
+                else:
+                    raise ValueError('parameter=%s not understood for %s'%(key, url))
+
+        self.lvalert = self.store.lvalert
+        self.alerts = self.store.alerts
+
+    @classmethod
+    def drop(cls, name):
+        '''
+        forget a named store so the next MemoryEngine with this name starts from scratch
+        '''
+        cls.__stores__.pop(name, None)
+
+    def link(self, graceid=None, kind=None):
+        if graceid==None:
+            return self.url
+        elif kind==None:
+            return "%s/%s"%(self.url, graceid)
+        else:
+            return "%s/%s/%s.pkl"%(self.url, graceid, kind)
+
+    def get(self, url):
+        graceid, kind = url[len(self.url):].strip('/').split('/')
+        return self.read(graceid, kind.replace('.pkl', ''))
+
+    def sendlvalert(self, line):
+        self.alerts.put(line)
+        if self.lvalert:
+            super(MemoryEngine, self).sendlvalert(line)
+
+    ### events ###
+
+    def exists(self, graceid):
+        return self.store.events.has_key(graceid)
+
+    def stamp(self, graceid):
+        if self.store.events.has_key(graceid):
+            return id(self.store.events[graceid])
+        return None
+
+    def graceids(self):
+        return list(self.store.order)
+
+    def genGraceID(self, letter):
+        with self.store.lock:
+            ind = self.store.counter
+            while self.store.events.has_key("%s%06d"%(letter, ind)):
+                ind += 1
+            self.store.counter = ind+1
+
+        return "%s%06d"%(letter, ind)
+
+    def create(self, graceid):
+        with self.store.lock:
+            if self.store.events.has_key(graceid):
+                raise ValueError('graceid=%s already exists!'%graceid)
+            self.store.events[graceid] = dict((kind, []) for kind in self.__recordKinds__)
+            self.store.events[graceid]['tags'] = dict() ### tagname -> log numbers
+            self.store.events[graceid]['emfootprints'] = [] ### arrays of footprints.footprintDtype
+            self.store.order.append(graceid)
+
+    @contextmanager
+    def lock(self, graceid):
+        with self.store.lock: ### a single RLock for the whole store, which is plenty within one process
+            yield
+
+    ### reading and writing data ###
+
+    ### we hand out and store copies so that callers can never modify the store by accident
+
+    def read(self, graceid, kind):
+        return copy.deepcopy(self.store.events[graceid][kind])
+
+    def write(self, graceid, kind, stuff):
+        with self.store.lock:
+            self.store.events[graceid][kind] = copy.deepcopy(stuff)
+
+            if kind=='toplevel':
+                gpstime = stuff['gpstime']
+                self.store.graceid2gps[graceid] = gpstime
+                bisect.insort(self.store.gpsIndex, (gpstime, graceid))
+
+    def append(self, graceid, kind, stuff):
+        with self.store.lock:
+            records = self.store.events[graceid][kind]
+            records.append( copy.deepcopy(stuff) )
+
+            if kind=='labels':
+                graceids = self.store.labels.setdefault(stuff['name'], [])
+                if graceid not in graceids:
+                    graceids.append(graceid)
+
+            return len(records)-1
+
+    def removeLabel(self, graceid, label):
+        with self.store.lock:
+            records = self.store.events[graceid]['labels']
+            kept = [entry for entry in records if entry['name']!=label]
+            if len(kept)==len(records):
+                return False
+            records[:] = kept
+
+            graceids = self.store.labels.get(label, [])
+            if graceid in graceids:
+                graceids.remove(graceid)
+        return True
+
+    def readRange(self, graceid, kind, start=0, stop=None):
+        return copy.deepcopy(self.store.events[graceid][kind][start:stop])
+
+    def count(self, graceid, kind):
+        return len(self.store.events[graceid][kind])
+
+    def tags(self, graceid):
+        return copy.deepcopy(self.store.events[graceid]['tags'])
+
+    def addTag(self, graceid, N, tagname):
+        with self.store.lock:
+            Ns = self.store.events[graceid]['tags'].setdefault(tagname, [])
+            if N in Ns:
+                return False
+            bisect.insort(Ns, N)
+
+            graceids = self.store.tags.setdefault(tagname, [])
+            if graceid not in graceids:
+                graceids.append(graceid)
+        return True
+
+    def removeTag(self, graceid, N, tagname):
+        with self.store.lock:
+            index = self.store.events[graceid]['tags']
+            Ns = index.get(tagname, [])
+            if N not in Ns:
+                return False
+            Ns.remove(N)
+            if not Ns:
+                index.pop(tagname)
+        return True
+
+    def appendFootprints(self, graceid, rows):
+        rows = np.array(rows, dtype=fp.footprintDtype) ### a copy
+        with self.store.lock:
+            self.store.events[graceid]['emfootprints'].append( rows )
+            self.store.footprints.append( fp.indexRows(graceid, rows) )
+
+    def __concatenate__(self, arrays, dtype):
+        '''
+        join arrays into one, which replaces them so later reads do not pay for this again. Returns a copy
+        '''
+        with self.store.lock:
+            if not arrays:
+                return np.empty(0, dtype=dtype)
+            if len(arrays) > 1:
+                arrays[:] = [np.concatenate(arrays)]
+            return arrays[0].copy()
+
+    def footprints(self, graceid):
+        return self.__concatenate__(self.store.events[graceid]['emfootprints'], fp.footprintDtype)
+
+    def allFootprints(self, start=None, stop=None):
+        return self.__concatenate__(self.store.footprints, fp.indexDtype)
+
+    def filename(self, graceid, filename):
+        return "%s/%s"%(self.link(graceid), os.path.basename(filename))
+
+    def attach(self, graceid, filename):
+        with open(filename, 'rb') as file_obj:
+            data = file_obj.read()
+        return self.attachData(graceid, filename, data)
+
+    def attachData(self, graceid, filename, data):
+        '''
+        data is kept in the store rather than written to disk, under a link like mem://name/graceid/filename
+        '''
+        link = self.filename(graceid, filename)
+        with self.store.lock:
+            self.store.attachments[link] = data
+        return link
+
+    def readAttachment(self, path):
+        if self.store.attachments.has_key(path):
+            return self.store.attachments[path]
+        return super(MemoryEngine, self).readAttachment(path)
+
+    ### indexes ###
+
+    def label2graceids(self, label):
+        return list(self.store.labels.get(label, []))
+
+    def tag2graceids(self, tagname):
+        return list(self.store.tags.get(tagname, []))
+
+    def gps2graceids(self, gpsstart, gpsstop):
+        start = bisect.bisect_left(self.store.gpsIndex, (gpsstart,))
+        stop = bisect.bisect_right(self.store.gpsIndex, (gpsstop, chr(255)))
+        return [graceid for gpstime, graceid in self.store.gpsIndex[start:stop]]
+
+    def graceid2gpstime(self, graceid):
+        return self.store.graceid2gps[graceid]
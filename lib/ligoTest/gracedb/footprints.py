@@ -0,0 +1,168 @@
+description = "NumPy structured arrays for the sky footprints of EM observations, and vectorized tests for whether they overlap a region of the sky or a range of times"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import numpy as np
+
+#-------------------------------------------------
+
+### one row per footprint. observation is the N of the EMObservation it belongs to and N counts footprints within it.
+### ra, dec and their widths are in degrees (the footprint spans ra +/- raWidth/2, dec +/- decWidth/2).
+### start is a unix timestamp, like FakeDb's 'created', and duration is in seconds
+footprintDtype = np.dtype([('observation', '<i4'),
+                           ('N', '<i4'),
+                           ('ra', '<f8'),
+                           ('dec', '<f8'),
+                           ('raWidth', '<f8'),
+                           ('decWidth', '<f8'),
+                           ('start', '<f8'),
+                           ('duration', '<f8'),
+                          ])
+
+### footprints of many events, as returned by StorageEngine.allFootprints
+indexDtype = np.dtype([('graceid', 'S16')]+footprintDtype.descr)
+
+__epoch__ = np.datetime64('1970-01-01T00:00:00', 'us')
+
+#-------------------------------------------------
+
+def parseList(values, name='values'):
+    '''
+    GraceDb accepts a list, a comma-separated string or a single number. Returns a 1D array of floats
+    '''
+    if isinstance(values, basestring):
+        values = [value for value in values.split(',') if value.strip()]
+    elif np.isscalar(values):
+        values = [values]
+    try:
+        return np.array(values, dtype=float).reshape(-1)
+    except ValueError:
+        raise ValueError('could not interpret %s as a list of numbers'%name)
+
+def parseTimes(values, name='startTimeList'):
+    '''
+    like parseList, but values are ISO 8601 UTC times (eg: "2017-08-17T12:41:04") or unix timestamps. Returns unix timestamps
+    '''
+    try:
+        return parseList(values, name=name)
+    except ValueError:
+        pass
+
+    if isinstance(values, basestring):
+        values = values.split(',')
+    elif np.isscalar(values):
+        values = [values]
+    values = [value.strip().rstrip('Z') for value in values if value.strip()]
+    try:
+        return (np.array(values, dtype='datetime64[us]') - __epoch__).astype('<i8')*1e-6
+    except ValueError:
+        raise ValueError('could not interpret %s as a list of times'%name)
+
+def time2iso(times):
+    '''
+    unix timestamps -> ISO 8601 UTC strings, the format GraceDb reports start times in
+    '''
+    return np.datetime_as_string(__epoch__ + np.round(np.asarray(times)*1e6).astype('<i8').astype('timedelta64[us]'))
+
+def genFootprints(observation, ra, raWidth, dec, decWidth, start, duration):
+    '''
+    build a structured array with footprintDtype. Every argument except observation is an array with one entry per footprint
+    (a raWidth, decWidth or duration with a single entry applies to every footprint). Raises ValueError if these are inconsistent
+    '''
+    ra = np.asarray(ra, dtype=float)
+    dec = np.asarray(dec, dtype=float)
+    start = np.asarray(start, dtype=float)
+
+    N = len(ra)
+    if not N:
+        raise ValueError('please supply at least one footprint')
+    if (len(dec)!=N) or (len(start)!=N):
+        raise ValueError('raList, decList and startTimeList must have the same length')
+
+    rows = np.empty(N, dtype=footprintDtype)
+    rows['observation'] = observation
+    rows['N'] = np.arange(1, N+1)
+    rows['ra'] = ra
+    rows['dec'] = dec
+    rows['start'] = start
+    for key, values in [('raWidth', raWidth), ('decWidth', decWidth), ('duration', duration)]:
+        values = np.asarray(values, dtype=float)
+        if len(values) not in [1, N]:
+            raise ValueError('%sList must have a single entry or one for each footprint'%key)
+        if np.any(values < 0):
+            raise ValueError('%sList must be non-negative'%key)
+        rows[key] = values
+
+    if np.any(np.abs(dec) > 90):
+        raise ValueError('decList must be between -90 and 90 degrees')
+    if not np.all(np.isfinite(ra) & np.isfinite(start)):
+        raise ValueError('raList and startTimeList must be finite')
+
+    return rows
+
+def indexRows(graceid, rows):
+    '''
+    rows (footprintDtype) labeled with graceid (indexDtype)
+    '''
+    ans = np.empty(len(rows), dtype=indexDtype)
+    ans['graceid'] = graceid
+    for name in footprintDtype.names:
+        ans[name] = rows[name]
+    return ans
+
+def bounds(rows):
+    '''
+    the smallest (ra, raWidth, dec, decWidth) box that contains rows, as GraceDb reports for an EMObservation.
+    The ra range does not wrap around 0, so footprints on either side of ra=0 produce a wide box
+    '''
+    ramin = np.min(rows['ra']-0.5*rows['raWidth'])
+    ramax = np.max(rows['ra']+0.5*rows['raWidth'])
+    decmin = np.min(rows['dec']-0.5*rows['decWidth'])
+    decmax = np.max(rows['dec']+0.5*rows['decWidth'])
+    return 0.5*(ramin+ramax), ramax-ramin, 0.5*(decmin+decmax), decmax-decmin
+
+def overlaps(rows, ra=None, dec=None, start=None, stop=None):
+    '''
+    a boolean mask selecting the rows whose footprint overlaps every region supplied
+        ra    : (low, high) in degrees. If low > high, the range wraps through ra=0 (eg: (350, 10))
+        dec   : (low, high) in degrees
+        start : unix timestamp. Footprints observed (from start to start+duration) only before this are excluded
+        stop  : unix timestamp. Footprints observed only after this are excluded
+    '''
+    mask = np.ones(len(rows), dtype=bool)
+
+    if ra!=None: ### compare angular distances between centers so that both footprints and the range may wrap through ra=0
+        low, high = ra
+        width = (high-low)%360.
+        if (width==0) and (high!=low): ### the full circle
+            width = 360.
+        center = low + 0.5*width
+        distance = np.abs((rows['ra']-center+180.)%360. - 180.)
+        mask &= distance <= 0.5*(rows['raWidth']+width)
+
+    if dec!=None:
+        low, high = dec
+        mask &= (rows['dec']+0.5*rows['decWidth'] >= low) & (rows['dec']-0.5*rows['decWidth'] <= high)
+
+    if start!=None:
+        mask &= rows['start']+rows['duration'] >= start
+
+    if stop!=None:
+        mask &= rows['start'] <= stop
+
+    return mask
+
+def toDicts(rows):
+    '''
+    the footprints in rows in the form GraceDb reports them
+    '''
+    starts = time2iso(rows['start'])
+    return [{'N'             : int(row['N']),
+             'ra'            : float(row['ra']),
+             'dec'           : float(row['dec']),
+             'raWidth'       : float(row['raWidth']),
+             'decWidth'      : float(row['decWidth']),
+             'start_time'    : start,
+             'exposure_time' : float(row['duration']),
+            } for row, start in zip(rows, starts)]
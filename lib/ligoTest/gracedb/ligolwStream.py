@@ -0,0 +1,125 @@
+description = "a streaming reader for single tables within LIGO_LW documents that stops as soon as it has the table it needs"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import re
+import gzip
+
+from xml.etree import cElementTree as ElementTree
+
+#-------------------------------------------------
+
+__intTypes__ = ['int_2s', 'int_4s', 'int_8s', 'int_2u', 'int_4u', 'int_8u']
+__floatTypes__ = ['real_4', 'real_8']
+
+#-------------------------------------------------
+
+def openLIGOLW(filename):
+    '''
+    open filename for reading, transparently decompressing gzipped documents
+    '''
+    file_obj = open(filename, 'rb')
+    magic = file_obj.read(2)
+    file_obj.seek(0)
+    if magic=='\x1f\x8b':
+        file_obj.close()
+        return gzip.open(filename, 'rb')
+    return file_obj
+
+def __tableName__(name):
+    '''
+    "coinc_inspiral:table" -> "coinc_inspiral"
+    '''
+    if name.endswith(':table'):
+        name = name[:-len(':table')]
+    return name.split(':')[-1]
+
+def __columnName__(name):
+    '''
+    "coinc_inspiral:end_time" -> "end_time"
+    '''
+    return name.split(':')[-1]
+
+def __convert__(value, typ):
+    if value==None:
+        return None
+    elif typ in __intTypes__:
+        return int(value)
+    elif typ in __floatTypes__:
+        return float(value)
+    return value
+
+def parseStream(text, delimiter, columns):
+    '''
+    split the contents of a Stream element into rows, returned as dictionaries keyed by column name.
+    columns is a list of (name, type). Quoted values may contain the delimiter and backslash escapes.
+    Empty unquoted values are nulls (None), including one after a delimiter that ends the Stream.
+    Raises ValueError if the values do not fill whole rows
+    '''
+    delimiter = re.escape(delimiter)
+    tokenRegex = re.compile(r'\s*(?:"((?:[^"\\]|\\.)*)"|([^"%s]*?))\s*(%s|\Z)'%(delimiter, delimiter), re.DOTALL)
+
+    text = text.strip()
+    tokens = []
+    pos = 0
+    while pos < len(text):
+        match = tokenRegex.match(text, pos)
+        if match==None:
+            raise ValueError('could not parse Stream near "%s"'%text[pos:pos+50])
+        quoted, raw, sep = match.groups()
+        if quoted!=None:
+            tokens.append( re.sub(r'\\(.)', r'\1', quoted) )
+        elif raw:
+            tokens.append( raw )
+        else:
+            tokens.append( None )
+        pos = match.end()
+        if not sep:
+            break
+    else:
+        if text and sep: ### the Stream ends with a delimiter, so the last value is null
+            tokens.append( None )
+
+    N = len(columns)
+    extra = len(tokens)%N if N else len(tokens)
+    if (extra==1) and (tokens[-1]==None): ### some writers also put a delimiter after the last row
+        tokens.pop()
+    elif extra:
+        raise ValueError('Stream has %d values, which do not fill rows of %d columns'%(len(tokens), N))
+
+    rows = []
+    for i in xrange(0, len(tokens), N):
+        rows.append( dict((name, __convert__(value, typ)) for (name, typ), value in zip(columns, tokens[i:i+N])) )
+    return rows
+
+def readTable(filename, tableName):
+    '''
+    return the rows of tableName in the LIGO_LW document filename as a list of dictionaries.
+    We only parse the document up to the end of this table and never build the rest of it.
+    Raises ValueError if we cannot find the table (the caller can then fall back to a full parse)
+    '''
+    file_obj = openLIGOLW(filename)
+    try:
+        inTable = False
+        columns = []
+        for event, elem in ElementTree.iterparse(file_obj, events=('start', 'end')):
+            if event=='start':
+                if (elem.tag=='Table') and (__tableName__(elem.get('Name', ''))==tableName):
+                    inTable = True
+                    columns = []
+
+            elif inTable:
+                if elem.tag=='Column':
+                    columns.append( (__columnName__(elem.get('Name')), elem.get('Type')) )
+
+                elif elem.tag=='Stream':
+                    return parseStream(elem.text or '', elem.get('Delimiter', ','), columns)
+
+                elif elem.tag=='Table': ### a table without a Stream has no rows
+                    return []
+
+    finally:
+        file_obj.close()
+
+    raise ValueError('could not find table=%s in %s'%(tableName, filename))
@@ -0,0 +1,496 @@
+description = "a parser for the GraceDb event search language that compiles queries into plans FakeDb can evaluate"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import re
+import time
+import calendar
+
+#-------------------------------------------------
+
+### aliases for the attributes that can be named explicitly, eg: "pipeline: gstlal"
+__keywords__ = {'label'       : 'label',
+                'labels'      : 'label',
+                'gid'         : 'graceid',
+                'graceid'     : 'graceid',
+                'gpstime'     : 'gpstime',
+                'gps'         : 'gpstime',
+                'far'         : 'far',
+                'created'     : 'created',
+                'group'       : 'group',
+                'pipeline'    : 'pipeline',
+                'search'      : 'search',
+                'submitter'   : 'submitter',
+                'instruments' : 'instruments',
+                'instrument'  : 'instruments',
+                'ifos'        : 'instruments',
+               }
+
+__numericKeys__ = ['gpstime', 'far', 'created']
+__stringKeys__ = ['group', 'pipeline', 'search', 'submitter'] ### compared case-insensitively
+
+__comparisons__ = ['<', '<=', '>', '>=', '=', '==']
+
+__tokenRegex__ = re.compile(r'''\s*(?:(?P<time>\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2})(?=[\s()|&~,]|\.\.|$)|(?P<op><=|>=|==|<|>|=|\.\.|\(|\)|\||&|~|:|,)|"(?P<dq>[^"]*)"|'(?P<sq>[^']*)'|(?P<word>(?:(?!\.\.)[^\s()|&~<>=:,"'])+))''')
+
+#-------------------------------------------------
+
+def tokenize(query):
+    '''
+    split query into a list of (kind, value) where kind is one of
+        op   : punctuation (parentheses, boolean operators, comparisons, ':', ',' and '..')
+        word : an unquoted string
+        str  : a quoted string, which is never interpreted as a keyword or operator
+    UTC date-times ("YYYY-MM-DD HH:MM:SS" or "YYYY-MM-DDTHH:MM:SS") are a single word even though they contain a space and ':'.
+    A "-" at the start of a token means negation unless it starts a number (eg: "-EM_READY" vs "far > -1")
+    '''
+    tokens = []
+    pos = 0
+    N = len(query)
+    while pos < N:
+        if query[pos].isspace():
+            pos += 1
+            continue
+
+        if (query[pos]=='-') and (pos+1 < N) and not (query[pos+1].isdigit() or query[pos+1]=='.'):
+            tokens.append( ('op', '-') )
+            pos += 1
+            continue
+
+        match = __tokenRegex__.match(query, pos)
+        if (match==None) or (match.end()==pos):
+            raise ValueError('could not parse query near "%s"'%query[pos:])
+
+        if match.group('time')!=None:
+            tokens.append( ('word', match.group('time')) )
+        elif match.group('op')!=None:
+            tokens.append( ('op', match.group('op')) )
+        elif match.group('dq')!=None:
+            tokens.append( ('str', match.group('dq')) )
+        elif match.group('sq')!=None:
+            tokens.append( ('str', match.group('sq')) )
+        else:
+            tokens.append( ('word', match.group('word')) )
+        pos = match.end()
+
+    return tokens
+
+def str2float(value):
+    try:
+        return float(value)
+    except ValueError:
+        raise ValueError('could not interpret "%s" as a number'%value)
+
+def str2time(value):
+    '''
+    interpret value as a unix timestamp. We understand numbers, "now", "today", "yesterday"
+    and UTC dates of the form "YYYY-MM-DD", "YYYY-MM-DD HH:MM:SS"
+    '''
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    if value=='now':
+        return time.time()
+    elif value=='today':
+        return calendar.timegm(time.gmtime()[:3]+(0, 0, 0, 0, 0, 0))
+    elif value=='yesterday':
+        return calendar.timegm(time.gmtime()[:3]+(0, 0, 0, 0, 0, 0)) - 86400
+
+    for fmt in ['%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d']:
+        try:
+            return calendar.timegm(time.strptime(value, fmt))
+        except ValueError:
+            pass
+
+    raise ValueError('could not interpret "%s" as a time'%value)
+
+#-------------------------------------------------
+
+class Node(object):
+    '''
+    a single predicate within a compiled query.
+    index returns the exact set of matching graceids if it can be answered from the engine's indexes, otherwise None.
+    match decides whether a single graceid satisfies the predicate by looking at that event
+    '''
+
+    def index(self, db):
+        return None
+
+    def match(self, db, graceid, cache):
+        raise NotImplementedError
+
+class AllNode(Node):
+    '''
+    matches everything
+    '''
+
+    def match(self, db, graceid, cache):
+        return True
+
+class AndNode(Node):
+
+    def __init__(self, children):
+        self.children = children
+
+    def index(self, db):
+        indexed = []
+        scanned = []
+        for child in self.children:
+            ids = child.index(db)
+            if ids==None:
+                scanned.append( child )
+            else:
+                indexed.append( ids )
+
+        if not indexed: ### nothing narrows down the candidates, so we will have to scan
+            return None
+
+        ids = set.intersection(*indexed)
+        if scanned:
+            cache = dict()
+            ids = set(graceid for graceid in ids if all(child.match(db, graceid, cache) for child in scanned))
+        return ids
+
+    def match(self, db, graceid, cache):
+        return all(child.match(db, graceid, cache) for child in self.children)
+
+class OrNode(Node):
+
+    def __init__(self, children):
+        self.children = children
+
+    def index(self, db):
+        ids = set()
+        for child in self.children:
+            these = child.index(db)
+            if these==None: ### at least one child needs a scan, so we might as well scan for all of them
+                return None
+            ids.update(these)
+        return ids
+
+    def match(self, db, graceid, cache):
+        return any(child.match(db, graceid, cache) for child in self.children)
+
+class NotNode(Node):
+
+    def __init__(self, child):
+        self.child = child
+
+    def index(self, db):
+        ids = self.child.index(db)
+        if ids==None:
+            return None
+        return set(db.__get_all_graceids__()) - ids
+
+    def match(self, db, graceid, cache):
+        return not self.child.match(db, graceid, cache)
+
+class LabelNode(Node):
+
+    def __init__(self, label):
+        self.label = label
+
+    def index(self, db):
+        return set(db.engine.label2graceids(self.label))
+
+    def match(self, db, graceid, cache):
+        key = ('labels', graceid)
+        if not cache.has_key(key):
+            cache[key] = set(label['name'] for label in db.engine.read(graceid, 'labels'))
+        return self.label in cache[key]
+
+class GraceIDNode(Node):
+
+    def __init__(self, graceid):
+        self.graceid = graceid
+
+    def index(self, db):
+        if db.engine.exists(self.graceid):
+            return set([self.graceid])
+        return set()
+
+    def match(self, db, graceid, cache):
+        return graceid==self.graceid
+
+class RangeNode(Node):
+    '''
+    low <= value <= high for a numeric attribute. Either bound may be None and either may be strict
+    '''
+
+    def __init__(self, key, low=None, high=None, lowStrict=False, highStrict=False):
+        self.key = key
+        self.low = low
+        self.high = high
+        self.lowStrict = lowStrict
+        self.highStrict = highStrict
+
+    def __contains__(self, value):
+        if value==None:
+            return False
+        if self.low!=None:
+            if (value < self.low) or (self.lowStrict and value==self.low):
+                return False
+        if self.high!=None:
+            if (value > self.high) or (self.highStrict and value==self.high):
+                return False
+        return True
+
+    def index(self, db):
+        if self.key!='gpstime':
+            return None
+        low = self.low if self.low!=None else -float('inf')
+        high = self.high if self.high!=None else float('inf')
+        return set(graceid for graceid in db.engine.gps2graceids(low, high) if db.engine.graceid2gpstime(graceid) in self)
+
+    def match(self, db, graceid, cache):
+        return db.__meta__(graceid).get(self.key) in self
+
+class EqualsNode(Node):
+    '''
+    a string attribute (group, pipeline, search, submitter) that must equal one of values (case-insensitively)
+    '''
+
+    def __init__(self, key, values):
+        self.key = key
+        self.values = [value.lower() for value in values]
+
+    def index(self, db):
+        ids = set()
+        for value in self.values:
+            these = db.engine.attribute2graceids(self.key, value)
+            if these==None:
+                return None
+            ids.update(these)
+        return ids
+
+    def match(self, db, graceid, cache):
+        value = db.__meta__(graceid).get(self.key)
+        return (value!=None) and (value.lower() in self.values)
+
+class InstrumentsNode(Node):
+    '''
+    events that involve all of the requested instruments
+    '''
+
+    def __init__(self, instruments):
+        self.instruments = set(instruments)
+
+    def match(self, db, graceid, cache):
+        instruments = db.__meta__(graceid).get('instruments') or ''
+        return self.instruments.issubset(instrument.strip() for instrument in instruments.split(','))
+
+#-------------------------------------------------
+
+class Plan(object):
+    '''
+    a compiled query. Call graceids(db) to find the matching events
+    '''
+
+    def __init__(self, query, root):
+        self.query = query
+        self.root = root
+
+    def graceids(self, db):
+        '''
+        returns a sorted list of the graceids that satisfy this query.
+        We use the engine's indexes wherever we can and only scan events (through FakeDb's cached metadata) when we must
+        '''
+        ids = self.root.index(db)
+        if ids==None:
+            cache = dict()
+            ids = [graceid for graceid in db.__get_all_graceids__() if self.root.match(db, graceid, cache)]
+        return sorted(ids)
+
+class QueryParser(object):
+    '''
+    a recursive descent parser for the GraceDb search language
+        expr  : and ( ("|" | "OR") and )*
+        and   : unary ( ["&" | "AND"] unary )*      (adjacent terms are combined with AND)
+        unary : ("-" | "~" | "NOT") unary | "(" expr ")" | term
+        term  : keyword ":" value [".." value]      (eg: "far: 1e-8 .. 1e-6", "pipeline: gstlal,pycbc", "label: EM_READY")
+              | keyword [":"] comparison value      (eg: "far < 1e-7", "created: >= 2017-08-01")
+              | number ".." number                  (a gpstime range)
+              | label | graceid | group | pipeline | search
+
+    isLabel and isGraceid are functions that recognize bare labels and graceids.
+    groups, pipelines and searches are the names we recognize as bare words
+    '''
+
+    def __init__(self, isLabel, isGraceid, groups=[], pipelines=[], searches=[]):
+        self.isLabel = isLabel
+        self.isGraceid = isGraceid
+        self.bare = dict()
+        for key, names in [('group', groups), ('pipeline', pipelines), ('search', searches)]:
+            for name in names:
+                if name:
+                    self.bare.setdefault(name.lower(), key)
+
+    def compile(self, query):
+        '''
+        returns a Plan. Raises ValueError if we cannot parse query
+        '''
+        self.tokens = tokenize(query)
+        self.pos = 0
+        if not self.tokens:
+            return Plan(query, AllNode())
+
+        root = self.__expr__()
+        if self.pos < len(self.tokens):
+            raise ValueError('unexpected "%s"'%self.tokens[self.pos][1])
+        return Plan(query, root)
+
+    ### token utilities ###
+
+    def __peek__(self, offset=0):
+        if self.pos+offset < len(self.tokens):
+            return self.tokens[self.pos+offset]
+        return (None, None)
+
+    def __next__(self):
+        token = self.__peek__()
+        if token[0]==None:
+            raise ValueError('unexpected end of query')
+        self.pos += 1
+        return token
+
+    def __isop__(self, token, *ops):
+        return (token[0]=='op') and (token[1] in ops)
+
+    def __isword__(self, token, *words):
+        return (token[0]=='word') and (token[1] in words)
+
+    def __value__(self):
+        kind, value = self.__next__()
+        if kind=='op':
+            raise ValueError('expected a value but found "%s"'%value)
+        return value
+
+    def __values__(self):
+        '''
+        a comma separated list of values
+        '''
+        values = [self.__value__()]
+        while self.__isop__(self.__peek__(), ','):
+            self.pos += 1
+            values.append( self.__value__() )
+        return values
+
+    ### grammar ###
+
+    def __expr__(self):
+        children = [self.__and__()]
+        while self.__isop__(self.__peek__(), '|') or self.__isword__(self.__peek__(), 'OR'):
+            self.pos += 1
+            children.append( self.__and__() )
+        if len(children)==1:
+            return children[0]
+        return OrNode(children)
+
+    def __and__(self):
+        children = [self.__unary__()]
+        while True:
+            token = self.__peek__()
+            if (token[0]==None) or self.__isop__(token, ')', '|') or self.__isword__(token, 'OR'):
+                break
+            if self.__isop__(token, '&') or self.__isword__(token, 'AND'):
+                self.pos += 1
+            children.append( self.__unary__() )
+        if len(children)==1:
+            return children[0]
+        return AndNode(children)
+
+    def __unary__(self):
+        token = self.__peek__()
+        if self.__isop__(token, '-', '~') or self.__isword__(token, 'NOT'):
+            self.pos += 1
+            return NotNode(self.__unary__())
+
+        elif self.__isop__(token, '('):
+            self.pos += 1
+            node = self.__expr__()
+            if not self.__isop__(self.__next__(), ')'):
+                raise ValueError('unbalanced parentheses')
+            return node
+
+        return self.__term__()
+
+    def __term__(self):
+        kind, value = self.__next__()
+        if kind=='op':
+            raise ValueError('unexpected "%s"'%value)
+
+        following = self.__peek__()
+        if (kind=='word') and __keywords__.has_key(value.lower()) and (self.__isop__(following, ':') or (following[0]=='op' and following[1] in __comparisons__)):
+            return self.__keyword__(__keywords__[value.lower()])
+
+        if self.__isop__(following, '..'): ### "gps .. gps"
+            self.pos += 1
+            return RangeNode('gpstime', low=str2float(value), high=str2float(self.__value__()))
+
+        if self.isLabel(value):
+            return LabelNode(value)
+
+        elif self.isGraceid(value):
+            return GraceIDNode(value)
+
+        elif self.bare.has_key(value.lower()):
+            return EqualsNode(self.bare[value.lower()], [value])
+
+        raise ValueError('"%s" is not a known label, graceid, group, pipeline or search'%value)
+
+    def __keyword__(self, key):
+        if self.__isop__(self.__peek__(), ':'):
+            self.pos += 1
+
+        token = self.__peek__()
+        if (token[0]=='op') and (token[1] in __comparisons__): ### eg: "far < 1e-7"
+            if key not in __numericKeys__:
+                raise ValueError('cannot compare %s with "%s"'%(key, token[1]))
+            self.pos += 1
+            value = self.__number__(key, self.__value__())
+            op = token[1]
+            if op=='<':
+                return RangeNode(key, high=value, highStrict=True)
+            elif op=='<=':
+                return RangeNode(key, high=value)
+            elif op=='>':
+                return RangeNode(key, low=value, lowStrict=True)
+            elif op=='>=':
+                return RangeNode(key, low=value)
+            else:
+                return RangeNode(key, low=value, high=value)
+
+        if key in __numericKeys__: ### "key: value" or "key: low .. high"
+            low = self.__number__(key, self.__value__())
+            if self.__isop__(self.__peek__(), '..'):
+                self.pos += 1
+                return RangeNode(key, low=low, high=self.__number__(key, self.__value__()))
+            return RangeNode(key, low=low, high=low)
+
+        values = self.__values__()
+        if key=='label':
+            for value in values:
+                if not self.isLabel(value):
+                    raise ValueError('label=%s not understood'%value)
+            nodes = [LabelNode(value) for value in values]
+
+        elif key=='graceid':
+            nodes = [GraceIDNode(value) for value in values]
+
+        elif key=='instruments':
+            return InstrumentsNode([instrument.strip() for value in values for instrument in value.split(',') if instrument.strip()])
+
+        else:
+            return EqualsNode(key, values)
+
+        if len(nodes)==1:
+            return nodes[0]
+        return OrNode(nodes)
+
+    def __number__(self, key, value):
+        if key=='created':
+            return str2time(value)
+        return str2float(value)
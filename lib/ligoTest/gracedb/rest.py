@@ -5,14 +5,19 @@ author = "reed.essick@ligo.org"
 
 import os
 import glob
-import shutil
 
 import getpass
 
-import pickle
 import json
+import marshal
+import copy
 
 import time
+import threading
+
+from collections import OrderedDict
+from collections import Mapping
+from collections import Sequence
 
 import numpy as np
 
@@ -22,24 +27,134 @@ from glue.ligolw import table
 from glue.ligolw import lsctables
 
 from ligoTest.lvalert import lvalertTestUtils as lvutils
+from ligoTest.gracedb import engines
+from ligoTest.gracedb import query as gdbquery
+from ligoTest.gracedb import columns
+from ligoTest.gracedb import ligolwStream
+from ligoTest.gracedb import footprints as fp
+from ligoTest.gracedb import voevent as voe
 
 #-------------------------------------------------
 
+def copyPayload(data):
+    '''
+    a deep copy of a json-like payload. marshal is much faster than either copy.deepcopy or a json round-trip,
+    but only understands builtin types so we fall back to copy.deepcopy for anything else
+    '''
+    try:
+        return marshal.loads( marshal.dumps(data) )
+    except ValueError: ### unmarshallable object
+        return copy.deepcopy(data)
+
+def readonlyView(data):
+    '''
+    wraps dictionaries and lists so that they cannot be modified. Anything else is returned as is
+    '''
+    if isinstance(data, dict):
+        return ReadOnlyDict(data)
+    elif isinstance(data, list):
+        return ReadOnlyList(data)
+    else:
+        return data
+
+def unwrapView(obj):
+    '''
+    used as json.dumps(..., default=unwrapView) so that read-only views can be serialized
+    '''
+    if isinstance(obj, (ReadOnlyDict, ReadOnlyList)):
+        return obj.__data__
+    raise TypeError('%s is not JSON serializable'%repr(obj))
+
+class ReadOnlyDict(Mapping):
+    '''
+    a read-only view of a dictionary. Nested dictionaries and lists are wrapped as they are accessed
+    '''
+
+    def __init__(self, data):
+        self.__data__ = data
+
+    def __getitem__(self, key):
+        return readonlyView( self.__data__[key] )
+
+    def __iter__(self):
+        return iter(self.__data__)
+
+    def __len__(self):
+        return len(self.__data__)
+
+    def __repr__(self):
+        return repr(self.__data__)
+
+    def has_key(self, key):
+        return self.__data__.has_key(key)
+
+    def copy(self):
+        '''a modifiable deep copy'''
+        return copyPayload(self.__data__)
+
+class ReadOnlyList(Sequence):
+    '''
+    a read-only view of a list. Nested dictionaries and lists are wrapped as they are accessed
+    '''
+
+    def __init__(self, data):
+        self.__data__ = data
+
+    def __getitem__(self, ind):
+        if isinstance(ind, slice):
+            return ReadOnlyList( self.__data__[ind] )
+        return readonlyView( self.__data__[ind] )
+
+    def __len__(self):
+        return len(self.__data__)
+
+    def __repr__(self):
+        return repr(self.__data__)
+
+    def copy(self):
+        '''a modifiable deep copy'''
+        return copyPayload(self.__data__)
+
 class FakeTTPResponse():
     """
     a "fake" httpResponse that provides some basic functionality
+
+    we keep the Python object and only serialize it if read() is called, so json() does not pay for a json round-trip.
+    json() returns a copy of the payload, or a read-only view of it if readonly=True.
+    Either way the values keep FakeDb's Python types, which json.loads would not produce: strings are str rather than unicode,
+    tuples are not turned into lists and dictionary keys are not turned into strings. Pass exact=True (or set FakeTTPResponse.exact)
+    to pay for the json round-trip and get exactly what GraceDb's json() returns.
+    Like a real httpResponse, the payload can only be consumed once. After that read() returns an empty string
     """
+    readonly = False ### default used when readonly is not specified
+    exact = False ### default used when exact is not specified
 
-    def __init__(self, data):
-        self.data = json.dumps( data )
+    def __init__(self, data, readonly=None, exact=None):
+        self.data = data
+        self.consumed = False
+        if readonly!=None:
+            self.readonly = readonly
+        if exact!=None:
+            self.exact = exact
 
     def read(self):
-        ans = self.data
-        self.data = ''
+        if self.consumed:
+            return ''
+        ans = json.dumps( self.data, default=unwrapView )
+        self.consumed = True
+        self.data = None
         return ans
 
     def json(self):
-        return json.loads( self.read() )
+        if self.consumed or self.exact: ### behaves like json.loads on an empty response
+            return json.loads( self.read() )
+        data = self.data
+        self.consumed = True
+        self.data = None
+        if self.readonly:
+            return readonlyView( data )
+        else:
+            return copyPayload( data )
 
 class FakeTTPError(Exception):
     """
@@ -273,6 +388,19 @@ class FakeDb():
                            'ADVOK', 'ADVNO',
                           ]
 
+    ### top-level attributes that never change once an event is created, cached by __meta__
+    __immutableKeys__ = ['graceid', 'group', 'pipeline', 'search', 'gpstime', 'far', 'instruments', 'created', 'submitter', 'offline']
+    __metaCacheSize__ = 4096 ### the number of events whose metadata we remember
+    __planCacheSize__ = 256 ### the number of compiled queries we remember
+    __attachmentsCacheSize__ = 1024 ### the number of events whose attachments we remember, see __attachments__
+
+    ### attributes extracted from uploaded files, keyed by (pipeline, sha256 of the file).
+    ### Shared by every FakeDb in this process so that repeated or replayed uploads skip parsing
+    __extraAttributesCache__ = OrderedDict()
+    __extraAttributesCacheSize__ = 1024
+    __extraAttributesCacheLock__ = threading.Lock() ### FakeDbs in different threads share the cache
+    fastExtraAttributes = True ### use ligolwStream for coinc documents instead of loading them with glue.ligolw
+
     @property
     def groups(self):
         return self.__allowedGroupPipelineSearch__.keys()
@@ -340,32 +468,119 @@ class FakeDb():
 
     ### basic instantiation ###
 
-    def __init__(self, directory='.'):
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+    def __init__(self, directory='.', lvalertFlushEvery=1, lvalertFlushInterval=None, attachMode='copy', columnar=False, layout=None):
+        '''
+        lvalert messages are buffered and written to self.lvalert after every lvalertFlushEvery messages
+        and/or lvalertFlushInterval seconds after they were sent. Call flush() or close() to write whatever is left
+
+        uploaded files are stored according to attachMode (copy, hardlink, reflink or symlink; see engines.attachFile)
+        or deduplicated into a content-addressed store shared by all events (dedup; see engines.BlobStore)
+
+        if columnar, we keep top-level attributes of every event in a columns.EventTable and answer queries with vectorized masks.
+        The table is updated as this FakeDb writes events, but writes from other processes are only seen after eventTable(refresh=True)
+
+        layout (flat or sharded) only applies to directories and is fixed when the database is created (see engines.DirectoryEngine).
+        None means we use whatever layout the directory already has (flat for new directories)
+        '''
+        if attachMode not in engines.attachModes:
+            raise ValueError('attachMode=%s not understood. Must be one of : %s'%(attachMode, ', '.join(engines.attachModes)))
+        self.engine = engines.initEngine(directory, layout=layout) ### decides how we store things based on the scheme of directory
+        self.engine.lvalertPolicy = {'flushEvery':lvalertFlushEvery, 'flushInterval':lvalertFlushInterval}
+        self.engine.attachMode = attachMode
         self.service_url = directory
-        self.lvalert = os.path.join(directory, 'lvalert.out') ### file into which we write lvalert messages
+        self.lvalert = self.engine.lvalert ### file into which we write lvalert messages
+
+        self.__metaCache__ = OrderedDict() ### graceid -> (stamp, metadata), least recently used first
+        self.__planCache__ = OrderedDict() ### query -> gdbquery.Plan, least recently used first
+        self.__attachmentsCache__ = OrderedDict() ### graceid -> (number of files seen, basename -> path, most recent FITS file)
+        self.__cacheLock__ = threading.Lock() ### guards the caches above, since AsyncFakeDb calls us from several threads at once
+
+        self.__table__ = None ### columns.EventTable, only built if requested
+        if columnar:
+            self.eventTable()
 
     ### write lvalert messages into a file ###
 
     def sendlvalert(self, message, node ):
-        file_obj = open(self.lvalert, 'a')
-        print >> file_obj, lvutils.alert2line(node, json.dumps(message))
-        file_obj.close()
+        self.engine.sendlvalert( lvutils.alert2line(node, json.dumps(message)) )
+
+    def flush(self):
+        '''
+        write any buffered lvalert messages
+        '''
+        self.engine.flush()
+
+    def close(self):
+        '''
+        write buffered lvalert messages and release anything held by the storage engine (eg: database connections)
+        '''
+        self.engine.close()
 
     ### simulate get(...) according to GraceDb.get()
     def get(self, url):
         '''
         Returns the content of pickle file as a FakeTTPResponse
         '''
-        content = self.__extract__(url)
+        content = self.engine.get(url)
         return FakeTTPResponse(content)
         
+    def eventTable(self, refresh=False):
+        '''
+        a columns.EventTable of all events, which is built on the first call (or if refresh) and then kept up to date
+        as this FakeDb creates and labels events. Once built, events() and numEvents() use it to answer queries
+        '''
+        if (self.__table__==None) or refresh:
+            table = columns.EventTable()
+            for graceid in self.__get_all_graceids__():
+                labels = [label['name'] for label in self.engine.read(graceid, 'labels')]
+                table.add(self.__meta__(graceid), labels=labels)
+            self.__table__ = table
+        return self.__table__
+
+    def __labelTable__(self, graceid, label):
+        '''
+        record a label we just applied in our EventTable, if we built one. Events created by other writers (or processes)
+        do not have a row yet, so we add one from the engine, which already has this label
+        '''
+        if self.__table__==None:
+            return
+        if self.__table__.rows.has_key(graceid):
+            self.__table__.label(graceid, label)
+        else:
+            self.__table__.add(self.__meta__(graceid), labels=[entry['name'] for entry in self.engine.read(graceid, 'labels')])
+
+    def __meta__(self, graceid):
+        '''
+        returns the immutable top-level attributes (see __immutableKeys__) for this graceid.
+        These are cached in an LRU and only re-read if the engine's stamp for this event changes
+        (for the default engine that is the directory's mtime, so we notice events replaced by other processes).
+        raises FakeTTPError if graceid does not exist
+        '''
+        stamp = self.engine.stamp(graceid)
+        if stamp==None:
+            raise FakeTTPError('could not find graceid=%s'%graceid)
+
+        with self.__cacheLock__:
+            cachedStamp, meta = self.__metaCache__.pop(graceid, (None, None)) ### re-inserted below so it becomes the most recently used
+        if cachedStamp!=stamp:
+            meta = None
+
+        if meta==None: ### not cached or stale
+            topLevel = self.engine.read(graceid, 'toplevel')
+            meta = dict( (key, topLevel[key]) for key in self.__immutableKeys__ if topLevel.has_key(key) )
+
+        with self.__cacheLock__:
+            self.__metaCache__[graceid] = (stamp, meta)
+            while len(self.__metaCache__) > self.__metaCacheSize__:
+                self.__metaCache__.popitem(last=False)
+
+        return meta
+
     def __node__(self, graceid):
         '''
         figures out the node name given a graceid
         '''
-        event = self.event(graceid).json() ### load in the parameters
+        event = self.__meta__(graceid) ### load in the parameters
 
         return "%s_%s_%s"%(event['group'], event['pipeline'], event['search']) if event.has_key('search') else "%s_%s"%(event['group'], event['pipeline'])
                 
@@ -386,13 +601,20 @@ class FakeDb():
             raise FakeTTPError('label=%s not allowed'%label)
 
     def check_graceid(self, graceid):
-        if not os.path.exists(self.__directory__(graceid)):
-            raise FakeTTPError('could not find graceid=%s'%graceid)
+        self.__meta__(graceid) ### raises FakeTTPError if we could not find graceid
 
     def check_signoff(self, signoff):
         if signoff not in self.__allowedSignoffs__:
             raise FakeTTPError('signoff=%s not allowed'%signoff)
 
+    def check_em_group(self, group):
+        if group not in self.__allowedEMGroups__:
+            raise FakeTTPError('EM group=%s not allowed'%group)
+
+    def check_waveband(self, waveband):
+        if not self.__allowedWavebands__.has_key(waveband):
+            raise FakeTTPError('waveband=%s not allowed'%waveband)
+
     ### generic utils and data management ###
 
     def __is_label__(self, label):
@@ -411,119 +633,57 @@ class FakeDb():
             return False
 
     def __get_all_graceids__(self):
-        graceids = []
-        for path in os.listdir(self.service_url):
-            path = os.path.basename(path)
-            if self.__is_graceid__(path):
-                graceids.append( path )
-        return graceids
+        return self.engine.graceids()
 
     def __genGraceID__(self, group):
         '''
-        looks up the known GraceIDs within the directory.
-        returns the biggest one +1
-        if none exist, starts at 000000
+        allocates the next GraceID for this group. The engine guarantees we never hand out the same GraceID twice
         '''
-        existing = [int(graceid[1:]) for graceid in self.__get_all_graceids__()]
-        if existing:
-            ind = max(existing)+1
-        else:
-            ind = 0
-
-        return "%s%06d"%(self.__group2letter__[group], ind)
+        return self.engine.genGraceID(self.__group2letter__[group])
             
     def __directory__(self, graceid):
         '''
         generates the directory associated with this graceid
         '''
-        return os.path.join(self.service_url, graceid)
+        return self.engine.link(graceid)
 
     def __topLevelPath__(self, graceid):
-        return os.path.join(self.service_url, graceid, 'toplevel.pkl')
+        return self.engine.link(graceid, 'toplevel')
 
     def __filesPath__(self, graceid):
-        return os.path.join(self.service_url, graceid, 'files.pkl')
+        return self.engine.link(graceid, 'files')
 
     def __labelsPath__(self, graceid):
-        return os.path.join(self.service_url, graceid, 'labels.pkl')
+        return self.engine.link(graceid, 'labels')
 
     def __signoffsPath__(self, graceid):
-        return os.path.join(self.service_url, graceid, 'signoffs.pkl')
+        return self.engine.link(graceid, 'signoffs')
 
     def __logsPath__(self, graceid):
-        return os.path.join(self.service_url, graceid, 'logs.pkl')
+        return self.engine.link(graceid, 'logs')
 
     def __voeventsPath__(self, graceid):
-        return os.path.join(self.service_url, graceid, 'voevents.pkl')
-
-    def __path2len__(self, path):
-        return len(self.__extract__(path))
-
-    def __append__(self, stuff, path):
-        '''append to pkl file'''
-        ans = self.__extract__(path)
-        ans.append(stuff)
-        self.__write__(ans, path)
+        return self.engine.link(graceid, 'voevents')
 
-        return len(ans)-1
+    def __eelsPath__(self, graceid):
+        return self.engine.link(graceid, 'eels')
 
-    def __write__(self, stuff, path):
-        '''write stuff into pkl file'''
-        file_obj = open(path, 'w')
-        pickle.dump(stuff, file_obj)
-        file_obj.close()
-
-    def __extract__(self, path):
-        '''read from pkl file'''
-        file_obj = open(path, 'r')
-        ans = pickle.load(file_obj)
-        file_obj.close()
-
-        return ans
-        
-    def __signOffappend__( self, signoffObject, path ):
-        '''append signoffObject to signoff key'''
-        content  = self.__extract__(path) # this returns a dictionary
-        listofSignoffs = content.get('signoff')
-        listofSignoffs.append(signoffObject)
-        self.__write__(content, path)
+    def __emobservationsPath__(self, graceid):
+        return self.engine.link(graceid, 'emobservations')
 
     def __createDirectory__(self, graceid):
         '''
         generate local data structure for this graceid
         '''
-        d = self.__directory__(graceid)
-        if os.path.exists(d):
-            raise ValueError('graceid=%s already exists!'%graceid)
-        else:
-            os.makedirs(d) ### make directory
-            ### touch a bunch of files to make sure they exist
-            paths = [self.__filesPath__(graceid), 
-                     self.__labelsPath__(graceid), 
-                     self.__logsPath__(graceid),
-                     self.__voeventsPath__(graceid),
-                    ]
-            for path in paths:
-                file_obj = open(path, 'w')
-                pickle.dump([], file_obj)
-                file_obj.close()
-            # make signoffs.pkl file which is a DICTIONARY not a list!
-            file_obj = open(self.__signoffsPath__(graceid), 'w')
-            signoffDict = {'numRows': None,
-                           'start'  : None,
-                           'signoff': [],
-                           'links'  : None
-                          }
-            pickle.dump(signoffDict, file_obj)
-            file_obj.close()
+        self.engine.create(graceid) ### raises ValueError if graceid already exists
+        self.engine.write(graceid, 'signoffs', dict()) ### (signoff_type, instrument) -> current signoff, see StorageEngine.setSignoff
 
     def __newfilename__(self, graceid, filename):
-        return os.path.join(self.service_url, graceid, os.path.basename(filename))
+        return self.engine.filename(graceid, filename)
 
     def __copyFile__(self, graceid, filename):
-        newFilename = self.__newfilename__(graceid, filename)
-        shutil.copyfile(filename, newFilename)
-        self.__append__( newFilename, self.__filesPath__(graceid) )
+        newFilename = self.engine.attach(graceid, filename)
+        self.engine.append(graceid, 'files', newFilename)
 
     ### insertion ###
 
@@ -535,7 +695,7 @@ class FakeDb():
                  'pipeline':pipeline,
                  'created':time.time(),
                  'submitter':getpass.getuser()+'@ligo.org',
-                 'labels' : dict((label, labelsPath) for label in self.__extract__(self.__labelsPath__(graceid))), ### NOTE: this is overkill for now, but we may want to support labeling during event creation, at which point we will want to perform this query.
+                 'labels' : dict((label, labelsPath) for label in self.engine.read(graceid, 'labels')), ### NOTE: this is overkill for now, but we may want to support labeling during event creation, at which point we will want to perform this query.
                  'links': {'neighbors':'',
                            'files':self.__filesPath__(graceid),
                            'log':self.__logsPath__(graceid),
@@ -554,7 +714,7 @@ class FakeDb():
         jsonD.update( self.__file2extraattributes__(pipeline, filename) )
          
         ### write top level data to file 
-        self.__write__( jsonD, self.__topLevelPath__(graceid) )
+        self.engine.write( graceid, 'toplevel', jsonD ) ### also indexes the gpstime
 
         lvalert = {"alert_type": "new",
                    "description": "",
@@ -566,6 +726,23 @@ class FakeDb():
         return jsonD, lvalert
 
     def __file2extraattributes__(self, pipeline, filename):
+        '''
+        the attributes we extract from an uploaded file, remembered by the file's sha256 so identical uploads are only parsed once
+        '''
+        key = (pipeline.lower(), engines.fileDigest(filename))
+        with self.__extraAttributesCacheLock__:
+            ans = self.__extraAttributesCache__.pop(key, None)
+        if ans==None: ### parse outside the lock so other threads are not held up
+            ans = self.__parseextraattributes__(pipeline, filename)
+
+        with self.__extraAttributesCacheLock__:
+            self.__extraAttributesCache__[key] = ans
+            while len(self.__extraAttributesCache__) > self.__extraAttributesCacheSize__:
+                self.__extraAttributesCache__.popitem(last=False)
+
+        return copy.deepcopy(ans) ### callers put this into events, so they must not share it
+
+    def __parseextraattributes__(self, pipeline, filename):
         if pipeline.lower() == 'cwb':
             file_obj = open(filename, 'r')
             ans = {'extra_attributes':{
@@ -576,23 +753,29 @@ class FakeDb():
 
             readme = False
             for line in file_obj:
-                try:
-                    key, val = line.split(':')
+                fields = line.split(':')
+                if len(fields)==2: ### a "key: value" line
+                    key, val = fields
                     key = key.strip()
-                    if key == "likelihood":
-                        ans['likelihood'] = float(val.strip())
-                    elif key == 'time':
-                        ans['gpstime'] = float(val.split()[0].strip())
-                    elif key == 'ifo':
-                        ans['instruments'] = ",".join(val.split())
-                except:
-                    if readme:
-                        fields = [float(_) for _ in line.strip().split()]
-                        ans['far'] = fields[1]
-                        break
-                    
-                    readme = "significance based on " in line ### next line is a FAR statement
-                        
+                    try:
+                        if key == "likelihood":
+                            ans['likelihood'] = float(val.strip())
+                        elif key == 'time':
+                            ans['gpstime'] = float(val.split()[0].strip())
+                        elif key == 'ifo':
+                            ans['instruments'] = ",".join(val.split())
+                        continue
+                    except (ValueError, IndexError): ### not a value we understand, so treat it like any other line
+                        pass
+
+                if readme:
+                    fields = [float(_) for _ in line.strip().split()]
+                    ans['far'] = fields[1]
+                    break
+
+                readme = "significance based on " in line ### next line is a FAR statement
+            file_obj.close()
+
         elif pipeline.lower() == 'lib':
             file_obj = open(filename, 'r')
             a = json.loads( file_obj.read() )
@@ -639,16 +822,26 @@ class FakeDb():
                   }
 
         elif pipeline in ['gstlal', 'gstlal-spiir', 'mbtaonline', 'pycbc']:
-            xmldoc = ligolw_utils.load_filename(filename, contenthandler=lsctables.use_in(ligolw.LIGOLWContentHandler))
+            coinc = None
+            if self.fastExtraAttributes: ### only read as far as the coinc_inspiral table
+                try:
+                    coinc = [(row['false_alarm_rate'], row['ifos'], row['end_time'], row['end_time_ns']) for row in ligolwStream.readTable(filename, 'coinc_inspiral')]
+                except (ValueError, KeyError, SyntaxError): ### something we do not understand (SyntaxError includes xml parse errors), so fall back to glue
+                    coinc = None
+                if not coinc: ### no rows is not something we understand either
+                    coinc = None
+
+            if coinc==None:
+                xmldoc = ligolw_utils.load_filename(filename, contenthandler=lsctables.use_in(ligolw.LIGOLWContentHandler))
 
-            ### extract table
-            coinc = table.get_table(xmldoc, lsctables.CoincInspiralTable.tableName)
+                ### extract table
+                coinc = [(row.false_alarm_rate, row.ifos, row.end_time, row.end_time_ns) for row in table.get_table(xmldoc, lsctables.CoincInspiralTable.tableName)]
 
             ### fill in ans with
-            for row in coinc:
-                ans = {'far' : row.false_alarm_rate,
-                       'instruments' : row.ifos,
-                       'gpstime'     : row.end_time + 1e-9*row.end_time_ns,
+            for far, ifos, end_time, end_time_ns in coinc:
+                ans = {'far' : far,
+                       'instruments' : ifos,
+                       'gpstime'     : end_time + 1e-9*end_time_ns,
                        'extra_attributes': {
                                            },
                       }
@@ -671,6 +864,8 @@ class FakeDb():
 
         ### write top level data
         jsonD, lvalert = self.__createEvent__( graceid, group, pipeline, filename, search=search, offline=offline)
+        if self.__table__!=None:
+            self.__table__.add(jsonD)
         self.sendlvalert( lvalert, self.__node__(graceid) )
 
         ### write filename to local
@@ -688,22 +883,30 @@ class FakeDb():
         else:
             shortFilename = ''
 
-        ind = self.__path2len__(self.__logsPath__(graceid))
-        jsonD = {'comment': message,
-                 'created': time.time(),
-                 'self': self.__logsPath__(graceid),
-                 'file_version': 0,  
-                 'filename': shortFilename,
-                 'tag_names': tagname,
-                 'file': '',
-                 'N': ind+1,  
-                 'tags': '',
-                 'issuer': {'username': username+'@LIGO.ORG',
-                            'display_name': username,
-                           },
-                }
+        tags = self.__tagnames__(tagname)
+        for tag in tags: ### before we write anything
+            self.check_tagname(tag)
+
+        with self.engine.lock(graceid): ### hold the lock so N matches where this log actually ends up
+            ind = self.engine.count(graceid, 'logs')
+            jsonD = {'comment': message,
+                     'created': time.time(),
+                     'self': self.__logsPath__(graceid),
+                     'file_version': 0,  
+                     'filename': shortFilename,
+                     'tag_names': tagname,
+                     'file': '',
+                     'N': ind+1,  
+                     'tags': '',
+                     'issuer': {'username': username+'@LIGO.ORG',
+                                'display_name': username,
+                               },
+                    }
+
+            ind = self.engine.append( graceid, 'logs', jsonD ) ### gives the same number as self.engine.count(graceid, 'logs')
+            for tag in tags: ### keep the tag index in sync so nobody has to scan tag_names
+                self.engine.addTag( graceid, ind+1, tag )
 
-        ind = self.__append__( jsonD, self.__logsPath__(graceid)) ### should give the same number as self.__path2len__(self.__logsPath(graceid))+1
         if filename:
             self.__copyFile__(graceid, filename)
 
@@ -756,7 +959,8 @@ class FakeDb():
                   }
 
         self.writeLog( graceid, 'applying label : %s'%label )
-        self.__append__( jsonD, self.__labelsPath__(graceid) )
+        self.engine.append( graceid, 'labels', jsonD ) ### also indexes the label
+        self.__labelTable__(graceid, jsonD['name'])
 
         return jsonD, lvalert
 
@@ -774,7 +978,12 @@ class FakeDb():
 
         raise NotImplementedError('this is not implemented in the real GraceDb, so we do not implement it here. At least, not yet.')
 
-    def __signoff__(self, graceid, instrument, signoff_type, status ):
+    def __signoff__(self, graceid, instrument, signoff_type, status, update=False):
+        '''
+        make this graceid's current signoff for (signoff_type, instrument). If update, there must already be one to replace.
+        The label (eg: H1OK) is only applied when the status changes, so repeating a signoff does not pile up labels,
+        and it replaces the label from the previous status (eg: H1NO) so label queries agree with signoffs
+        '''
         signoff = '{0}{1}'.format(instrument, status) if instrument else '{0}{1}'.format(signoff_type, status)
         jsonD = {'self':self.__labelsPath__(graceid),
                  'creator':getpass.getuser(),
@@ -793,10 +1002,30 @@ class FakeDb():
                    'object': signoffObject,
                    'file':'',
                   }
-        
-        self.writeLog( graceid, 'applying label from signoff : %s'%signoff )
-        self.__append__( jsonD, self.__labelsPath__(graceid) )
-        self.__signOffappend__( signoffObject, self.__signoffsPath__(graceid) )
+
+        with self.engine.lock(graceid): ### other processes may be signing off on this event too
+            if update and (not self.engine.signoffs(graceid).has_key((signoff_type, instrument or ''))):
+                raise FakeTTPError('could not find signoff_type=%s instrument=%s for graceid=%s'%(signoff_type, instrument, graceid))
+            previous = self.engine.setSignoff( graceid, signoffObject )
+
+            changed = (previous==None) or (previous['status']!=status)
+            removed = None
+            if changed:
+                if previous!=None: ### the label from the signoff we replaced no longer applies
+                    old = '{0}{1}'.format(instrument, previous['status']) if instrument else '{0}{1}'.format(signoff_type, previous['status'])
+                    if self.engine.removeLabel( graceid, old ):
+                        removed = old
+                self.engine.append( graceid, 'labels', jsonD ) ### also indexes the label
+
+        if not changed:
+            self.writeLog( graceid, 'signoff unchanged : %s'%signoff )
+        else:
+            if removed!=None:
+                self.writeLog( graceid, 'removing label from signoff : %s'%removed )
+                if self.__table__!=None:
+                    self.__table__.unlabel(graceid, removed)
+            self.writeLog( graceid, 'applying label from signoff : %s'%signoff )
+            self.__labelTable__(graceid, jsonD['name'])
 
         return jsonD, lvalert
 
@@ -809,111 +1038,182 @@ class FakeDb():
         self.sendlvalert( lvalert, self.__node__(graceid) )
         return FakeTTPResponse(jsonD)
 
+    def updateSignoff(self, graceid, instrument, signoff_type, status):
+        '''
+        like writeSignoff, but graceid must already have a signoff for (signoff_type, instrument)
+        '''
+        signoff = '{0}{1}'.format(instrument, status) if instrument else '{0}{1}'.format(signoff_type, status)
+        self.check_graceid(graceid)
+        self.check_signoff( signoff )
+
+        jsonD, lvalert = self.__signoff__( graceid, instrument, signoff_type, status, update=True )
+        self.sendlvalert( lvalert, self.__node__(graceid) )
+        return FakeTTPResponse(jsonD)
+
     ### queries ###
 
-    def events(self, query=None, orderby=None, count=None, columns=None):
+    def events(self, query=None, orderby=None, count=None, columns=None, start=0):
+        """
+        query uses the GraceDb search syntax (see ligoTest.gracedb.query.QueryParser), eg:
+            "EM_READY 1177672330 .. 1177672360"
+            "far < 1e-7 pipeline: gstlal,pycbc -DQV"
+            "(group: CBC | group: Burst) created: 2017-08-01 .. now instruments: H1,L1"
+        adjacent terms must all be satisfied, "|" means either and "-" negates the following term
+
+        orderby : a comma separated list (or a list) of attributes from __orderbyKeys__. Prefix an attribute with "-" to sort in descending order
+        count   : the maximum number of events to return. We stop reading events once we have this many
+        start   : skip this many events (in the order given by orderby) before the ones we return
+        columns : a comma separated list (or a list) of attributes. Only these are included in each event and we only read what we need to produce them
+
+        events are generated lazily, so paging through many events only ever holds one of them in memory
         """
-        WARNING: we only support limitted syntax for these queries at this time. Specifically, we support three types of clauses that can be supplied in any order
-            graceid's
-            labels
-            gpsstart .. gpsstop
+        columns = self.__parsecolumns__(columns)
+        for graceid in self.__page__(self.__ordered__(query, orderby), start, count):
+            yield self.__project__(graceid, columns)
 
-        eg: "ADVNO 1177672330 .. 1177672360"
+    def eventsPage(self, query=None, orderby=None, start=0, count=None, columns=None):
+        """
+        returns (the number of events that satisfy query, a list of the events selected by start and count) like
+        (numEvents(query), list(events(query, orderby, count, columns, start))), but only runs query once
+        """
+        columns = self.__parsecolumns__(columns)
+        graceids = self.__ordered__(query, orderby)
+        return len(graceids), [self.__project__(graceid, columns) for graceid in self.__page__(graceids, start, count)]
 
-        NOTE: we only support query!=None at this time (we require orderby=count=columns=None but keep these kwargs present for consistency with ligo.gracedb.rest.GraceDb)
+    def __ordered__(self, query, orderby):
+        '''
+        the graceids that satisfy query, sorted by orderby
+        '''
+        orderby = self.__parseorderby__(orderby)
+        events = self.__query__(query)
 
-        more complete syntatic coverage may be available via sqlparse (https://sqlparse.readthedocs.io/en/latest/)
-        """
-        assert (orderby==None) and (count==None) and (columns==None), 'FakeDb.events only supports orderby=None, count=None, columns=None at this time!'
-
-        if query: ### downselect events
-            labels = []
-            graceids = []
-            gpstimes = []
-            bits = query.split()
-            N = len(bits)
-            i = 0
-            while i < N:
-                bit = bits[i]
-                try: ### interpret as the first part of a "gps .. gps" clause
-                    gpsstart = float(bit)
-                    if (i<N-2) and (bits[i+1]=='..'):
-                        gpsstop = float(bits[i+2])
-                    else:
-                        raise FakeTTPError('Invalid query: could not parse "gps .. gps" clause')
-                    gpstimes.append( (gpsstart, gpsstop) )
-                    i += 3
-
-                except ValueError as e: ### check to see if this is a label or a GraceId
-                    if self.__is_label__(bit): ### this is a known label
-                        labels.append( bit )
-
-                    elif self.__is_graceid__(bit): ### is a graceid
-                        graceids.append(bit)
-
-                    else:
-                        raise FakeTTPError('Invalid query: query contained an invalid label or graceid')
-                    i += 1
-
-            if graceids: ### check if users sepecified graceids
-                if len(graceids)==1:
-                    try:
-                        self.check_graceid(graceids[0])
-                        events = graceids
-                    except FakeTTPError as e: ### could not find this event
-                        events = [] 
-                else:
-                    events = [] ### more than one graceid, must return an empty list
-            else:
-                events = self.__get_all_graceids__() ### just grab all events
-                                                     ### FIXME: downselecting based on this may not scale well
-
-            if labels: ### check if users specified labels
-                retained = []
-                for label in labels:
-                    for graceid in events:
-                        these_labels = [d['name'] for d in self.labels(graceid).json()['labels']]
-                        if label in these_labels:
-                            retained.append( graceid )
-                events = retained
-
-            if gpstimes: ### check if users specified gpstimes
-                retained = []
-                for gpsstart, gpsstop in gpstimes:
-                    for graceid in events:
-                        gpstime = self.__extract__(self.__topLevelPath__(graceid))['gpstime']
-                        if (gpsstart<=gpstime) and (gpstime<=gpsstop):
-                            retained.append( graceid )
-                events = retained
-                
-        else: ### return all events
-            events = self.__get_all_graceids__()
+        if orderby: ### only sort keys are loaded here (through __meta__), full events are read as we yield them
+            for key, reverse in orderby[::-1]: ### sorts are stable, so applying the least significant key first gives a lexicographic order
+                events = sorted(events, key=lambda graceid: self.__meta__(graceid).get(key), reverse=reverse)
+
+        return events
+
+    def __page__(self, graceids, start, count):
+        start = int(start or 0)
+        if count!=None:
+            return graceids[start:start+int(count)]
+        return graceids[start:]
+
+    def __plan__(self, query):
+        '''
+        compile query into a gdbquery.Plan, remembering the most recent plans because consumers tend to repeat the same queries
+        '''
+        with self.__cacheLock__:
+            plan = self.__planCache__.pop(query, None)
+
+        if plan==None:
+            allowed = self.__allowedGroupPipelineSearch__
+            parser = gdbquery.QueryParser(
+                self.__is_label__,
+                self.__is_graceid__,
+                groups=allowed.keys(),
+                pipelines=set(pipeline for group in allowed.values() for pipeline in group.keys()),
+                searches=set(search for group in allowed.values() for pipelines in group.values() for search in pipelines),
+            )
+            try:
+                plan = parser.compile(query)
+            except ValueError as e:
+                raise FakeTTPError('Invalid query: %s'%e.message)
+
+        with self.__cacheLock__:
+            self.__planCache__[query] = plan
+            while len(self.__planCache__) > self.__planCacheSize__:
+                self.__planCache__.popitem(last=False)
+
+        return plan
+
+    def __query__(self, query=None):
+        '''
+        the graceids that satisfy query. We only look at the events themselves if the engine's indexes cannot answer query
+        '''
+        if not query:
+            return self.__get_all_graceids__()
+        elif self.__table__!=None:
+            return self.__table__.select(self.__plan__(query))
+        return self.__plan__(query).graceids(self)
+
+    __orderbyKeys__ = ['gpstime', 'created', 'far', 'graceid']
+
+    def __parseorderby__(self, orderby):
+        '''
+        returns a list of (key, reverse)
+        '''
+        if not orderby:
+            return []
+        if isinstance(orderby, basestring):
+            orderby = orderby.split(',')
+
+        ans = []
+        for key in orderby:
+            key = key.strip()
+            reverse = key.startswith('-')
+            key = key.strip('-+')
+            if key not in self.__orderbyKeys__:
+                raise FakeTTPError('Invalid orderby: %s. Must be one of : %s'%(key, ', '.join(self.__orderbyKeys__)))
+            ans.append( (key, reverse) )
+        return ans
 
-        ### FIXME: we should modify events to account for orderby, count here
+    def __parsecolumns__(self, columns):
+        if not columns:
+            return None
+        if isinstance(columns, basestring):
+            columns = columns.split(',')
+        return [column.strip() for column in columns if column.strip()]
 
-        for graceid in events:
-            topLevel = self.event(graceid).json()
+    def __project__(self, graceid, columns=None):
+        '''
+        the top-level attributes for graceid, restricted to columns.
+        We only read labels if they are requested and only read toplevel if we ask for something outside of __immutableKeys__
+        '''
+        if columns==None:
+            return self.event(graceid).json()
 
-            ### FIXME: incorporate columns here
+        if all(column in self.__immutableKeys__ for column in columns):
+            topLevel = self.__meta__(graceid)
+        else:
+            topLevel = self.engine.read( graceid, 'toplevel' )
 
-            yield topLevel
+        if 'labels' in columns:
+            topLevel['labels'] = dict( (label['name'], label['self']) for label in self.engine.read( graceid, 'labels' ) )
+
+        return dict( (column, topLevel[column]) for column in columns if topLevel.has_key(column) )
 
 
     def event(self, graceid):
         self.check_graceid(graceid)
 
-        topLevel = self.__extract__( self.__topLevelPath__(graceid) )
-        topLevel.update( {'labels':dict( (label['name'], label['self']) for label in self.__extract__( self.__labelsPath__(graceid) ) )} )
+        topLevel = self.engine.read( graceid, 'toplevel' )
+        topLevel.update( {'labels':dict( (label['name'], label['self']) for label in self.engine.read( graceid, 'labels' ) )} )
 
         return FakeTTPResponse( topLevel )
 
-    def logs(self, graceid):
+    def logs(self, graceid, start=0, count=None):
+        '''
+        the log messages for graceid. start and count select a page of them (count=None returns every message from start onward).
+        Only the requested messages are read from storage. numRows is always the total number of messages
+        '''
         self.check_graceid(graceid)
 
-        logs = self.__extract__( self.__logsPath__(graceid) )
+        if start < 0:
+            raise FakeTTPError('start=%d must be non-negative'%start)
+        if count==None:
+            stop = None
+        elif count < 0:
+            raise FakeTTPError('count=%d must be non-negative'%count)
+        else:
+            stop = start+count
+
+        logs = self.engine.readRange( graceid, 'logs', start=start, stop=stop )
+        if logs:
+            self.__applyTags__( logs, self.engine.tags( graceid ) )
         logsPath = self.__logsPath__(graceid)
-        return FakeTTPResponse( {'numRows':len(logs),
-                                 'start':0,
+        return FakeTTPResponse( {'numRows':self.engine.count( graceid, 'logs' ),
+                                 'start':start,
                                  'log': logs,
                                  'links':{'self'  : logsPath,
                                           'first' : logsPath,
@@ -922,10 +1222,112 @@ class FakeDb():
                                 }
                               )
 
+    def logs_since(self, graceid, n):
+        '''
+        the log messages written after message N=n, eg: logs_since(graceid, 0) returns every message.
+        Pollers can pass the largest N they have already seen to fetch only what is new
+        '''
+        return self.logs(graceid, start=n)
+
+    ### tags ###
+
+    def __tagnames__(self, tagname):
+        '''
+        GraceDb accepts a single tagname or a list of them (or None), see engines.tagnames
+        '''
+        return engines.tagnames(tagname)
+
+    def check_tagname(self, tagname):
+        if not (isinstance(tagname, basestring) and tagname):
+            raise FakeTTPError('tagname=%r not allowed'%(tagname,))
+
+    def __tag__(self, graceid, tagname):
+        '''
+        FakeDb does not keep display names, so every tag is displayed with its name
+        '''
+        return {'name'        : tagname,
+                'displayName' : tagname,
+                'self'        : self.__logsPath__(graceid),
+               }
+
+    def __applyTags__(self, logs, index):
+        '''
+        createTag and deleteTag only update the tag index (see engines.StorageEngine.tags), so we bring each log's tag_names up to date from it
+        '''
+        N2tags = dict()
+        for tagname, Ns in index.items():
+            for N in Ns:
+                N2tags.setdefault(N, set()).add(tagname)
+
+        for log in logs:
+            tagnames = self.__tagnames__(log['tag_names'])
+            current = N2tags.get(log['N'], set())
+            if current!=set(tagnames):
+                log['tag_names'] = [tagname for tagname in tagnames if tagname in current] + sorted(current.difference(tagnames))
+
+    def check_log(self, graceid, n):
+        '''
+        raises FakeTTPError if graceid or its log n does not exist
+        '''
+        self.check_graceid(graceid)
+        if not (1 <= n <= self.engine.count(graceid, 'logs')):
+            raise FakeTTPError('could not find log N=%d for graceid=%s'%(n, graceid))
+
+    def tags(self, graceid, n):
+        self.check_log(graceid, n)
+
+        index = self.engine.tags(graceid)
+        return FakeTTPResponse( {'tags': [self.__tag__(graceid, tagname) for tagname in sorted(index.keys()) if n in index[tagname]]} )
+
+    def createTag(self, graceid, n, tagname, displayName=None):
+        '''
+        tag log n of graceid. Tagging a log that already carries tagname does nothing. displayName is ignored
+        '''
+        self.check_log(graceid, n)
+        self.check_tagname(tagname)
+
+        self.engine.addTag(graceid, n, tagname)
+        return FakeTTPResponse( self.__tag__(graceid, tagname) )
+
+    def deleteTag(self, graceid, n, tagname):
+        self.check_log(graceid, n)
+
+        if not self.engine.removeTag(graceid, n, tagname):
+            raise FakeTTPError('could not find tag=%s for log N=%d of graceid=%s'%(tagname, n, graceid))
+        return FakeTTPResponse( self.__tag__(graceid, tagname) )
+
+    def taggedEvents(self, tagnames):
+        '''
+        the sorted graceids of events with at least one log that carries every tag in tagnames.
+        We only look at the events that the engine's tag index says have had these tags applied, so this does not scan every event's logs
+        '''
+        tagnames = self.__tagnames__(tagnames)
+        if not tagnames:
+            raise FakeTTPError('please supply at least one tagname')
+
+        candidates = set(self.engine.tag2graceids(tagnames[0]))
+        for tagname in tagnames[1:]:
+            candidates.intersection_update(self.engine.tag2graceids(tagname))
+
+        graceids = []
+        for graceid in sorted(candidates):
+            index = self.engine.tags(graceid)
+            if set.intersection(*[set(index.get(tagname, [])) for tagname in tagnames]): ### a single log carries all of them
+                graceids.append(graceid)
+        return graceids
+
+    def skymapEvents(self, lvem=True):
+        '''
+        the sorted graceids of events with a sky map (a log tagged sky_loc). If lvem, that log must also be tagged lvem
+        '''
+        if lvem:
+            return self.taggedEvents(['sky_loc', 'lvem'])
+        return self.taggedEvents(['sky_loc'])
+
     def labels(self, graceid, label=''):
         self.check_graceid(graceid)
 
-        return FakeTTPResponse( {'labels':self.__extract__( self.__labelsPath__(graceid) ),
+        return FakeTTPResponse( {'labels':self.engine.read( graceid, 'labels' ),
                                  'links': [{'self':self.__labelsPath__(graceid),
                                            'event':self.__directory__(graceid),
                                            }
@@ -936,24 +1338,180 @@ class FakeDb():
     def files(self, graceid, filename=None, raw=False):
         self.check_graceid(graceid)
 
-        return FakeTTPResponse( dict( (os.path.basename(filename), filename) for filename in self.__extract__( self.__filesPath__(graceid) ) ) )
+        return FakeTTPResponse( dict( (os.path.basename(filename), filename) for filename in self.engine.read( graceid, 'files' ) ) )
 
-    #--- methods that aren't really supported yet in any meaningful way
+    def signoffs(self, graceid, signoff_type='', instrument=''):
+        '''
+        graceid's current signoffs (one per signoff_type and instrument), optionally only those matching signoff_type and/or instrument.
+        Looking up a single signoff is a dictionary lookup rather than a scan through every signoff
+        '''
+        self.check_graceid(graceid)
 
-    def createVOEvent(self, *args, **kwargs):
-        """
-        WARNING: this is not actually implemented and is only present for syntactic completion.
-        If users actually need to reference the VOEvents that they create, then we'll have to actually implement somthing.
-        """
-        pass
+        index = self.engine.signoffs(graceid)
+        if signoff_type and instrument: ### a single signoff
+            keys = [key for key in [(signoff_type, instrument)] if index.has_key(key)]
+        else:
+            keys = [key for key in sorted(index.keys()) if ((not signoff_type) or (key[0]==signoff_type)) and ((not instrument) or (key[1]==instrument))]
+
+        return FakeTTPResponse( {'signoffs':[index[key] for key in keys],
+                                 'links': [{'self':self.__signoffsPath__(graceid),
+                                            'event':self.__directory__(graceid),
+                                           }
+                                          ],
+                                }
+                              )
+
+    def signoffHistory(self, graceid):
+        '''
+        every signoff written for graceid, in order, including those that were later updated
+        '''
+        self.check_graceid(graceid)
+
+        return FakeTTPResponse( {'signoffs':self.engine.read(graceid, 'signoffhistory')} )
+
+    ### VOEvents ###
+
+    def __attachments__(self, graceid):
+        '''
+        graceid's files (basename -> path) and the name of the most recent FITS file among them (or None).
+        Files are only ever added, so we remember what we have seen in an LRU and only read the files added since we last looked
+        '''
+        with self.__cacheLock__:
+            seen, attachments, skymap = self.__attachmentsCache__.pop(graceid, (0, dict(), None)) ### re-inserted below so it becomes the most recently used
+
+        for path in self.engine.readRange(graceid, 'files', start=seen):
+            name = os.path.basename(path)
+            attachments[name] = path
+            if name.endswith('.fits') or name.endswith('.fits.gz'):
+                skymap = name
+            seen += 1
+
+        with self.__cacheLock__:
+            self.__attachmentsCache__[graceid] = (seen, attachments, skymap)
+            while len(self.__attachmentsCache__) > self.__attachmentsCacheSize__:
+                self.__attachmentsCache__.popitem(last=False)
+
+        return attachments, skymap
+
+    def __voeventType__(self, voevent_type):
+        '''
+        GraceDb accepts the code (eg: 'PR', in either case) or its description (eg: 'preliminary'). Returns the code
+        '''
+        if isinstance(voevent_type, basestring):
+            if self.__allowedVOEventTypes__.has_key(voevent_type.upper()):
+                return voevent_type.upper()
+            for code, description in self.__allowedVOEventTypes__.items():
+                if voevent_type.lower()==description:
+                    return code
+        raise FakeTTPError('voevent_type=%s not allowed. Must be one of : %s'%(voevent_type, ', '.join(sorted(self.__allowedVOEventTypes__.values()))))
+
+    def __voeventFlag__(self, value, name):
+        '''
+        flags may arrive as bools, ints or strings (eg: over HTTP). Returns 0 or 1
+        '''
+        if isinstance(value, basestring):
+            value = value.strip().lower()
+            if value in ['1', 'true']:
+                return 1
+            elif value in ['0', 'false']:
+                return 0
+        elif value in [True, False, 0, 1]:
+            return int(value)
+        raise FakeTTPError('could not interpret %s=%s as a flag'%(name, value))
+
+    def __skymap__(self, graceid, skymap_filename=None, skymap_type=None):
+        '''
+        the (skymap_type, skymap_filename, path) a VOEvent announces. Without skymap_filename, we announce the most recent
+        FITS file attached to graceid (if any). skymap_type defaults to the file's name without its extension, eg: "bayestar"
+        '''
+        attachments, latest = self.__attachments__(graceid)
+        if skymap_filename:
+            skymap_filename = os.path.basename(skymap_filename)
+            if not attachments.has_key(skymap_filename):
+                raise FakeTTPError('could not find skymap_filename=%s for graceid=%s'%(skymap_filename, graceid))
+        elif latest:
+            skymap_filename = latest
+        else:
+            return None, None, None
+
+        if not skymap_type:
+            skymap_type = skymap_filename.split('.')[0]
+        return skymap_type, skymap_filename, attachments[skymap_filename]
+
+    def createVOEvent(self, graceid, voevent_type, **kwargs):
+        '''
+        generate a VOEvent for graceid from its top-level attributes and attach it as a file. voevent_type is one of
+        preliminary (PR), initial (IN), update (UP) or retraction (RE). We understand the kwargs
+            skymap_filename, skymap_type         : the sky map to announce (see __skymap__). Retractions never announce one
+            internal, open_alert, hardware_inj   : flags reported in the VOEvent
+            BNS, NSBH, BBH, MassGap, Terrestrial, ProbHasNS, ProbHasRemnant : optional probabilities
+        and ignore any others. The XML comes from templates compiled once per voevent_type (see ligoTest.gracedb.voevent)
+        '''
+        self.check_graceid(graceid)
+        voevent_type = self.__voeventType__(voevent_type)
+
+        flags = dict((name, self.__voeventFlag__(kwargs.get(name, default), name)) for name, default in [('internal', 1), ('open_alert', 0), ('hardware_inj', 0)])
+        probabilities = dict()
+        for name in ['BNS', 'NSBH', 'BBH', 'MassGap', 'Terrestrial', 'ProbHasNS', 'ProbHasRemnant']:
+            value = self.__emFloat__(kwargs.get(name), name)
+            if value!=None:
+                probabilities[name] = value
+
+        if voevent_type=='RE':
+            skymap_type, skymap_filename, skymap_url = None, None, None
+        else:
+            skymap_type, skymap_filename, skymap_url = self.__skymap__(graceid, skymap_filename=kwargs.get('skymap_filename'), skymap_type=kwargs.get('skymap_type'))
+
+        event = self.__meta__(graceid)
+        username = getpass.getuser()
+        with self.engine.lock(graceid): ### hold the lock so N matches where this VOEvent actually ends up
+            N = self.engine.count(graceid, 'voevents')+1
+            previous = self.engine.readRange(graceid, 'voevents', start=N-2) if N > 1 else []
+
+            created = time.time()
+            text = voe.render(voevent_type, event, N, created, self.__directory__(graceid),
+                              skymap_type=skymap_type, skymap_url=skymap_url, previous=previous[0]['ivorn'] if previous else None, **dict(flags, **probabilities))
+            filename = voe.filename(graceid, N, voevent_type)
+            path = self.engine.attachData(graceid, filename, text)
+
+            jsonD = {'self': self.__voeventsPath__(graceid),
+                     'N': N,
+                     'voevent_type': voevent_type,
+                     'ivorn': voe.ivorn(graceid, N, voevent_type),
+                     'created': created,
+                     'submitter': username+'@LIGO.ORG',
+                     'filename': filename,
+                     'file_version': 0,
+                     'file': path,
+                     'skymap_type': skymap_type,
+                     'skymap_filename': skymap_filename,
+                     'text': text,
+                     'links': {'event' : self.__directory__(graceid),
+                               'file'  : path,
+                              },
+                    }
+            jsonD.update( flags )
+            jsonD.update( probabilities )
+
+            self.engine.append( graceid, 'files', path )
+            self.engine.append( graceid, 'voevents', jsonD )
+
+        lvalert = {'uid':graceid,
+                   'alert_type':'update',
+                   'description':'VOEvent: %s'%filename,
+                   'file':filename,
+                   'object':jsonD,
+                  }
+        self.sendlvalert( lvalert, self.__node__(graceid) )
+        return FakeTTPResponse( jsonD )
 
     def voevents(self, graceid):
-        """
-        WARNING: not implemented yet. Should return some sort of list of VOEvents that have been created for this GraceId
-        """
+        '''
+        every VOEvent created for graceid, oldest first
+        '''
         self.check_graceid(graceid)
 
-        voevents = self.__extract__( self.__voeventsPath__(graceid) )
+        voevents = self.engine.read( graceid, 'voevents' )
         voeventsPath = self.__voeventsPath__(graceid)
         return FakeTTPResponse( {'numRows':len(voevents),
                                  'start':0,
@@ -965,59 +1523,207 @@ class FakeDb():
                                 }
                               )
 
-    def replaceEvent(self, graceid, filename, filecontents=None):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
+    ### EM followup ###
 
-    def numEvents(self, query=None):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
+    def __emCode__(self, value, allowed, name):
+        '''
+        GraceDb accepts either the code (eg: 'FO') or its description (eg: 'FOOTPRINT'). Returns the code
+        '''
+        if allowed.has_key(value):
+            return value
+        for code, description in allowed.items():
+            if value==description:
+                return code
+        raise FakeTTPError('%s=%s not allowed'%(name, value))
+
+    def __emFloat__(self, value, name):
+        '''
+        optional numbers may arrive as strings (eg: over HTTP). Missing values become None
+        '''
+        if (value==None) or (value==''):
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            raise FakeTTPError('could not interpret %s=%s as a number'%(name, value))
+
+    def writeEel(self, graceid, group, waveband, eel_status, obs_status, **kwargs):
+        '''
+        record an EMBB event log. Like GraceDb, we only keep the kwargs ra, dec, raWidth, decWidth, gpstime, duration,
+        comment and extra_info_dict and ignore any others
+        '''
+        self.check_graceid(graceid)
+        self.check_em_group(group)
+        self.check_waveband(waveband)
+        eel_status = self.__emCode__(eel_status, self.__allowedEELStatuses__, 'eel_status')
+        obs_status = self.__emCode__(obs_status, self.__allowedOBSStatuses__, 'obs_status')
+
+        username = getpass.getuser()
+        jsonD = {'created': time.time(),
+                 'self': self.__eelsPath__(graceid),
+                 'submitter': username+'@LIGO.ORG',
+                 'group': group,
+                 'waveband': waveband,
+                 'eel_status': eel_status,
+                 'obs_status': obs_status,
+                 'comment': kwargs.get('comment') or '',
+                 'extra_info_dict': kwargs.get('extra_info_dict') or '',
+                }
+        for key in ['ra', 'dec', 'raWidth', 'decWidth', 'gpstime', 'duration']:
+            jsonD[key] = self.__emFloat__(kwargs.get(key), key)
+
+        with self.engine.lock(graceid): ### hold the lock so N matches where this entry actually ends up
+            jsonD['N'] = self.engine.count(graceid, 'eels')+1
+            self.engine.append( graceid, 'eels', jsonD )
+
+        lvalert = {'uid':graceid,
+                   'alert_type':'update',
+                   'description':'New EMBB log entry',
+                   'file':'',
+                   'object':jsonD,
+                  }
+        self.sendlvalert( lvalert, self.__node__(graceid) )
+        return FakeTTPResponse( jsonD )
 
     def eels(self, graceid):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
+        self.check_graceid(graceid)
 
-    def writeEel(self, graceid, group, waveband, eel_status, obs_status, **kwargs):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
+        eels = self.engine.read( graceid, 'eels' )
+        eelsPath = self.__eelsPath__(graceid)
+        return FakeTTPResponse( {'numRows':len(eels),
+                                 'start':0,
+                                 'embblog':eels,
+                                 'links':{'self'  : eelsPath,
+                                          'first' : eelsPath,
+                                          'last'  : eelsPath,
+                                         },
+                                }
+                              )
+
+    def writeEMObservation(self, graceid, group, raList, raWidthList, decList, decWidthList, startTimeList, durationList, comment=None):
+        '''
+        record an EM observation made up of one footprint per entry in raList. The lists may be python lists, comma-separated
+        strings or single numbers (widths and durations with a single entry apply to every footprint). Start times are
+        ISO 8601 UTC (or unix timestamps). Footprints are stored as NumPy arrays (see footprints and footprintsOverlapping)
+        '''
+        self.check_graceid(graceid)
+        self.check_em_group(group)
+
+        try:
+            ra = fp.parseList(raList, name='raList')
+            raWidth = fp.parseList(raWidthList, name='raWidthList')
+            dec = fp.parseList(decList, name='decList')
+            decWidth = fp.parseList(decWidthList, name='decWidthList')
+            start = fp.parseTimes(startTimeList, name='startTimeList')
+            duration = fp.parseList(durationList, name='durationList')
+        except ValueError as e:
+            raise FakeTTPError(str(e))
+
+        username = getpass.getuser()
+        with self.engine.lock(graceid): ### hold the lock so N matches where this observation actually ends up
+            N = self.engine.count(graceid, 'emobservations')+1
+            try:
+                rows = fp.genFootprints(N, ra, raWidth, dec, decWidth, start, duration)
+            except ValueError as e:
+                raise FakeTTPError(str(e))
+
+            ra, raWidth, dec, decWidth = [float(value) for value in fp.bounds(rows)]
+            jsonD = {'N': N,
+                     'created': time.time(),
+                     'self': self.__emobservationsPath__(graceid),
+                     'submitter': username+'@LIGO.ORG',
+                     'group': group,
+                     'comment': comment or '',
+                     'ra': ra,
+                     'raWidth': raWidth,
+                     'dec': dec,
+                     'decWidth': decWidth,
+                     'footprint_count': len(rows),
+                    }
+
+            ### footprints go first, so an observation is never visible without them
+            self.engine.appendFootprints( graceid, rows )
+            self.engine.append( graceid, 'emobservations', jsonD )
+
+        jsonD['footprints'] = fp.toDicts(rows)
+        lvalert = {'uid':graceid,
+                   'alert_type':'update',
+                   'description':'New EMObservation entry',
+                   'file':'',
+                   'object':jsonD,
+                  }
+        self.sendlvalert( lvalert, self.__node__(graceid) )
+        return FakeTTPResponse( jsonD )
 
     def emobservations(self, graceid):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
+        '''
+        every EM observation for graceid along with its footprints
+        '''
+        self.check_graceid(graceid)
 
-    def writeEMObservation(self, graceid, group, raList, raWidthList, decList, decWidthList, startTimeList, durationList, comment=None):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
+        observations = self.engine.read( graceid, 'emobservations' )
+        if observations:
+            rows = self.engine.footprints( graceid ) ### stored in order of observation
+            edges = np.searchsorted(rows['observation'], [observation['N'] for observation in observations]+[observations[-1]['N']+1])
+            for observation, start, stop in zip(observations, edges[:-1], edges[1:]):
+                observation['footprints'] = fp.toDicts(rows[start:stop])
 
-    def tags(self, graceid, n):
-        """
-        WARNING: not implemented
-        """
-        raise NotImplementedError
+        emobservationsPath = self.__emobservationsPath__(graceid)
+        return FakeTTPResponse( {'numRows':len(observations),
+                                 'start':0,
+                                 'observations':observations,
+                                 'links':{'self'  : emobservationsPath,
+                                          'first' : emobservationsPath,
+                                          'last'  : emobservationsPath,
+                                         },
+                                }
+                              )
 
-    def createTag(self, graceid, n, tagname, displayName=None):
+    def footprints(self, graceid):
+        '''
+        every footprint of graceid's EM observations as a structured array (see footprints.footprintDtype)
+        '''
+        self.check_graceid(graceid)
+
+        return self.engine.footprints( graceid )
+
+    def footprintsOverlapping(self, ra=None, dec=None, start=None, stop=None):
+        '''
+        the footprints of every event that overlap a box on the sky and/or a range of times, as a structured array
+        (see footprints.indexDtype), eg:
+            footprintsOverlapping(ra=(350, 10), dec=(-30, 0))     (ra ranges may wrap through 0)
+            footprintsOverlapping(start='2017-08-17', stop='2017-08-18 12:00:00')
+        ra and dec are (low, high) in degrees. start and stop are anything ligoTest.gracedb.query.str2time understands.
+        Every comparison is vectorized over the engine's footprint index, so we never load events one at a time
+        '''
+        if start!=None:
+            start = gdbquery.str2time(start)
+        if stop!=None:
+            stop = gdbquery.str2time(stop)
+
+        rows = self.engine.allFootprints(start=start, stop=stop)
+        return rows[fp.overlaps(rows, ra=ra, dec=dec, start=start, stop=stop)]
+
+    def observationsOverlapping(self, ra=None, dec=None, start=None, stop=None):
+        '''
+        the sorted (graceid, N) of every EM observation with at least one footprint that satisfies footprintsOverlapping
+        '''
+        rows = self.footprintsOverlapping(ra=ra, dec=dec, start=start, stop=stop)
+        return sorted(set(zip(rows['graceid'].tolist(), rows['observation'].tolist())))
+
+    #--- methods that aren't really supported yet in any meaningful way
+
+    def replaceEvent(self, graceid, filename, filecontents=None):
         """
         WARNING: not implemented
         """
         raise NotImplementedError
 
-    def deleteTag(self, graceid, n, tagname):
+    def numEvents(self, query=None):
         """
-        WARNING: not implemented
+        the number of events that satisfy query (see events). We never read the events themselves unless query requires it
         """
-        raise NotImplementedError
+        return len(self.__query__(query))
 
     def ping(self):
     
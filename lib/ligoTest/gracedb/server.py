@@ -0,0 +1,631 @@
+description = "an HTTP server that serves a FakeDb through the REST routes used by ligo.gracedb.rest.GraceDb, and a GraceDb client that talks to it over plain HTTP"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import os
+import re
+import cgi
+import json
+import gzip
+import time
+import errno
+import shutil
+import socket
+import urllib
+import httplib
+import urlparse
+import tempfile
+import threading
+
+from cStringIO import StringIO
+
+from collections import deque
+from collections import defaultdict
+
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+
+import numpy as np
+
+from ligo.gracedb.rest import GraceDb
+
+from ligoTest.gracedb import engines
+from ligoTest.gracedb.rest import FakeDb
+from ligoTest.gracedb.rest import FakeTTPError
+from ligoTest.gracedb.rest import unwrapView
+
+#-------------------------------------------------
+
+class RequestStats(object):
+    '''
+    counts requests for each route and remembers the latency of the most recent ones so we can report percentiles.
+    Shared by every handler thread
+    '''
+
+    def __init__(self, window=10000, percentiles=[50, 90, 99]):
+        self.window = window ### the number of latencies we remember for each route
+        self.percentiles = percentiles
+        self.start = time.time()
+
+        self.__lock__ = threading.Lock()
+        self.__counts__ = defaultdict(int) ### route -> number of requests
+        self.__errors__ = defaultdict(int) ### route -> number of responses with status >= 400
+        self.__latencies__ = defaultdict(lambda: deque(maxlen=self.window)) ### route -> latencies (sec)
+
+    def record(self, route, latency, status):
+        with self.__lock__:
+            self.__counts__[route] += 1
+            if status >= 400:
+                self.__errors__[route] += 1
+            self.__latencies__[route].append(latency)
+
+    def __summarize__(self, count, errors, latencies, uptime):
+        ans = {'requests' : count,
+               'errors'   : errors,
+               'rps'      : count/uptime,
+              }
+        if latencies:
+            latencies = np.array(latencies)*1e3
+            ans['latency_ms'] = dict([('mean', np.mean(latencies)), ('max', np.max(latencies))] \
+                                     + [('p%d'%p, np.percentile(latencies, p)) for p in self.percentiles])
+        return ans
+
+    def summary(self):
+        '''
+        requests, errors, requests per second and latency percentiles (ms) for every route and for all routes together
+        '''
+        with self.__lock__:
+            counts = dict(self.__counts__)
+            errors = dict(self.__errors__)
+            latencies = dict((route, list(values)) for route, values in self.__latencies__.items())
+
+        uptime = max(time.time()-self.start, 1e-9)
+        ans = self.__summarize__(sum(counts.values()), sum(errors.values()), sum(latencies.values(), []), uptime)
+        ans['uptime'] = uptime
+        ans['routes'] = dict((route, self.__summarize__(count, errors.get(route, 0), latencies[route], uptime)) for route, count in counts.items())
+        return ans
+
+#-------------------------------------------------
+
+__graceid__ = r'(?P<graceid>[A-Z]\d+)'
+
+class FakeDbRequestHandler(BaseHTTPRequestHandler):
+    '''
+    maps the REST routes used by ligo.gracedb.rest.GraceDb onto FakeDb's methods.
+    Each connection gets its own FakeDb, so requests on different connections are handled concurrently
+    and connections are kept alive between requests (HTTP/1.1)
+    '''
+    protocol_version = 'HTTP/1.1'
+
+    ### (method, path relative to the server's prefix, name of the method that handles it)
+    __routes__ = [('GET',    r'',                                                   'serviceInfo'),
+                  ('GET',    r'_stats/?',                                           'stats'),
+                  ('GET',    r'events/?',                                           'events'),
+                  ('POST',   r'events/?',                                           'createEvent'),
+                  ('GET',    r'events/%s/?'%__graceid__,                            'event'),
+                  ('PUT',    r'events/%s/?'%__graceid__,                            'replaceEvent'),
+                  ('GET',    r'events/%s/log/?'%__graceid__,                        'logs'),
+                  ('POST',   r'events/%s/log/?'%__graceid__,                        'writeLog'),
+                  ('GET',    r'events/%s/log/(?P<n>\d+)/tag/?'%__graceid__,         'tags'),
+                  ('PUT',    r'events/%s/log/(?P<n>\d+)/tag/(?P<tagname>[^/]+)'%__graceid__, 'createTag'),
+                  ('DELETE', r'events/%s/log/(?P<n>\d+)/tag/(?P<tagname>[^/]+)'%__graceid__, 'deleteTag'),
+                  ('GET',    r'events/%s/files/?'%__graceid__,                      'files'),
+                  ('GET',    r'events/%s/files/(?P<filename>.+)'%__graceid__,       'file'),
+                  ('PUT',    r'events/%s/files/(?P<filename>.+)'%__graceid__,       'writeFile'),
+                  ('GET',    r'events/%s/labels/?'%__graceid__,                     'labels'),
+                  ('GET',    r'events/%s/labels/(?P<label>[^/]+)'%__graceid__,      'labels'),
+                  ('PUT',    r'events/%s/labels/(?P<label>[^/]+)'%__graceid__,      'writeLabel'),
+                  ('DELETE', r'events/%s/labels/(?P<label>[^/]+)'%__graceid__,      'removeLabel'),
+                  ('GET',    r'events/%s/signoff/?'%__graceid__,                    'signoffs'),
+                  ('POST',   r'events/%s/signoff/?'%__graceid__,                    'writeSignoff'),
+                  ('PUT',    r'events/%s/signoff/?'%__graceid__,                    'updateSignoff'),
+                  ('GET',    r'events/%s/voevent/?'%__graceid__,                    'voevents'),
+                  ('POST',   r'events/%s/voevent/?'%__graceid__,                    'createVOEvent'),
+                  ('GET',    r'events/%s/embb/?'%__graceid__,                       'eels'),
+                  ('POST',   r'events/%s/embb/?'%__graceid__,                       'writeEel'),
+                  ('GET',    r'events/%s/emobservation/?'%__graceid__,              'emobservations'),
+                  ('POST',   r'events/%s/emobservation/?'%__graceid__,              'writeEMObservation'),
+                 ]
+    __compiledRoutes__ = [(method, re.compile(route+'$'), name) for method, route, name in __routes__]
+
+    ### connections ###
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.fakedb = FakeDb(self.server.url, **self.server.fakedbKwargs)
+
+    def finish(self):
+        try:
+            BaseHTTPRequestHandler.finish(self)
+        finally:
+            self.fakedb.close() ### writes any buffered lvalert messages
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    ### dispatch ###
+
+    def __route__(self, method):
+        '''
+        find the handler for this request. Returns (name, kwargs from the path, query parameters)
+        '''
+        url = urlparse.urlparse(self.path) ### clients may send absolute urls
+        path = urllib.unquote(url.path)
+        if not path.startswith(self.server.prefix):
+            return None, None, None
+        path = path[len(self.server.prefix):]
+
+        for meth, regex, name in self.__compiledRoutes__:
+            if meth==method:
+                match = regex.match(path)
+                if match:
+                    return name, match.groupdict(), urlparse.parse_qs(url.query)
+        return None, None, None
+
+    def __handle__(self, method):
+        start = time.time()
+        name, kwargs, params = self.__route__(method)
+        try:
+            if name==None:
+                status, body, contentType = 404, json.dumps({'error':'%s %s not found'%(method, self.path)}), 'application/json'
+            else:
+                self.__readBody__()
+                status, body, contentType = getattr(self, '__%s__'%name)(params, **kwargs)
+
+        except FakeTTPError as e:
+            status = 404 if e.message.startswith('could not find') else 400
+            body, contentType = json.dumps({'error':e.message}), 'application/json'
+
+        except NotImplementedError as e:
+            status, body, contentType = 501, json.dumps({'error':'%s is not implemented by FakeDb'%name}), 'application/json'
+
+        except Exception as e:
+            status, body, contentType = 500, json.dumps({'error':'%s: %s'%(type(e).__name__, e)}), 'application/json'
+
+        self.__respond__(status, body, contentType)
+        self.server.stats.record('%s %s'%(method, name), time.time()-start, status)
+
+    def do_GET(self):
+        self.__handle__('GET')
+
+    def do_POST(self):
+        self.__handle__('POST')
+
+    def do_PUT(self):
+        self.__handle__('PUT')
+
+    def do_DELETE(self):
+        self.__handle__('DELETE')
+
+    ### requests and responses ###
+
+    def __readBody__(self):
+        '''
+        parse the body of the request into self.form (name -> list of values) and self.uploads (name -> (filename, contents)).
+        Understands json, urlencoded and multipart/form-data bodies
+        '''
+        self.form = dict()
+        self.uploads = dict()
+
+        length = int(self.headers.get('Content-Length', 0))
+        if not length:
+            return
+        body = self.rfile.read(length) ### read exactly this much so the connection can be reused
+
+        contentType = self.headers.get('Content-Type', '')
+        if contentType.startswith('application/json'):
+            for key, value in json.loads(body).items():
+                if value!=None:
+                    self.form[key] = value if isinstance(value, list) else [value]
+
+        elif contentType.startswith('multipart/form-data'):
+            fields = cgi.FieldStorage(fp=StringIO(body), headers=self.headers, environ={'REQUEST_METHOD':'POST', 'CONTENT_TYPE':contentType})
+            for key in fields.keys():
+                items = fields[key] if isinstance(fields[key], list) else [fields[key]]
+                for item in items:
+                    if item.filename:
+                        self.uploads[key] = (os.path.basename(item.filename), item.value)
+                    else:
+                        self.form.setdefault(key, []).append(item.value)
+
+        else:
+            self.form = urlparse.parse_qs(body)
+
+    def __field__(self, name, default=None):
+        return self.form.get(name, [default])[0]
+
+    def __respond__(self, status, body, contentType='application/json'):
+        headers = [('Content-Type', contentType)]
+        if (len(body) >= self.server.gzipMinSize) and ('gzip' in self.headers.get('Accept-Encoding', '')):
+            buf = StringIO()
+            file_obj = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=self.server.gzipLevel)
+            file_obj.write(body)
+            file_obj.close()
+            body = buf.getvalue()
+            headers.append( ('Content-Encoding', 'gzip') )
+        headers.append( ('Content-Length', str(len(body))) )
+
+        self.send_response(status)
+        for key, value in headers:
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def __json__(self, data, status=200):
+        return status, json.dumps(data, default=unwrapView), 'application/json'
+
+    def __response__(self, response, status=200):
+        '''
+        serialize a FakeTTPResponse
+        '''
+        return status, response.read(), 'application/json'
+
+    def __upload__(self, name):
+        '''
+        write an uploaded file where FakeDb can read it. Returns the path
+        '''
+        filename, contents = self.uploads[name]
+        directory = tempfile.mkdtemp(dir=self.server.uploadDirectory)
+        path = os.path.join(directory, filename)
+        file_obj = open(path, 'wb')
+        file_obj.write(contents)
+        file_obj.close()
+        return path
+
+    def __discard__(self, path):
+        '''
+        remove an uploaded file once FakeDb has stored it, unless FakeDb still references it
+        '''
+        if not self.server.keepUploads:
+            shutil.rmtree(os.path.dirname(path))
+
+    ### routes ###
+
+    def __serviceInfo__(self, params):
+        return self.__json__(self.server.serviceInfo(self.fakedb))
+
+    def __stats__(self, params):
+        return self.__json__(self.server.stats.summary())
+
+    def __events__(self, params):
+        '''
+        GraceDb treats count as a page size and follows links['next'] until there is none, while numEvents only reads numRows.
+        We run query once and only load the events on the page we return
+        '''
+        query = params.get('query', [None])[0]
+        orderby = params.get('orderby', [None])[0]
+        columns = params.get('columns', [None])[0]
+        start = int(params.get('start', [0])[0])
+        count = max(1, int(params.get('count', [self.server.pageSize])[0]))
+
+        numRows, events = self.fakedb.eventsPage(query=query, orderby=orderby, start=start, count=count, columns=columns)
+
+        base = dict((key, value) for key, value in [('query', query), ('orderby', orderby), ('columns', columns), ('count', count)] if value)
+        def link(start):
+            return self.server.serviceURL+'events/?'+urllib.urlencode(sorted(base.items()+[('start', start)]))
+
+        links = {'self'  : link(start),
+                 'first' : link(0),
+                 'last'  : link(max(0, (numRows-1)//count)*count),
+                }
+        if start+count < numRows:
+            links['next'] = link(start+count)
+        if start > 0:
+            links['previous'] = link(max(0, start-count))
+
+        return self.__json__({'numRows' : numRows,
+                              'events'  : events,
+                              'links'   : links,
+                             })
+
+    def __createEvent__(self, params):
+        filename = self.__upload__('eventFile')
+        try:
+            response = self.fakedb.createEvent(self.__field__('group'), self.__field__('pipeline'), filename, search=self.__field__('search'), offline=self.__field__('offline', 'False')=='True')
+        finally:
+            self.__discard__(filename)
+        data = response.json()
+        for label in self.form.get('labels', []): ### GraceDb applies these when it creates the event
+            self.fakedb.writeLabel(data['graceid'], label)
+        return self.__json__(data, status=201)
+
+    def __event__(self, params, graceid):
+        return self.__response__(self.fakedb.event(graceid))
+
+    def __replaceEvent__(self, params, graceid):
+        filename = self.__upload__('eventFile')
+        try:
+            return self.__response__(self.fakedb.replaceEvent(graceid, filename))
+        finally:
+            self.__discard__(filename)
+
+    def __logs__(self, params, graceid):
+        start = int(params.get('start', [0])[0])
+        if params.has_key('count'):
+            count = int(params['count'][0])
+        else:
+            count = None
+        return self.__response__(self.fakedb.logs(graceid, start=start, count=count))
+
+    def __writeLog__(self, params, graceid):
+        tagname = self.__field__('tagname')
+        tagname = tagname.split(',') if tagname else []
+        if self.uploads.has_key('upload'):
+            filename = self.__upload__('upload')
+            try:
+                response = self.fakedb.writeLog(graceid, self.__field__('message', ''), filename=filename, tagname=tagname, displayName=self.__field__('displayName'))
+            finally:
+                self.__discard__(filename)
+        else:
+            response = self.fakedb.writeLog(graceid, self.__field__('message', ''), tagname=tagname, displayName=self.__field__('displayName'))
+        return self.__response__(response, status=201)
+
+    def __tags__(self, params, graceid, n):
+        return self.__response__(self.fakedb.tags(graceid, int(n)))
+
+    def __createTag__(self, params, graceid, n, tagname):
+        return self.__response__(self.fakedb.createTag(graceid, int(n), tagname, displayName=self.__field__('displayName')), status=201)
+
+    def __deleteTag__(self, params, graceid, n, tagname):
+        return self.__response__(self.fakedb.deleteTag(graceid, int(n), tagname))
+
+    def __files__(self, params, graceid):
+        return self.__response__(self.fakedb.files(graceid))
+
+    def __file__(self, params, graceid, filename):
+        files = self.fakedb.files(graceid).json()
+        if not files.has_key(filename):
+            raise FakeTTPError('could not find filename=%s for graceid=%s'%(filename, graceid))
+        return 200, self.fakedb.engine.readAttachment(files[filename]), 'application/octet-stream'
+
+    def __writeFile__(self, params, graceid, filename):
+        path = self.__upload__('upload')
+        try:
+            return self.__response__(self.fakedb.writeFile(graceid, path), status=201)
+        finally:
+            self.__discard__(path)
+
+    def __labels__(self, params, graceid, label=''):
+        return self.__response__(self.fakedb.labels(graceid, label=label))
+
+    def __writeLabel__(self, params, graceid, label):
+        return self.__response__(self.fakedb.writeLabel(graceid, label), status=201)
+
+    def __removeLabel__(self, params, graceid, label):
+        return self.__response__(self.fakedb.removeLabel(graceid, label))
+
+    def __signoffs__(self, params, graceid):
+        return self.__response__(self.fakedb.signoffs(graceid, signoff_type=params.get('signoff_type', [''])[0], instrument=params.get('instrument', [''])[0]))
+
+    def __writeSignoff__(self, params, graceid):
+        return self.__response__(self.fakedb.writeSignoff(graceid, self.__field__('instrument'), self.__field__('signoff_type'), self.__field__('status')), status=201)
+
+    def __updateSignoff__(self, params, graceid):
+        return self.__response__(self.fakedb.updateSignoff(graceid, self.__field__('instrument'), self.__field__('signoff_type'), self.__field__('status')))
+
+    def __voevents__(self, params, graceid):
+        return self.__response__(self.fakedb.voevents(graceid))
+
+    def __createVOEvent__(self, params, graceid):
+        kwargs = dict((key, values[0]) for key, values in self.form.items())
+        return self.__response__(self.fakedb.createVOEvent(graceid, kwargs.pop('voevent_type', None), **kwargs), status=201)
+
+    def __eels__(self, params, graceid):
+        return self.__response__(self.fakedb.eels(graceid))
+
+    def __writeEel__(self, params, graceid):
+        kwargs = dict((key, values[0]) for key, values in self.form.items())
+        return self.__response__(self.fakedb.writeEel(graceid, kwargs.pop('group'), kwargs.pop('waveband'), kwargs.pop('eel_status'), kwargs.pop('obs_status'), **kwargs), status=201)
+
+    def __emobservations__(self, params, graceid):
+        return self.__response__(self.fakedb.emobservations(graceid))
+
+    def __writeEMObservation__(self, params, graceid):
+        field = self.__field__
+        return self.__response__(self.fakedb.writeEMObservation(graceid, field('group'), field('raList'), field('raWidthList'), field('decList'), field('decWidthList'), field('startTimeList'), field('durationList'), comment=field('comment')), status=201)
+
+class FakeDbServer(ThreadingMixIn, HTTPServer):
+    '''
+    serves the FakeDb at url (anything FakeDb understands) over HTTP, handling each connection in its own thread.
+    ligo.gracedb.rest.GraceDb-style clients (see FakeDbClient) should point at self.serviceURL.
+    Responses of at least gzipMinSize bytes are gzip-compressed for clients that accept it.
+    Request counts, requests per second and latency percentiles are kept in self.stats and served from prefix+"_stats/"
+
+    uploaded files are written into uploadDirectory (a temporary directory if None) before they are handed to FakeDb.
+    Searches return at most pageSize events at a time unless the client asks for another count, like GraceDb
+    '''
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, url, host='localhost', port=8000, prefix='/api/', uploadDirectory=None, gzipMinSize=1024, gzipLevel=6, pageSize=100, verbose=False, **fakedbKwargs):
+        if url==engines.MemoryEngine.anonymous:
+            raise ValueError('each connection gets its own FakeDb, so please use mem://name instead of %s'%url)
+        self.url = url
+        self.fakedbKwargs = fakedbKwargs
+
+        self.host = host if host not in ['', '0.0.0.0'] else 'localhost' ### what clients should connect to
+
+        self.prefix = '/'+prefix.strip('/')+'/' if prefix.strip('/') else '/'
+        self.gzipMinSize = gzipMinSize
+        self.gzipLevel = gzipLevel
+        self.pageSize = pageSize
+        self.verbose = verbose
+        self.stats = RequestStats()
+
+        fakedb = FakeDb(url, **fakedbKwargs) ### make sure we can, and see how it stores uploaded files
+        self.keepUploads = (fakedb.engine.attachMode=='symlink') ### FakeDb references the uploads themselves
+        fakedb.close()
+
+        self.removeUploads = uploadDirectory==None
+        if self.removeUploads:
+            uploadDirectory = tempfile.mkdtemp(prefix='fakedb-uploads-')
+        elif not os.path.exists(uploadDirectory):
+            os.makedirs(uploadDirectory)
+        self.uploadDirectory = uploadDirectory
+
+        HTTPServer.__init__(self, (host, port), FakeDbRequestHandler)
+
+    @property
+    def serviceURL(self):
+        return 'http://%s:%d%s'%(self.host, self.server_address[1], self.prefix)
+
+    def serviceInfo(self, fakedb):
+        '''
+        FakeDb's service_info with links and templates that point back at this server
+        '''
+        url = self.serviceURL
+        event = url+'events/{graceid}'
+        info = fakedb.service_info
+        info['links'] = {'self'        : url,
+                         'events'      : url+'events/',
+                         'performance' : url+'_stats/',
+                        }
+        info['templates'] = {'event-detail-template'       : event,
+                             'event-log-template'          : event+'/log/',
+                             'taglist-template'            : event+'/log/{n}/tag/',
+                             'tag-template'                : event+'/log/{n}/tag/{tagname}',
+                             'files-template'              : event+'/files/{filename}',
+                             'event-label-template'        : event+'/labels/{label}',
+                             'signoff-list-template'       : event+'/signoff/',
+                             'voevent-list-template'       : event+'/voevent/',
+                             'embb-event-log-template'     : event+'/embb/',
+                             'emobservation-list-template' : event+'/emobservation/',
+                            }
+        return info
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        if self.removeUploads and (not self.keepUploads):
+            shutil.rmtree(self.uploadDirectory, ignore_errors=True)
+
+#-------------------------------------------------
+
+class BufferedResponse(object):
+    '''
+    an httplib.HTTPResponse that has already been read (and decompressed) so its connection can be reused
+    '''
+
+    def __init__(self, response):
+        self.status = response.status
+        self.reason = response.reason
+        self.msg = response.msg
+        self.__headers__ = dict(response.getheaders())
+
+        body = response.read()
+        if self.getheader('content-encoding')=='gzip':
+            body = gzip.GzipFile(fileobj=StringIO(body)).read()
+        self.__body__ = StringIO(body)
+
+    def getheader(self, name, default=None):
+        return self.__headers__.get(name.lower(), default)
+
+    def getheaders(self):
+        return self.__headers__.items()
+
+    def read(self, amt=None):
+        if amt==None:
+            return self.__body__.read()
+        return self.__body__.read(amt)
+
+class FakeDbClient(GraceDb):
+    '''
+    a ligo.gracedb.rest.GraceDb that talks plain HTTP (no X509 credentials) to a FakeDbServer, eg:
+        FakeDbClient('http://localhost:8000/api/')
+    Each thread keeps its connection alive between requests and asks for gzip-compressed responses
+    '''
+
+    def __init__(self, service_url, timeout=60):
+        ### we do not call GsiRest.__init__ because it insists on credentials and HTTPS
+        url = urlparse.urlparse(service_url)
+        self.host = url.hostname
+        self.port = url.port or 80
+        self.timeout = timeout
+
+        self.service_url = service_url
+        self._service_info = None
+
+        self.__local__ = threading.local() ### one connection per thread
+
+    def getConnection(self):
+        conn = getattr(self.__local__, 'conn', None)
+        if conn==None:
+            conn = self.__local__.conn = httplib.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        return conn
+
+    def __dropConnection__(self):
+        conn = getattr(self.__local__, 'conn', None)
+        if conn!=None:
+            conn.close()
+            self.__local__.conn = None
+
+    def request(self, method, url, body=None, headers=None):
+        url = url and str(url) ### see GsiRest.request
+        headers = dict(headers or {})
+        headers.setdefault('Accept-Encoding', 'gzip')
+
+        reused = getattr(self.__local__, 'conn', None)!=None
+        try:
+            conn = self.getConnection()
+            conn.request(method, url, body, headers)
+            response = BufferedResponse(conn.getresponse())
+
+        except (httplib.BadStatusLine, socket.error) as e:
+            self.__dropConnection__()
+            if reused and ((not isinstance(e, socket.error)) or (e.errno in [errno.EPIPE, errno.ECONNRESET])):
+                ### the server closed our idle connection before it read the request, so it is safe to try again
+                conn = self.getConnection()
+                conn.request(method, url, body, headers)
+                response = BufferedResponse(conn.getresponse())
+            else:
+                raise
+
+        if response.getheader('connection', '').lower()=='close':
+            self.__dropConnection__()
+        return self.adjustResponse(response)
+
+    def logs(self, graceid, start=0, count=None):
+        '''
+        like GraceDb.logs, but the server only sends the page of messages selected by start and count (see FakeDb.logs)
+        '''
+        uri = self.templates['event-log-template'].format(graceid=graceid)
+        params = {}
+        if start:
+            params['start'] = start
+        if count!=None:
+            params['count'] = count
+        if params:
+            uri += '?'+urllib.urlencode(params)
+        return self.get(uri)
+
+    def logs_since(self, graceid, n):
+        '''
+        the log messages written after message N=n (see FakeDb.logs_since)
+        '''
+        return self.logs(graceid, start=n)
+
+    def signoffs(self, graceid, signoff_type='', instrument=''):
+        '''
+        graceid's current signoffs, optionally only those matching signoff_type and/or instrument (see FakeDb.signoffs)
+        '''
+        uri = self.templates['signoff-list-template'].format(graceid=graceid)
+        params = dict((key, value) for key, value in [('signoff_type', signoff_type), ('instrument', instrument)] if value)
+        if params:
+            uri += '?'+urllib.urlencode(params)
+        return self.get(uri)
+
+    def writeSignoff(self, graceid, instrument, signoff_type, status):
+        uri = self.templates['signoff-list-template'].format(graceid=graceid)
+        return self.post(uri, body={'instrument':instrument, 'signoff_type':signoff_type, 'status':status})
+
+    def updateSignoff(self, graceid, instrument, signoff_type, status):
+        uri = self.templates['signoff-list-template'].format(graceid=graceid)
+        return self.put(uri, body={'instrument':instrument, 'signoff_type':signoff_type, 'status':status})
+
+    def close(self):
+        '''
+        close this thread's connection
+        '''
+        self.__dropConnection__()
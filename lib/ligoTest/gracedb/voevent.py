@@ -0,0 +1,202 @@
+description = "renders GraceDb-style VOEvent XML from templates that are compiled once per voevent type, so each VOEvent is a single string substitution"
+author = "reed.essick@ligo.org"
+
+#-------------------------------------------------
+
+import time
+import bisect
+
+from xml.sax.saxutils import escape
+
+#-------------------------------------------------
+
+### voevent_type -> what the VOEvent calls itself and the GCN packet type it is distributed as
+alertTypes = {'PR' : 'Preliminary',
+              'IN' : 'Initial',
+              'UP' : 'Update',
+              'RE' : 'Retraction',
+             }
+
+packetTypes = {'PR' : 150,
+               'IN' : 151,
+               'UP' : 152,
+               'RE' : 164,
+              }
+
+### how each type refers to the VOEvent sent before it. Preliminary VOEvents do not cite anything
+__citeTypes__ = {'IN' : 'supersedes',
+                 'UP' : 'supersedes',
+                 'RE' : 'retraction',
+                }
+
+### the optional classification and properties we report, as (VOEvent Param, createVOEvent kwarg)
+__probabilities__ = [('BNS', 'BNS'),
+                     ('NSBH', 'NSBH'),
+                     ('BBH', 'BBH'),
+                     ('MassGap', 'MassGap'),
+                     ('Terrestrial', 'Terrestrial'),
+                     ('HasNS', 'ProbHasNS'),
+                     ('HasRemnant', 'ProbHasRemnant'),
+                    ]
+
+#-------------------------------------------------
+
+### gps times at which another leap second had been added to UTC since the GPS epoch
+__leapSeconds__ = [46828800, 78364801, 109900802, 173059203, 252028804, 315187205, 346723206, 393984007, 425520008,
+                   457056009, 504489610, 551750411, 599184012, 820108813, 914803214, 1025136015, 1119744016, 1167264017]
+__gpsEpoch__ = 315964800 ### 1980-01-06T00:00:00 as a unix timestamp
+
+def gps2unix(gpstime):
+    return gpstime + __gpsEpoch__ - bisect.bisect_right(__leapSeconds__, gpstime)
+
+def unix2iso(unix):
+    '''
+    unix timestamp -> ISO 8601 UTC with microseconds, eg: "2017-08-17T12:41:04.400000"
+    '''
+    sec, usec = divmod(int(round(unix*1e6)), 1000000)
+    return "%s.%06d"%(time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(sec)), usec)
+
+def gps2iso(gpstime):
+    return unix2iso(gps2unix(gpstime))
+
+#-------------------------------------------------
+
+def __compile__(voevent_type):
+    '''
+    the XML for voevent_type with named %-placeholders for everything that changes between VOEvents.
+    Optional sections (search, skymap, probabilities, citations) are rendered separately and substituted whole
+    '''
+    alertType = alertTypes[voevent_type]
+    retraction = voevent_type=='RE'
+
+    lines = ["<?xml version='1.0' encoding='UTF-8'?>",
+             '<voe:VOEvent xmlns:voe="http://www.ivoa.net/xml/VOEvent/v2.0" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" xsi:schemaLocation="http://www.ivoa.net/xml/VOEvent/v2.0 http://www.ivoa.net/xml/VOEvent/VOEvent-v2.0.xsd" version="2.0" role="%(role)s" ivorn="%(ivorn)s">',
+             '  <Who>',
+             '    <Date>%(date)s</Date>',
+             '    <Author>',
+             '      <contactName>LIGO Scientific Collaboration and Virgo Collaboration</contactName>',
+             '    </Author>',
+             '  </Who>',
+             '  <What>',
+             '    <Param name="Packet_Type" dataType="int" value="%d"/>'%packetTypes[voevent_type],
+             '    <Param name="internal" dataType="int" value="%(internal)s"/>',
+             '    <Param name="Pkt_Ser_Num" dataType="string" value="%(N)s"/>',
+             '    <Param name="GraceID" dataType="string" ucd="meta.id" value="%(graceid)s"/>',
+             '    <Param name="AlertType" dataType="string" ucd="meta.version" value="%s"/>'%alertType,
+             '    <Param name="HardwareInj" dataType="int" ucd="meta.number" value="%(hardware_inj)s"/>',
+             '    <Param name="OpenAlert" dataType="int" ucd="meta.number" value="%(open_alert)s"/>',
+             '    <Param name="EventPage" dataType="string" ucd="meta.ref.url" value="%(event_page)s"/>',
+            ]
+    if not retraction: ### retractions only say which event they retract
+        lines += ['    <Param name="Instruments" dataType="string" ucd="meta.code" value="%(instruments)s"/>',
+                  '    <Param name="FAR" dataType="float" ucd="arith.rate;stat.falsealarm" unit="Hz" value="%(far)s"/>',
+                  '    <Param name="Group" dataType="string" ucd="meta.code" value="%(group)s"/>',
+                  '    <Param name="Pipeline" dataType="string" ucd="meta.code" value="%(pipeline)s"/>',
+                  '%(search)s%(skymap)s%(probabilities)s  </What>',
+                 ]
+    else:
+        lines.append('  </What>')
+    lines += ['  <WhereWhen>',
+              '    <ObsDataLocation>',
+              '      <ObservatoryLocation id="LIGO Virgo"/>',
+              '      <ObservationLocation>',
+              '        <AstroCoordSystem id="UTC-FK5-GEO"/>',
+              '        <AstroCoords coord_system_id="UTC-FK5-GEO">',
+              '          <Time unit="s">',
+              '            <TimeInstant>',
+              '              <ISOTime>%(isotime)s</ISOTime>',
+              '            </TimeInstant>',
+              '          </Time>',
+              '        </AstroCoords>',
+              '      </ObservationLocation>',
+              '    </ObsDataLocation>',
+              '  </WhereWhen>',
+              '  <How>',
+              '    <Description>Candidate gravitational wave event identified by low-latency analysis</Description>',
+              '  </How>',
+              '  <Why importance="1">',
+              '    <Inference>',
+              '      <Name>%(graceid)s</Name>',
+              '    </Inference>',
+              '  </Why>',
+              '%(citations)s</voe:VOEvent>',
+              '',
+             ]
+    return '\n'.join(lines)
+
+### every template is compiled when we are imported
+templates = dict((voevent_type, __compile__(voevent_type)) for voevent_type in alertTypes.keys())
+
+__searchTemplate__ = '    <Param name="Search" dataType="string" ucd="meta.code" value="%s"/>\n'
+
+__skymapTemplate__ = '''    <Group type="GW_SKYMAP" name="%(skymap_type)s">
+      <Param name="skymap_fits_basic" dataType="string" ucd="meta.ref.url" value="%(skymap_url)s"/>
+    </Group>
+'''
+
+__probabilityTemplate__ = '      <Param name="%s" dataType="float" ucd="stat.probability" value="%s"/>\n'
+
+__citationsTemplate__ = '''  <Citations>
+    <EventIVORN cite="%(cite)s">%(ivorn)s</EventIVORN>
+    <Description>%(description)s</Description>
+  </Citations>
+'''
+
+#-------------------------------------------------
+
+def __escape__(value):
+    return escape(str(value), {'"':'&quot;'})
+
+def ivorn(graceid, N, voevent_type):
+    return "ivo://gwnet/LVC#%s-%d-%s"%(graceid, N, alertTypes[voevent_type])
+
+def filename(graceid, N, voevent_type):
+    return "%s-%d-%s.xml"%(graceid, N, alertTypes[voevent_type])
+
+def render(voevent_type, event, N, created, event_page, skymap_type=None, skymap_url=None, previous=None, internal=1, open_alert=0, hardware_inj=0, **probabilities):
+    '''
+    the XML for the N'th VOEvent sent for event (its top-level attributes, as FakeDb stores them)
+        created    : unix timestamp at which the VOEvent is issued
+        event_page : where the event can be found
+        skymap_*   : describe the sky map we announce (skymap_url=None means we do not announce one)
+        previous   : the ivorn of the VOEvent this one supersedes or retracts (if any)
+    probabilities may include BNS, NSBH, BBH, MassGap, Terrestrial, ProbHasNS and ProbHasRemnant
+    '''
+    graceid = event['graceid']
+    fields = {'role'         : 'test' if event['group']=='Test' else 'observation',
+              'ivorn'        : __escape__(ivorn(graceid, N, voevent_type)),
+              'date'         : unix2iso(created),
+              'internal'     : int(internal),
+              'N'            : N,
+              'graceid'      : __escape__(graceid),
+              'hardware_inj' : int(hardware_inj),
+              'open_alert'   : int(open_alert),
+              'event_page'   : __escape__(event_page),
+              'instruments'  : __escape__(event.get('instruments', '')),
+              'far'          : repr(float(event.get('far', 0.0))),
+              'group'        : __escape__(event['group']),
+              'pipeline'     : __escape__(event['pipeline']),
+              'isotime'      : gps2iso(event['gpstime']),
+              'search'       : '',
+              'skymap'       : '',
+              'probabilities': '',
+              'citations'    : '',
+             }
+
+    if event.get('search'):
+        fields['search'] = __searchTemplate__%__escape__(event['search'])
+
+    if skymap_url:
+        fields['skymap'] = __skymapTemplate__%{'skymap_type':__escape__(skymap_type), 'skymap_url':__escape__(skymap_url)}
+
+    params = [(name, probabilities[kwarg]) for name, kwarg in __probabilities__ if probabilities.get(kwarg)!=None]
+    if params:
+        fields['probabilities'] = '    <Group type="Classification">\n' + ''.join(__probabilityTemplate__%(name, repr(float(value))) for name, value in params) + '    </Group>\n'
+
+    if previous and __citeTypes__.has_key(voevent_type):
+        fields['citations'] = __citationsTemplate__%{'cite'        : __citeTypes__[voevent_type],
+                                                     'ivorn'       : __escape__(previous),
+                                                     'description' : '%s %s'%(alertTypes[voevent_type], __escape__(graceid)),
+                                                    }
+
+    return templates[voevent_type]%fields
@@ -12,6 +12,7 @@ import multiprocessing as mp
 import tempfile
 
 import time
+import threading
 
 #-------------------------------------------------
 
@@ -144,6 +145,79 @@ class LVAlertBuffer():
             if wait>0:
                 time.sleep(wait)
 
+class LVAlertWriter():
+    '''
+    a long-lived append handle on a lvalert.out file, used by FakeDb to record lvalert messages
+    lines are buffered and written according to a flush policy
+        flushEvery=N       -> write after every N lines (N=1 writes every line immediately)
+        flushInterval=T    -> also write anything still buffered T seconds after it was added
+    the file is opened with O_APPEND and every flush is a single os.write of whole lines,
+    so concurrent writers in separate processes interleave complete lines
+    '''
+
+    def __init__(self, filename, flushEvery=1, flushInterval=None):
+        if flushEvery < 1:
+            raise ValueError("flushEvery must be at least 1")
+        self.filename = filename
+        self.flushEvery = flushEvery
+        self.flushInterval = flushInterval
+
+        self.lock = threading.RLock()
+        self.fd = None
+        self.pid = None
+        self.buffer = []
+        self.timer = None
+
+    def __open__(self):
+        '''
+        (re)open the file if needed. A forked child gets its own descriptor and drops whatever its parent had buffered
+        '''
+        if self.pid != os.getpid():
+            self.fd = None
+            self.buffer = []
+            self.timer = None
+        if self.fd==None:
+            self.fd = os.open(self.filename, os.O_WRONLY|os.O_APPEND|os.O_CREAT, 0644)
+            self.pid = os.getpid()
+
+    def write(self, line):
+        '''
+        record a single line (without the trailing newline)
+        '''
+        with self.lock:
+            self.__open__()
+            self.buffer.append(line+"\n")
+            if len(self.buffer) >= self.flushEvery:
+                self.flush()
+            elif (self.flushInterval!=None) and (self.timer==None):
+                self.timer = threading.Timer(self.flushInterval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        '''
+        write everything that is buffered
+        '''
+        with self.lock:
+            if self.timer!=None:
+                self.timer.cancel()
+                self.timer = None
+            if self.buffer and (self.pid==os.getpid()):
+                data = "".join(self.buffer)
+                self.buffer = []
+                while data: ### os.write may be partial for very large buffers
+                    data = data[os.write(self.fd, data):]
+
+    def close(self):
+        '''
+        flush and release the file descriptor
+        '''
+        with self.lock:
+            self.flush()
+            if (self.fd!=None) and (self.pid==os.getpid()):
+                os.close(self.fd)
+            self.fd = None
+
 class FileMonitor():
     '''
     wraps around a file and knows how to monitor it for changes as well as extract those changes
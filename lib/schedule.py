@@ -7,9 +7,14 @@ import time
 
 import json
 
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
 from ligo.gracedb.rest import GraceDb
 from ligoTest.gracedb.rest import FakeDb
 from ligoTest.gracedb.rest import FakeTTPResponse
+from ligoTest.gracedb.server import FakeDbClient
 
 #-------------------------------------------------
 
@@ -17,12 +22,103 @@ def initGraceDb(url):
     '''
     a method that decides whether we want an actual instance of GraceDb or an instance of FakeDb based on the url
     currently, that's done by requring 'http' to be the begining of the url for real GraceDb instances. 
-    Otherwise we try to set up FakeDb, in which case we expect url to be a path.
+    Plain http://host:port/api/ urls are served by a local FakeDbServer (see lvalertTest_fakedb_server), so we talk to them with FakeDbClient.
+    Otherwise we try to set up FakeDb, in which case we expect url to be a path or a url whose scheme selects FakeDb's storage engine
+        sqlite:///path/to/db -> a single SQLite database
+        mem://name           -> Python structures shared by everything in this process that uses the same name
+        /path/to/directory   -> one directory per event (default)
     '''
-    if 'http' == url[:4]: ### could be fragile...
+    if 'http://' == url[:7]: ### GraceDb itself is only served over https
+        return FakeDbClient(url)
+    elif 'http' == url[:4]: ### could be fragile...
         return GraceDb(url)
     else:
-        return FakeDb(url) ### expects url to be a path
+        return FakeDb(url) ### FakeDb delegates to ligoTest.gracedb.engines.initEngine
+
+### a process-wide registry of clients so that every Action pointed at the same url shares a single GraceDb or FakeDb
+maxClients = 16 ### the most clients we keep open at once
+__clients__ = OrderedDict() ### url -> client, least recently used first
+__leases__ = dict() ### id(client) -> [client, number of leases, whether it was evicted], see leaseGraceDb
+__clientsLock__ = threading.Lock()
+
+def __getClient__(url):
+    '''
+    the shared client for url and the clients we evicted to make room for it. Must be called with __clientsLock__ held
+    '''
+    evicted = []
+    if __clients__.has_key(url):
+        client = __clients__.pop(url) ### re-inserted below so it becomes the most recently used
+    else:
+        client = initGraceDb(url)
+        while len(__clients__) >= maxClients:
+            old = __clients__.popitem(last=False)[1]
+            if __leases__.has_key(id(old)): ### still in use (eg: by execute_async's workers), so it is closed once released
+                __leases__[id(old)][2] = True
+            else:
+                evicted.append( old )
+    __clients__[url] = client
+    return client, evicted
+
+def getGraceDb(url):
+    '''
+    returns the shared client for url, creating it with initGraceDb if needed.
+    If we already hold maxClients clients, the least recently used one is closed to make room unless it is leased
+    (see leaseGraceDb), in which case it is closed when its last lease is released.
+    Use leaseGraceDb instead if the client must stay open while you use it
+    '''
+    with __clientsLock__:
+        client, evicted = __getClient__(url)
+    for old in evicted:
+        __closeClient__( old )
+    return client
+
+@contextmanager
+def leaseGraceDb(url):
+    '''
+    like getGraceDb, but the client is not closed by eviction until we are done with it, eg:
+        with leaseGraceDb(url) as gdb:
+            gdb.writeLog(graceid, message)
+    '''
+    with __clientsLock__:
+        client, evicted = __getClient__(url)
+        __leases__.setdefault(id(client), [client, 0, False])[1] += 1
+    for old in evicted:
+        __closeClient__( old )
+
+    try:
+        yield client
+    finally:
+        with __clientsLock__:
+            lease = __leases__[id(client)]
+            lease[1] -= 1
+            if lease[1]==0:
+                __leases__.pop(id(client))
+            release = (lease[1]==0) and lease[2]
+        if release: ### evicted while we held it
+            __closeClient__( client )
+
+def closeGraceDb(url=None):
+    '''
+    closes and forgets the shared client for url. If url is None, we close all shared clients.
+    Unlike eviction, this closes clients even if they are leased
+    '''
+    with __clientsLock__:
+        if url==None:
+            urls = __clients__.keys()
+        elif __clients__.has_key(url):
+            urls = [url]
+        else:
+            urls = []
+
+        for url in urls:
+            client = __clients__.pop(url)
+            if __leases__.has_key(id(client)): ### already closed, so do not close it again on release
+                __leases__[id(client)][2] = False
+            __closeClient__( client )
+
+def __closeClient__(client):
+    if hasattr(client, 'close'): ### FakeDb and requests-based GraceDb clients know how to close themselves
+        client.close()
 
 #-------------------------------------------------
 
@@ -34,6 +130,9 @@ class GraceDBEvent(object):
         self.__randStr__ = randStr
         self.__graceid__ = graceid
 
+        self.__lock__ = threading.Lock()
+        self.__last__ = None ### the Future of the most recent Action for this event started with Action.execute_async
+
     def __str__(self):
         return "randStr : %s\ngraceid : %s"%(self.randStr, str(self.__graceid__))
 
@@ -52,6 +151,15 @@ class GraceDBEvent(object):
         else:
             raise RuntimeError('graceid has already been set for this GraceDBEvent!')
 
+    def chain(self, future):
+        '''
+        record future as the most recent Action for this event and return the one before it (None if there was none)
+        '''
+        with self.__lock__:
+            previous = self.__last__
+            self.__last__ = future
+        return previous
+
 #-------------------------------------------------
 
 class Action(object):
@@ -89,6 +197,25 @@ class Action(object):
     def execute(self):
         return self.foo( *self.args, **self.kwargs )
 
+    def execute_async(self, executor):
+        '''
+        perform this action in executor (a ligoTest.gracedb.asyncdb.Executor) and return a Future for its result.
+        Blocks only if executor already holds as many calls as it allows.
+        Actions that reference the same GraceDBEvent run one after the other in the order they were started,
+        so nothing touches an event before CreateEvent has assigned its graceid. Different events run concurrently
+        '''
+        future = executor.reserve()
+        if hasattr(self, 'graceDBevent'):
+            previous = self.graceDBevent.chain(future)
+        else:
+            previous = None
+
+        if previous==None:
+            executor.start(future, self.execute)
+        else: ### start once the previous action for this event is done, whether or not it succeeded
+            previous.add_done_callback(lambda _: executor.start(future, self.execute))
+        return future
+
 class Schedule(object):
     '''
     an ordered list of Actions
@@ -175,9 +302,9 @@ class CreateEvent(Action):
         '''
         creates the entry in the database and updates self.graceDBevent.graceid so that other Actions know which graceid was assigned
         '''
-        gdb = initGraceDb(self.gdb_url) ### delegate to work out whether we want GraceDb or FakeDb
-        httpResponse = gdb.createEvent( self.group, self.pipeline, self.filename, search=self.search, offline=self.offline )
-        data = httpResponse.json()
+        with leaseGraceDb(self.gdb_url) as gdb: ### shared client, delegates to initGraceDb to work out whether we want GraceDb or FakeDb
+            httpResponse = gdb.createEvent( self.group, self.pipeline, self.filename, search=self.search, offline=self.offline )
+            data = httpResponse.json()
         self.graceDBevent.set_graceid( data['graceid'] ) 
         return FakeTTPResponse( data )  ### NOTE: we've already read the httpResponse once, so we need to make a new one...
 
@@ -202,8 +329,8 @@ class WriteLabel(Action):
     expiration : %s"""%(self.gdb_url, self.graceDBevent.get_randStr(), self.graceDBevent.get_graceid(force=True), self.label, self.dt, "%.3f"%self.expiration if self.expiration else "None")
 
     def writeLabel(self, *args, **kwargs):
-        gdb = initGraceDb(self.gdb_url) ### delegate to work out whether we want GraceDb or FakeDb
-        httpResponse = gdb.writeLabel( self.graceDBevent.get_graceid(), self.label )
+        with leaseGraceDb(self.gdb_url) as gdb: ### shared client, delegates to initGraceDb to work out whether we want GraceDb or FakeDb
+            httpResponse = gdb.writeLabel( self.graceDBevent.get_graceid(), self.label )
         return httpResponse
 
 class RemoveLabel(Action):
@@ -227,8 +354,8 @@ class RemoveLabel(Action):
     expiration : %s"""%(self.gdb_url, self.graceDBevent.get_randStr(), self.graceDBevent.get_graceid(force=True), self.label, self.dt, "%.3f"%self.expiration if self.expiration else "None")
 
     def removeLabel(self, *args, **kwargs):
-        gdb = initGraceDb(self.gdb_url) ### delegate to work out whether we want GraceDb or FakeDb
-        httpResponse = gdb.removeLabel( self.graceDBevent.get_graceid(), self.label )
+        with leaseGraceDb(self.gdb_url) as gdb: ### shared client, delegates to initGraceDb to work out whether we want GraceDb or FakeDb
+            httpResponse = gdb.removeLabel( self.graceDBevent.get_graceid(), self.label )
         return httpResponse
 
 class WriteLog(Action):
@@ -256,8 +383,8 @@ class WriteLog(Action):
     expiration : %s"""%(self.gdb_url, self.graceDBevent.get_randStr(), self.graceDBevent.get_graceid(force=True), self.message, self.filename, self.tagname, self.dt, "%.3f"%self.expiration if self.expiration else "None")
 
     def writeLog(self, *args, **kwargs):
-        gdb = initGraceDb(self.gdb_url) ### delegate to work out whether we want GraceDb or FakeDb
-        httpResponse = gdb.writeLog( self.graceDBevent.get_graceid(), self.message, filename=self.filename, tagname=self.tagname )
+        with leaseGraceDb(self.gdb_url) as gdb: ### shared client, delegates to initGraceDb to work out whether we want GraceDb or FakeDb
+            httpResponse = gdb.writeLog( self.graceDBevent.get_graceid(), self.message, filename=self.filename, tagname=self.tagname )
         return httpResponse
 
 class WriteFile(Action):
@@ -282,8 +409,8 @@ class WriteFile(Action):
     expiration : %s"""%(self.gdb_url, self.graceDBevent.get_randStr(), self.graceDBevent.get_graceid(force=True), self.filename, self.dt, "%.3f"%self.expiration if self.expiration else "None")
 
     def writeFile(self, *args, **kwargs):
-        gdb = initGraceDb(self.gdb_url) ### delegate to work out whether we want GraceDb or FakeDb
-        httpResponse = gdb.writeFile( self.graceDBevent.get_graceid(), filename=self.filename )
+        with leaseGraceDb(self.gdb_url) as gdb: ### shared client, delegates to initGraceDb to work out whether we want GraceDb or FakeDb
+            httpResponse = gdb.writeFile( self.graceDBevent.get_graceid(), filename=self.filename )
         return httpResponse
 
 class WriteSignoff(Action):
@@ -310,7 +437,7 @@ class WriteSignoff(Action):
     expiration : %s"""%(self.gdb_url, self.graceDBevent.get_randStr(), self.graceDBevent.get_graceid(force=True), self.signoff, self.dt, "%.3f"%self.expiration if self.expiration else "None")
 
     def writeSignoff(self, *args, **kwargs):
-        gdb = initGraceDb(self.gdb_url) ### delegate to work out whether we want GraceDb or FakeDb
-        httpResponse = gdb.writeSignoff( self.graceDBevent.get_graceid(), self.instrument, self.signoff_type, self.status )
+        with leaseGraceDb(self.gdb_url) as gdb: ### shared client, delegates to initGraceDb to work out whether we want GraceDb or FakeDb
+            httpResponse = gdb.writeSignoff( self.graceDBevent.get_graceid(), self.instrument, self.signoff_type, self.status )
         return httpResponse
 